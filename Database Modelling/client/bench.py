@@ -0,0 +1,276 @@
+import json
+import argparse
+import math
+import random
+import sys
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Replays a weighted mix of the REST endpoints against a running server, for a fixed duration
+# or number of requests, optionally at a target rate, and records per route latency
+# percentiles, a latency histogram and throughput. The JSON report can be compared with
+# an earlier run's to catch regressions:
+#   python bench.py -d 30 -r 200 -o new.json
+#   python bench.py -d 30 -r 200 -o new.json --compare old.json
+
+
+# Default mix. Paths and bodies may use {name} placeholders, filled per request from PARAMS:
+# a [low, high] int range or a list of choices. A body string that is exactly "{name}"
+# is replaced by the value itself (so ids stay ints).
+DEFAULT_MIX = {
+    "params": {
+        "song_id": [1, 1000],
+        "album_id": [1, 100],
+        "artist_id": [1, 200],
+        "num": [1, 20],
+        "date": ["2020-01-01", "2020-01-02", "2020-01-03"],
+        "count": [1, 5]
+    },
+    "routes": [
+        {"name": "song", "method": "GET", "path": "songs/{song_id}", "weight": 20},
+        {"name": "songs_by_album", "method": "GET", "path": "songs/by_album/{album_id}", "weight": 10},
+        {"name": "songs_by_artist", "method": "GET", "path": "songs/by_artist/{artist_id}", "weight": 10},
+        {"name": "album", "method": "GET", "path": "albums/{album_id}", "weight": 10},
+        {"name": "albums_by_artist", "method": "GET", "path": "albums/by_artist/{artist_id}", "weight": 5},
+        {"name": "artist", "method": "GET", "path": "artists/{artist_id}", "weight": 10},
+        {"name": "avg_song_length", "method": "GET", "path": "analytics/artists/avg_song_length/{artist_id}", "weight": 3},
+        {"name": "cnt_singles", "method": "GET", "path": "analytics/artists/cnt_singles/{artist_id}", "weight": 3},
+        {"name": "top_length", "method": "GET", "path": "analytics/artists/top_length/{num}", "weight": 3},
+        {"name": "solo_albums", "method": "GET", "path": "analytics/solo_albums", "weight": 1},
+        {"name": "top_song", "method": "GET", "path": "analytics/playcount/top_song/{date}", "weight": 3},
+        {"name": "top_source", "method": "GET", "path": "analytics/playcount/top_source/{song_id}/{date}", "weight": 3},
+        {"name": "top_country", "method": "GET", "path": "analytics/playcount/top_country/{date}", "weight": 3},
+        {"name": "post_play", "method": "POST", "path": "playcount", "weight": 15,
+         "body": {"date": "{date}", "song_id": "{song_id}", "play_count": "{count}"}}
+    ]
+}
+
+# upper bounds (ms) of the latency histogram buckets; the last bucket is everything above
+HISTOGRAM_BOUNDS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class BenchError(Exception):
+    def __init__(self, message=None):
+        Exception.__init__(self)
+        if message:
+            self.message = message
+        else:
+            self.message = "Bench Error"
+
+
+# Draws a value for each placeholder name
+def draw_params(params, rng):
+    values = {}
+    for name, spec in params.items():
+        if isinstance(spec, list) and len(spec) == 2 and all(isinstance(x, int) for x in spec):
+            values[name] = rng.randint(spec[0], spec[1])
+        elif isinstance(spec, list):
+            values[name] = rng.choice(spec)
+        else:
+            values[name] = spec
+    return values
+
+
+def fill(template, values):
+    if isinstance(template, dict):
+        return {k: fill(v, values) for k, v in template.items()}
+    if isinstance(template, list):
+        return [fill(v, values) for v in template]
+    if isinstance(template, str):
+        if template.startswith("{") and template.endswith("}") and template[1:-1] in values:
+            return values[template[1:-1]]
+        return template.format(**values)
+    return template
+
+
+# Per route latencies (seconds), status codes and errors
+class RouteStats:
+    def __init__(self):
+        self.latencies = []
+        self.status = {}
+        self.errors = 0
+
+    def add(self, latency, status):
+        self.latencies.append(latency)
+        self.status[status] = self.status.get(status, 0) + 1
+        if status == "error" or status >= 400:
+            self.errors += 1
+
+    def summary(self, elapsed):
+        ordered = sorted(self.latencies)
+        histogram = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        for latency in ordered:
+            ms = latency * 1000.0
+            bucket = 0
+            while bucket < len(HISTOGRAM_BOUNDS) and ms > HISTOGRAM_BOUNDS[bucket]:
+                bucket += 1
+            histogram[bucket] += 1
+        return {
+            "count": len(ordered),
+            "errors": self.errors,
+            "status": {str(k): v for k, v in sorted(self.status.items(), key=lambda kv: str(kv[0]))},
+            "throughput": len(ordered) / elapsed if elapsed > 0 else 0.0,
+            "p50_ms": percentile(ordered, 50),
+            "p90_ms": percentile(ordered, 90),
+            "p99_ms": percentile(ordered, 99),
+            "max_ms": ordered[-1] * 1000.0 if ordered else None,
+            "histogram_ms": {"bounds": HISTOGRAM_BOUNDS, "counts": histogram},
+        }
+
+
+# Nearest rank percentile of sorted latencies, in ms
+def percentile(ordered, pct):
+    if not ordered:
+        return None
+    rank = max(int(math.ceil(pct / 100.0 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)] * 1000.0
+
+
+def run_bench(cfg, mix):
+    server = "http://%s:%s/" % (cfg.server, cfg.port)
+    routes = mix["routes"]
+    weights = [r.get("weight", 1) for r in routes]
+    stats = {r["name"]: RouteStats() for r in routes}
+    lock = threading.Lock()
+    counter = [0]
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=cfg.concurrency)
+    session.mount("http://", adapter)
+
+    start = time.perf_counter()
+    end = start + cfg.duration if cfg.duration else None
+
+    # Hands out the next request number, or None when the run is over
+    def next_request():
+        with lock:
+            i = counter[0]
+            if cfg.requests and i >= cfg.requests:
+                return None
+            counter[0] += 1
+        return i
+
+    def worker(seed):
+        rng = random.Random(seed)
+        while True:
+            i = next_request()
+            if i is None:
+                return
+            # with a target rate request i is due at start + i/rate; latency counts from then,
+            # so a slow server's queueing shows up instead of silently lowering the rate
+            due = start + i / cfg.rate if cfg.rate else time.perf_counter()
+            if end is not None and due >= end:
+                return
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            route = rng.choices(routes, weights)[0]
+            values = draw_params(mix.get("params", {}), rng)
+            url = server + fill(route["path"], values)
+            sent = due if cfg.rate else time.perf_counter()
+            try:
+                if route.get("method", "GET") == "POST":
+                    r = session.post(url, json=fill(route.get("body", {}), values))
+                else:
+                    r = session.get(url)
+                status = r.status_code
+            except RequestException:
+                status = "error"
+            latency = time.perf_counter() - sent
+            with lock:
+                stats[route["name"]].add(latency, status)
+
+    with ThreadPoolExecutor(max_workers=cfg.concurrency) as executor:
+        futures = [executor.submit(worker, cfg.seed * 1000 + n) for n in range(cfg.concurrency)]
+    elapsed = time.perf_counter() - start
+    session.close()
+
+    # a worker that died would leave numbers from a partial run
+    failures = [f.exception() for f in futures if f.exception() is not None]
+    if failures:
+        raise BenchError("%d of %d workers failed, first with %r" % (len(failures), cfg.concurrency, failures[0]))
+
+    total = RouteStats()
+    for s in stats.values():
+        total.latencies.extend(s.latencies)
+        total.errors += s.errors
+        for k, v in s.status.items():
+            total.status[k] = total.status.get(k, 0) + v
+    return {
+        "config": {"server": server, "duration": cfg.duration, "requests": cfg.requests, "rate": cfg.rate,
+                   "concurrency": cfg.concurrency, "seed": cfg.seed},
+        "elapsed": elapsed,
+        "total": total.summary(elapsed),
+        "routes": {name: s.summary(elapsed) for name, s in stats.items() if s.latencies},
+    }
+
+
+def print_report(report):
+    print("%-20s %8s %7s %10s %9s %9s %9s %9s" % ("route", "count", "errors", "req/s", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    rows = sorted(report["routes"].items()) + [("TOTAL", report["total"])]
+    for name, r in rows:
+        print("%-20s %8d %7d %10.1f %9.2f %9.2f %9.2f %9.2f" % (name, r["count"], r["errors"], r["throughput"],
+                                                                r["p50_ms"] or 0, r["p90_ms"] or 0, r["p99_ms"] or 0, r["max_ms"] or 0))
+
+
+# Prints how each route moved against baseline; returns the routes that regressed more than threshold
+def compare(report, baseline, threshold):
+    regressions = []
+    print("%-20s %12s %12s %12s" % ("route", "p50 change", "p99 change", "req/s change"))
+    for name, r in sorted(report["routes"].items()):
+        if name not in baseline["routes"]:
+            continue
+        b = baseline["routes"][name]
+        changes = []
+        for key in ("p50_ms", "p99_ms", "throughput"):
+            if b[key]:
+                changes.append((r[key] - b[key]) / b[key])
+            else:
+                changes.append(0.0)
+        print("%-20s %+11.1f%% %+11.1f%% %+11.1f%%" % (name, changes[0] * 100, changes[1] * 100, changes[2] * 100))
+        if changes[1] > threshold or -changes[2] > threshold:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--server", help="Server hostname (default localhost)", default="localhost")
+    parser.add_argument("-p", "--port", help="Server port (default 5000)", default=5000, type=int)
+    parser.add_argument("-m", "--mix", help="JSON file with the route mix (default: built in mix)")
+    parser.add_argument("-d", "--duration", help="Run for this many seconds", type=float)
+    parser.add_argument("-n", "--requests", help="Run this many requests", type=int)
+    parser.add_argument("-r", "--rate", help="Target requests/sec (default: as fast as possible)", type=float)
+    parser.add_argument("-c", "--concurrency", help="Parallel clients (default 8)", default=8, type=int)
+    parser.add_argument("--seed", help="Random seed (default 1)", default=1, type=int)
+    parser.add_argument("-o", "--out", help="Write the JSON report here")
+    parser.add_argument("--compare", help="Baseline JSON report to compare against")
+    parser.add_argument("--threshold", help="Relative p99/throughput change that fails the compare (default 0.2)",
+                        default=0.2, type=float)
+    config = parser.parse_args()
+    try:
+        if not config.duration and not config.requests:
+            raise BenchError("Give a --duration and/or a number of --requests")
+        mix = DEFAULT_MIX
+        if config.mix:
+            with open(config.mix) as mix_file:
+                mix = json.load(mix_file)
+        report = run_bench(config, mix)
+        print_report(report)
+        if config.out:
+            with open(config.out, "w") as out:
+                json.dump(report, out, indent=1)
+        if config.compare:
+            with open(config.compare) as baseline_file:
+                regressions = compare(report, json.load(baseline_file), config.threshold)
+            if regressions:
+                print("Regressed: %s" % ", ".join(regressions))
+                sys.exit(1)
+    except BenchError as e:
+        print("BenchError: %s" % e.message)
+        sys.exit(2)
@@ -0,0 +1,236 @@
+import json
+import argparse
+import bisect
+import datetime
+import os
+import random
+from array import array
+
+
+# Generates a synthetic catalog (artists, songs, albums, playlists) and play history of any
+# size, streamed straight to disk in the formats the loaders read:
+#   loader:  {"path": ..., "data": [...]}                      (python loader.py -f songs.json)
+#   loader2: {"post_path": ..., "response": 201, "values": [...]} plus a script.json
+#   ndjson:  one object per line                               (POST /<path>/stream)
+# Records are written as they are made; only one int per album (its first song id) is kept.
+# The same seed and sizes always give the same data.
+#   python generate.py -o data --artists 100000 --songs 2000000 --plays 50000000
+
+
+# (output name, POST path) of each entity, in load order
+ENTITIES = [("artists", "artist"), ("songs", "songs"), ("albums", "album"),
+            ("playlists", "playlists"), ("plays", "playcount")]
+
+COUNTRIES = ["US", "UK", "CA", "FR", "DE", "SE", "JP", "KR", "BR", "MX", "NG", "IN", "AU"]
+
+
+class GenerateError(Exception):
+    def __init__(self, message=None):
+        Exception.__init__(self)
+        if message:
+            self.message = message
+        else:
+            self.message = "Generate Error"
+
+
+# Draws ranks in [1, n] with P(rank) roughly proportional to 1/rank^s (continuous
+# inverse CDF, so no per-rank table is needed)
+def zipf(rng, n, s):
+    u = rng.random()
+    if abs(s - 1.0) < 1e-9:
+        x = n ** u
+    else:
+        x = ((n ** (1.0 - s) - 1.0) * u + 1.0) ** (1.0 / (1.0 - s))
+    return min(max(int(x), 1), n)
+
+
+# Maps popularity rank to id with a fixed permutation, so the popular ids are spread out
+def rank_to_id(rank, n):
+    step = 2654435761 % n or 1
+    while gcd(step, n) != 1:
+        step += 1
+    return ((rank - 1) * step) % n + 1
+
+
+def gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+
+# Writes records to every requested format of one entity as they come
+class EntityWriter:
+    def __init__(self, out_dir, formats, name, post_path):
+        self.files = []
+        self.first = True
+        if "loader" in formats:
+            f = open(os.path.join(out_dir, "loader", name + ".json"), "w")
+            f.write('{"path": %s, "data": [\n' % json.dumps(post_path))
+            self.files.append((f, "array"))
+        if "loader2" in formats:
+            f = open(os.path.join(out_dir, "loader2", name + ".json"), "w")
+            f.write('{"post_path": %s, "response": 201, "values": [\n' % json.dumps(post_path))
+            self.files.append((f, "array"))
+        if "ndjson" in formats:
+            f = open(os.path.join(out_dir, "ndjson", name + ".ndjson"), "w")
+            self.files.append((f, "lines"))
+        self.count = 0
+
+    def write(self, record):
+        line = json.dumps(record)
+        for f, kind in self.files:
+            if kind == "array" and not self.first:
+                f.write(",\n")
+            f.write(line)
+            if kind == "lines":
+                f.write("\n")
+        self.first = False
+        self.count += 1
+
+    def close(self):
+        for f, kind in self.files:
+            if kind == "array":
+                f.write("\n]}\n")
+            f.close()
+
+
+def generate(cfg):
+    formats = set(cfg.formats.split(","))
+    unknown = formats - {"loader", "loader2", "ndjson"}
+    if unknown:
+        raise GenerateError("Unknown format(s) %s" % ", ".join(sorted(unknown)))
+    if cfg.artists < 1 or cfg.songs < 1:
+        raise GenerateError("Need at least one artist and one song")
+    for fmt in formats:
+        os.makedirs(os.path.join(cfg.out, fmt), exist_ok=True)
+
+    writers = {name: EntityWriter(cfg.out, formats, name, post_path) for name, post_path in ENTITIES}
+    rng = random.Random(cfg.seed)
+
+    def pick_artist():
+        return rank_to_id(zipf(rng, cfg.artists, cfg.zipf), cfg.artists)
+
+    def song_artists(main_artist):
+        artist_ids = [main_artist]
+        while rng.random() < cfg.collab and len(artist_ids) < 4:
+            other = pick_artist()
+            if other not in artist_ids:
+                artist_ids.append(other)
+        return sorted(artist_ids)
+
+    # artists
+    for artist_id in range(1, cfg.artists + 1):
+        record = {"artist_id": artist_id, "artist_name": "artist_%d" % artist_id}
+        if rng.random() > cfg.no_country:
+            record["country"] = COUNTRIES[zipf(rng, len(COUNTRIES), 1.0) - 1]
+        writers["artists"].write(record)
+
+    # album tracks, then singles; songs and albums are written in the same pass
+    album_starts = array("q")
+    album_tracks = int(cfg.songs * (1.0 - cfg.singles))
+    song_id = 1
+    album_id = 1
+    year = cfg.start_year
+    while song_id <= album_tracks:
+        size = min(rng.randint(cfg.min_tracks, cfg.max_tracks), album_tracks - song_id + 1)
+        artist_id = pick_artist()
+        song_ids = list(range(song_id, song_id + size))
+        for track in song_ids:
+            writers["songs"].write({"song_id": track, "song_name": "song_%d" % track,
+                                    "length": rng.randint(90, 420), "artist_ids": song_artists(artist_id)})
+        writers["albums"].write({"album_id": album_id, "album_name": "album_%d" % album_id,
+                                 "release_year": year + rng.randint(0, cfg.years - 1),
+                                 "artist_ids": [artist_id], "song_ids": song_ids})
+        album_starts.append(song_id)
+        song_id += size
+        album_id += 1
+    for single in range(song_id, cfg.songs + 1):
+        writers["songs"].write({"song_id": single, "song_name": "song_%d" % single,
+                                "length": rng.randint(90, 420), "artist_ids": song_artists(pick_artist())})
+    albums = len(album_starts)
+
+    def pick_song():
+        return rank_to_id(zipf(rng, cfg.songs, cfg.zipf), cfg.songs)
+
+    # album a song is a track of, or None for a single
+    def album_of(song):
+        if song > album_tracks:
+            return None
+        return bisect.bisect_right(album_starts, song)
+
+    # playlists
+    for playlist_id in range(1, cfg.playlists + 1):
+        size = rng.randint(cfg.min_tracks, cfg.max_tracks * 2)
+        song_ids = []
+        for _ in range(size):
+            song = pick_song()
+            if song not in song_ids:
+                song_ids.append(song)
+        writers["playlists"].write({"playlist_id": playlist_id, "playlist_name": "playlist_%d" % playlist_id,
+                                    "author_name": "author_%d" % rng.randint(1, max(cfg.playlists // 10, 1)),
+                                    "song_ids": song_ids})
+
+    # plays, in date order
+    start = datetime.date.fromisoformat(cfg.start_date)
+    for n in range(cfg.plays):
+        date = start + datetime.timedelta(days=n * cfg.days // max(cfg.plays, 1))
+        song = pick_song()
+        record = {"date": date.isoformat(), "song_id": song, "play_count": zipf(rng, 100, 2.0)}
+        source = rng.random()
+        album = album_of(song)
+        if source < cfg.album_plays and album is not None:
+            record["album_id"] = album
+        elif source > 1.0 - cfg.playlist_plays and cfg.playlists:
+            record["playlist_id"] = rng.randint(1, cfg.playlists)
+        writers["plays"].write(record)
+
+    for writer in writers.values():
+        writer.close()
+
+    if "loader2" in formats:
+        script = [{"url": "create", "response": 200}] + [{"file": name + ".json"} for name, _ in ENTITIES]
+        with open(os.path.join(cfg.out, "loader2", "script.json"), "w") as f:
+            json.dump(script, f, indent=1)
+
+    counts = {name: writers[name].count for name, _ in ENTITIES}
+    print("Wrote %s to %s (%d albums)" % (counts, cfg.out, albums))
+    return counts
+
+
+# Command line options; also used by server/microbench.py to build its data sets
+def make_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--out", help="Output folder", required=True)
+    parser.add_argument("-f", "--formats", help="Comma separated: loader, loader2, ndjson (default all)",
+                        default="loader,loader2,ndjson")
+    parser.add_argument("--seed", help="Random seed (default 1)", default=1, type=int)
+    parser.add_argument("--artists", help="Number of artists (default 1000)", default=1000, type=int)
+    parser.add_argument("--songs", help="Number of songs (default 10000)", default=10000, type=int)
+    parser.add_argument("--playlists", help="Number of playlists (default 500)", default=500, type=int)
+    parser.add_argument("--plays", help="Number of play events (default 100000)", default=100000, type=int)
+    parser.add_argument("--zipf", help="Popularity skew of artists and songs, 0 = uniform (default 1.1)",
+                        default=1.1, type=float)
+    parser.add_argument("--collab", help="Chance a song gets each extra artist (default 0.15)", default=0.15, type=float)
+    parser.add_argument("--singles", help="Fraction of songs not on an album (default 0.2)", default=0.2, type=float)
+    parser.add_argument("--no-country", dest="no_country", help="Fraction of artists without a country (default 0.05)",
+                        default=0.05, type=float)
+    parser.add_argument("--min-tracks", dest="min_tracks", help="Smallest album (default 4)", default=4, type=int)
+    parser.add_argument("--max-tracks", dest="max_tracks", help="Largest album (default 20)", default=20, type=int)
+    parser.add_argument("--start-year", dest="start_year", help="First release year (default 1960)", default=1960, type=int)
+    parser.add_argument("--years", help="Release years spanned (default 60)", default=60, type=int)
+    parser.add_argument("--start-date", dest="start_date", help="First play date (default 2020-01-01)",
+                        default="2020-01-01")
+    parser.add_argument("--days", help="Days of play history (default 30)", default=30, type=int)
+    parser.add_argument("--album-plays", dest="album_plays", help="Share of plays from an album (default 0.3)",
+                        default=0.3, type=float)
+    parser.add_argument("--playlist-plays", dest="playlist_plays", help="Share of plays from a playlist (default 0.2)",
+                        default=0.2, type=float)
+    return parser
+
+
+if __name__ == "__main__":
+    config = make_parser().parse_args()
+    try:
+        generate(config)
+    except GenerateError as e:
+        print("GenerateError: %s" % e.message)
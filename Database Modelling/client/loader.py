@@ -46,6 +46,8 @@ def run_loader(config):
             print("Using post url to load %s" % post_url)
             if config.single:
                 load_single(config, json_input, post_url)         
+            elif config.bulk:
+                load_bulk(config, json_input, post_url)
             else:
                 for x in json_input:
                     load_single(config, x, post_url)
@@ -116,6 +118,28 @@ def load_single(config, json_input, post_url):
         print("Unexpected error:", sys.exc_info()[0])
         raise
 
+#posts the data in chunks of config.bulk records to the /bulk variant of post_url
+def load_bulk(config, json_input, post_url):
+    bulk_url = post_url + "/bulk"
+    size = int(config.bulk)
+    try:
+        for start in range(0, len(json_input), size):
+            r = requests.post(bulk_url, json=json_input[start:start + size])
+            if r.status_code >= 400:
+                print("Error.  %s  Body: %s" % (r,r.content))
+            else:
+                res = r.json()
+                print("Resp: %s  Inserted: %s" % (r, res["inserted"]))
+                for failure in res["failed"]:
+                    print("Failed record %s: %s" % (start + failure["index"], failure["message"]))
+
+    except ConnectionError as err:
+        print("Connection error, halting %s" % err)
+        return
+    except:
+        print("Unexpected error:", sys.exc_info()[0])
+        raise
+
 def get_single(config, json_test, get_url):
     try:
         if "inputs" not in json_test:
@@ -156,5 +180,6 @@ if __name__ == "__main__":
     parser.add_argument("-e", "--endpoints", dest="endpoints", help="Run all test for endpoints")
     parser.add_argument("-p", "--port", dest="port", help="Port Flask App is running on")
     parser.add_argument("--single", help="Call a loader for a JSON file with a single entry",action="store_true")
+    parser.add_argument("--bulk", help="Load the file through the /bulk endpoint, this many records per request", type=int)
     config = parser.parse_args()
     run_loader(config)
\ No newline at end of file
@@ -2,8 +2,12 @@ import json
 import argparse
 import sys
 import requests
+import time
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError, ConnectTimeout
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from os import path
 
 
@@ -45,81 +49,148 @@ def validate_script(script_file):
                                           % (test_file, test_file_json.keys()))
 
 
-# Run a single file which is made up of multiple requests to the same URL
-def run_test_file(server, test_file_path, fail_on_wrong_response=True):        
+# Counts of requests made and failed over a run, for the closing report
+class RunStats:
+    def __init__(self):
+        self.started = time.time()
+        self.records = 0
+        self.errors = 0
+
+    def report(self):
+        elapsed = time.time() - self.started
+        rate = self.records / elapsed if elapsed > 0 else 0.0
+        print("Records %s  Errors %s  Time %.2fs  Records/sec %.1f" % (self.records, self.errors, elapsed, rate))
+
+
+# A keep-alive session whose connection pool fits concurrency parallel requests
+def make_session(concurrency):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(concurrency, 1))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Posts one value, returns None or the failure message
+def post_value(session, post_url, v, response):
+    r = session.post(post_url, json=v)
+    if r.status_code != response:
+        return ("Failure (%s) on post to %s with value: %s. Body: %s "
+                % (r.status_code, post_url, v, r.content))
+    return None
+
+
+# Runs one get test, returns None or the failure message
+def get_test(session, get_urlbase, v, response, fail_on_wrong_response=True):
+    if "inputs" in v:
+        inputs = v["inputs"]
+        get_url = "%s/%s" % (get_urlbase, str(inputs))
+    else:
+        get_url = get_urlbase
+    # appending parameters into get_url
+    expected = v["expected"]
+
+    r = session.get(get_url)
+    if r.status_code != response:
+        return "Failure (%s) on get to %s  " % (r.status_code, get_url)
+    res = r.json()
+    if isinstance(expected, list) and not isinstance(res, list):
+        res = [res]
+    if expected != res:
+        if fail_on_wrong_response:
+            if config.indent:
+                expected_out = json.dumps(expected, indent=1)
+                res_out = json.dumps(res, indent=1)
+            else:
+                expected_out = expected
+                res_out = res
+            return ("Wrong expected value on get to %s. \nExpect:%s\nGot   :%s  "
+                    % (get_url, expected_out, res_out))
+
+        print("===unexpected return at" + get_url + "===")
+        print("expected json: %s" % expected)
+        print("actual: %s" % res)
+        print("=======================")
+        return "Wrong expected value on get to %s" % get_url
+    return None
+
+
+# Run a single file which is made up of multiple requests to the same URL.
+# The requests of one file do not depend on each other, so with an executor they run
+# concurrently; the file still completes before the script moves on to the next one.
+def run_test_file(server, test_file_path, fail_on_wrong_response=True, session=None, executor=None, stats=None):
+    if session is None:
+        session = make_session(1)
+    if stats is None:
+        stats = RunStats()
     with open(test_file_path, 'r') as test_file:
         script = json.load(test_file)
         response = script["response"]
         if "post_path" in script:
-            count = 0
             post_url = "%s%s" % (server, script["post_path"])
-            for v in script["values"]:
-                r = requests.post(post_url, json=v)
-                if r.status_code != response:
-                    if fail_on_wrong_response:
-                        raise LoaderError("Failure (%s) on post to %s with value: %s. Body: %s "
-                                          % (r.status_code, post_url, v, r.json()))
-                else:
-                    count += 1
+            calls = [partial(post_value, session, post_url, v, response) for v in script["values"]]
         elif "get_path" in script:
-            count = 0
             get_urlbase = "%s%s" % (server, script["get_path"])
-            for v in script["tests"]:
-                if "inputs" in v:
-                    inputs = v["inputs"]
-                    get_url = "%s/%s" % (get_urlbase, str(inputs))
-                else:
-                    get_url = get_urlbase
-                # appending parameters into get_url
-                expected = v["expected"]
-
-                r = requests.get(get_url)
-                if r.status_code != response:
-                    if fail_on_wrong_response:
-                        raise LoaderError("Failure (%s) on get to %s  " % (r.status_code, get_url))
-                else:
-                    res = r.json()
-                    if isinstance(expected, list) and not isinstance(res, list):
-                        res = [res]
-                    if expected != res:
-                        if fail_on_wrong_response:
-                            if config.indent:
-                                expected_out = json.dumps(expected, indent=1)
-                                res_out = json.dumps(res, indent=1)
-                            else:
-                                expected_out = expected
-                                res_out = res
-                            raise LoaderError("Wrong expected value on get to %s. \nExpect:%s\nGot   :%s  "
-                                              % (get_url, expected_out, res_out))
-
-                        print("===unexpected return at" + get_url + "===")
-                        print("expected json: %s" % expected)
-                        print("actual: %s" % r.json())
-                        print("=======================")
-                    else:
-                        count += 1
+            calls = [partial(get_test, session, get_urlbase, v, response, fail_on_wrong_response)
+                     for v in script["tests"]]
+        else:
+            calls = []
+
+        if executor is None:
+            results = (call() for call in calls)
+        else:
+            results = executor.map(lambda call: call(), calls)
+
+        count = 0
+        failures = []
+        for failure in results:
+            stats.records += 1
+            if failure is None:
+                count += 1
+                continue
+            stats.errors += 1
+            if fail_on_wrong_response:
+                if executor is None:
+                    raise LoaderError(failure)
+                failures.append(failure)
+        if failures:
+            raise LoaderError("%s (%s failures in %s)" % (failures[0], len(failures), test_file_path))
     return count
 
 
-# Run the script file that contains a list of URLS and file for testing
+# Run the script file that contains a list of URLS and file for testing.
+# Script entries always run in order (e.g. create before loading, loading before reading).
 def run_script(script_file, cfg):
     print("Running script %s" % script_file)
     server = "http://%s:%s/" % (cfg.server, cfg.port)
     script_dir = path.dirname(script_file)
-    with open(script_file, 'r') as file_in:
-        json_script = json.load(file_in)
-        for script in json_script:
-            if "url" in script:
-                get_url = "%s%s" %(server,script["url"])
-                r = requests.get(get_url)
-                if r.status_code != script["response"]:
-                    raise LoaderError("Failure on %s. Expected %s Got %s" % (get_url, script["response"], r.status_code))
+    concurrency = max(cfg.concurrency, 1)
+    session = make_session(concurrency)
+    executor = ThreadPoolExecutor(max_workers=concurrency) if concurrency > 1 else None
+    stats = RunStats()
+    try:
+        with open(script_file, 'r') as file_in:
+            json_script = json.load(file_in)
+            for script in json_script:
+                if "url" in script:
+                    get_url = "%s%s" %(server,script["url"])
+                    r = session.get(get_url)
+                    stats.records += 1
+                    if r.status_code != script["response"]:
+                        stats.errors += 1
+                        raise LoaderError("Failure on %s. Expected %s Got %s" % (get_url, script["response"], r.status_code))
+                    else:
+                        print("Called %s" % get_url)
                 else:
-                    print("Called %s" % get_url)
-            else:
-                count = run_test_file(server, path.join(script_dir, script["file"]))
-                print("Ran file %s Successful %s" % (script["file"], count))
-    print("Done")
+                    count = run_test_file(server, path.join(script_dir, script["file"]),
+                                          session=session, executor=executor, stats=stats)
+                    print("Ran file %s Successful %s" % (script["file"], count))
+        print("Done")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        session.close()
+        stats.report()
 
 
 if __name__ == "__main__":
@@ -128,6 +199,7 @@ if __name__ == "__main__":
     parser.add_argument("-s", "--server", help="Server hostname (default localhost)", default="localhost")
     parser.add_argument("-p", "--port", help="Server port (default 5000)", default=5000, type=int)
     parser.add_argument("-i", "--indent", help="indent compare output (default False)", default=False, action="store_true")
+    parser.add_argument("-n", "--concurrency", help="Parallel requests within each test file (default 1)", default=1, type=int)
 
     config = parser.parse_args()
     try:
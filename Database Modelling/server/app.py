@@ -1,14 +1,28 @@
-from flask import current_app, g, Flask, flash, jsonify, redirect, render_template, request, session, Response
+from flask import current_app, g, Flask, flash, jsonify, redirect, render_template, request, session, Response, stream_with_context
 import logging
 import sqlite3
 import json
-import requests
-from db import DB, KeyNotFound, BadRequest
+from db import DB, KeyNotFound, BadRequest, ConnectionManager, EntityCache, QueryLog, VersionTracker, cache_key, parse_play
+import service
+from service import ServiceError, to_date
+from fastjson import FastJSONProvider
+from metrics import RequestMetrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from playbuffer import PlayBuffer, PlayBufferError
+from writequeue import WriteQueue, WriteQueueError
+import atexit
 import datetime
+import threading
+import time
+from functools import partial
+
+logging.basicConfig(level=logging.DEBUG)
 
 # Configure application
 app = Flask(__name__)
 
+# responses are encoded with orjson when it is installed (same bytes as the default encoder)
+app.json = FastJSONProvider(app)
+
 app.config['JSON_SORT_KEYS'] = False
 
 # Ensure templates are auto-reloaded
@@ -20,6 +34,107 @@ app.secret_key = b'mEw6%7APK'
 # path to database
 DATABASE = 'splatDB.sqlite3'
 
+# versioned schema changes applied on top of schema/create.sql
+MIGRATIONS = 'schema/migrations'
+
+# bring an existing database up to the latest migration when the first connection is made
+# (an empty one is left to /create), so an old database never meets newer SQL
+app.config["AUTO_MIGRATE"] = True
+
+# connection tuning, read once when the first connection is handed out
+app.config["DB_BUSY_TIMEOUT"] = 5000  # ms to wait on a locked database before failing
+app.config["DB_CACHE_SIZE"] = -64000  # page cache per connection (negative = KiB)
+app.config["DB_MMAP_SIZE"] = 268435456  # bytes of the file to memory map
+app.config["DB_SYNCHRONOUS"] = "NORMAL"  # OFF, NORMAL, FULL or EXTRA; NORMAL is durable enough under WAL
+app.config["DB_POOL_SIZE"] = 16  # idle connections kept (per kind) between requests
+
+# entity cache for /songs/<id>, /albums/<id> and /artists/<id> (size 0 disables it)
+app.config["ENTITY_CACHE_SIZE"] = 10000
+app.config["ENTITY_CACHE_TTL"] = 300  # seconds, None to never expire
+
+# NDJSON /stream loads commit every STREAM_CHUNK_ROWS rows or STREAM_CHUNK_MS ms (per request: ?chunk_rows=&chunk_ms=)
+app.config["STREAM_CHUNK_ROWS"] = 5000
+app.config["STREAM_CHUNK_MS"] = 200
+app.config["STREAM_MAX_LINE"] = 1048576  # bytes read per line at most
+
+# list and analytics endpoints with ?stream=json (a JSON array) or ?stream=ndjson send their rows
+# as they are read, STREAM_BATCH_ROWS rows per chunk, instead of building the whole response
+app.config["STREAM_BATCH_ROWS"] = 500
+
+# budget of the /web/query page's ad hoc SQL: rows returned at most, wall clock time and
+# SQLite virtual machine instructions (None = no limit); it runs on a read-only connection
+app.config["QUERY_PAGE_MAX_ROWS"] = 10000
+app.config["QUERY_PAGE_TIMEOUT_MS"] = 5000
+app.config["QUERY_PAGE_MAX_STEPS"] = 200000000
+
+# list endpoints (songs/albums by artist, songs by album, solo_albums) return one page of at most
+# ?limit= items, plus the next_cursor to pass as ?cursor= for the following page; without
+# either parameter they return the whole list
+app.config["PAGE_DEFAULT_LIMIT"] = 100
+app.config["PAGE_MAX_LIMIT"] = 1000
+
+# per statement timings for /debug/queries; statements over QUERY_SLOW_MS also go to the slow log,
+# with their EXPLAIN QUERY PLAN when QUERY_EXPLAIN is set
+app.config["QUERY_LOG"] = True
+app.config["QUERY_SLOW_MS"] = 50
+app.config["QUERY_SLOW_LOG_SIZE"] = 200
+app.config["QUERY_EXPLAIN"] = True
+
+# per route request counts, latency and DB time at /metrics (Prometheus text format)
+app.config["METRICS"] = True
+request_metrics = RequestMetrics()
+
+# every write (POSTs, /create, /migrate) goes through one writer thread (see writequeue.py) that
+# commits up to WRITE_QUEUE_MAX_BATCH waiting requests in one transaction and answers each of them
+# once that commit is done. With DB_SYNCHRONOUS = "FULL" the fsync is then paid per batch.
+app.config["WRITE_QUEUE"] = True
+app.config["WRITE_QUEUE_MAX_BATCH"] = 256
+# ms a request waits for the writer to start its write before it is dropped and answered 503
+app.config["WRITE_QUEUE_TIMEOUT_MS"] = 30000
+
+# write-behind buffer for POST /playcount (see playbuffer.py): events are summed per key in memory
+# and written every PLAY_BUFFER_FLUSH_MS ms or PLAY_BUFFER_MAX_KEYS keys, in one transaction.
+# With PLAY_BUFFER_LOG (a folder) each event is logged (and fsynced with PLAY_BUFFER_FSYNC) before
+# the 201, and replayed on restart after a crash (one server process per folder); without it a
+# crash loses the unflushed events.
+# Playcount analytics flush a date's buffered events before reading it.
+app.config["PLAY_BUFFER"] = False
+app.config["PLAY_BUFFER_FLUSH_MS"] = 200
+app.config["PLAY_BUFFER_MAX_KEYS"] = 10000
+app.config["PLAY_BUFFER_LOG"] = "play_buffer"
+app.config["PLAY_BUFFER_FSYNC"] = True
+
+# weak ETags on the GET endpoints in ETAG_ROUTES, from the version counters of the tables (or the
+# entity) each one reads; a request whose If-None-Match still matches gets a 304 without running
+# any query. ETAG_DATA_VERSION also notices writes made by other processes (PRAGMA data_version).
+app.config["ETAGS"] = True
+app.config["ETAG_DATA_VERSION"] = True
+
+# Cache-Control per url rule (e.g. {"/analytics/solo_albums": "max-age=60"}); the ETAG_ROUTES
+# not in it get CACHE_CONTROL_DEFAULT, and playcount analytics of a date before today get
+# CACHE_CONTROL_PAST_DATES instead (None to treat them like the rest)
+app.config["CACHE_CONTROL"] = {}
+app.config["CACHE_CONTROL_DEFAULT"] = "no-cache"
+app.config["CACHE_CONTROL_PAST_DATES"] = "public, max-age=31536000, immutable"
+
+# url rule -> (tables its responses read, (entity kind, view argument) or None)
+ETAG_ROUTES = {
+    "/songs/<song_id>": ((), ("song", "song_id")),
+    "/albums/<album_id>": ((), ("album", "album_id")),
+    "/artists/<artist_id>": ((), ("artist", "artist_id")),
+    "/songs/by_album/<album_id>": (("album", "song"), None),
+    "/songs/by_artist/<artist_id>": (("artist", "song"), None),
+    "/albums/by_artist/<artist_id>": (("artist", "album"), None),
+    "/analytics/artists/avg_song_length/<artist_id>": (("artist", "song"), None),
+    "/analytics/artists/cnt_singles/<artist_id>": (("artist", "song", "album"), None),
+    "/analytics/artists/top_length/<num_artists>": (("artist", "song"), None),
+    "/analytics/solo_albums": (("album", "song"), None),
+    "/analytics/playcount/top_song/<date_string>": (("play",), None),
+    "/analytics/playcount/top_source/<song_id>/<date_string>": (("play",), None),
+    "/analytics/playcount/top_source_all/<date_string>": (("play",), None),
+    "/analytics/playcount/top_country/<date_string>": (("play", "song", "artist"), None),
+}
+
 
 # default path
 @app.route('/')
@@ -48,8 +163,41 @@ def create_tables():
     """
     Drops existing tables and creates new tables
     """
-    db = DB(get_db_conn())
-    return db.create_db('schema/create.sql')
+    return write(recreate_tables, alone=True)
+
+
+# drops and creates all tables, then brings them to the latest migration
+def recreate_tables(db):
+    # buffered plays were acknowledged before the drop, so they go with it
+    play_buffer = get_play_buffer()
+    if play_buffer is not None:
+        play_buffer.flush()
+    res = db.create_db('schema/create.sql')
+    db.migrate(MIGRATIONS)
+    return res
+
+
+@app.route('/migrate', methods=["GET"])
+def migrate_tables():
+    """
+    Upgrades the existing tables in place (keeps the data) by running
+    any migrations the database has not had yet
+    """
+    try:
+        res = write(DB.migrate, MIGRATIONS, alone=True)
+    except sqlite3.Error as e:
+        print(e)
+        raise InvalidUsage(str(e))
+    return jsonify(res)
+
+
+@app.cli.command("migrate")
+def migrate_command():
+    """
+    Same as /migrate, from the command line: flask --app app migrate
+    """
+    db = get_db()
+    print(db.migrate(MIGRATIONS))
 
 
 @app.route('/artist', methods=["POST"])
@@ -63,11 +211,8 @@ def add_artist():
         logging.error("No post body")
         return Response(status=400)
 
-    # get DB class with new connection
-    db = DB(get_db_conn())
-
     try:
-        db.add_artist(post_body)
+        write(DB.add_artist, post_body)
     except BadRequest as e:
         raise InvalidUsage(e.message, status_code=e.error_code)
     except sqlite3.Error as e:
@@ -86,11 +231,8 @@ def add_album():
         logging.error("No post body")
         return Response(status=400)
 
-    # get DB class with new connection
-    db = DB(get_db_conn())
-
     try:
-        db.add_album(post_body)
+        write(DB.add_album, post_body)
     except BadRequest as e:
         raise InvalidUsage(e.message, status_code=e.error_code)
     except sqlite3.Error as e:
@@ -110,11 +252,8 @@ def add_song():
         logging.error("No post body")
         return Response(status=400)
 
-    # get DB class with new connection
-    db = DB(get_db_conn())
-
     try:
-        db.add_song_ms2(post_body)
+        write(DB.add_song_ms2, post_body)
     except BadRequest as e:
         raise InvalidUsage(e.message, status_code=e.error_code)
     except sqlite3.Error as e:
@@ -133,11 +272,8 @@ def add_playlist():
         logging.error("No post body")
         return Response(status=400)
 
-    # get DB class with new connection
-    db = DB(get_db_conn())
-
     try:
-        db.add_playlist(post_body)
+        write(DB.add_playlist, post_body)
     except BadRequest as e:
         raise InvalidUsage(e.message, status_code=e.error_code)
     except sqlite3.Error as e:
@@ -159,11 +295,12 @@ def add_play():
         logging.error("No post body")
         return Response(status=400)
 
-    # get DB class with new connection
-    db = DB(get_db_conn())
-
     try:
-        db.add_play(post_body)
+        play_buffer = get_play_buffer()
+        if play_buffer is not None:
+            play_buffer.add(parse_play(post_body))
+        else:
+            write(DB.add_play, post_body)
     except BadRequest as e:
         raise InvalidUsage(e.message, status_code=e.error_code)
     except sqlite3.Error as e:
@@ -172,14 +309,195 @@ def add_play():
     return Response(status=201)
 
 
+# -----------------
+# Bulk Create Endpoints
+# Same bodies as the endpoints above but a JSON list of them. The whole list is
+# validated and written in one transaction; items that fail validation are skipped
+# and reported back as {"index", "message"} under "failed".
+# -------------------
+
+# 201 with the summary if anything was written, 400 if every item failed
+def bulk_response(res):
+    response = jsonify(res)
+    response.status_code = 201 if res["inserted"] or not res["failed"] else 400
+    return response
+
+
+@app.route('/artist/bulk', methods=["POST"])
+def add_artists_bulk():
+    """
+    Loads a list of artists in a single transaction
+    """
+    post_body = request.json
+    if not post_body:
+        logging.error("No post body")
+        return Response(status=400)
+
+    try:
+        res = write(DB.add_artists_bulk, post_body)
+    except BadRequest as e:
+        raise InvalidUsage(e.message, status_code=e.error_code)
+    except sqlite3.Error as e:
+        print(e)
+        raise InvalidUsage(str(e))
+    return bulk_response(res)
+
+
+@app.route('/album/bulk', methods=["POST"])
+def add_albums_bulk():
+    """
+    Loads a list of albums (with their artists and tracklists) in a single transaction
+    """
+    post_body = request.json
+    if not post_body:
+        logging.error("No post body")
+        return Response(status=400)
+
+    try:
+        res = write(DB.add_albums_bulk, post_body)
+    except BadRequest as e:
+        raise InvalidUsage(e.message, status_code=e.error_code)
+    except sqlite3.Error as e:
+        print(e)
+        raise InvalidUsage(str(e))
+    return bulk_response(res)
+
+
+@app.route('/songs/bulk', methods=["POST"])
+def add_songs_bulk():
+    """
+    Loads a list of songs (with their artists) in a single transaction
+    """
+    post_body = request.json
+    if not post_body:
+        logging.error("No post body")
+        return Response(status=400)
+
+    try:
+        res = write(DB.add_songs_bulk, post_body)
+    except BadRequest as e:
+        raise InvalidUsage(e.message, status_code=e.error_code)
+    except sqlite3.Error as e:
+        print(e)
+        raise InvalidUsage(str(e))
+    return bulk_response(res)
+
+
+@app.route('/playlists/bulk', methods=["POST"])
+def add_playlists_bulk():
+    """
+    Loads a list of playlists, each with a list of ordered songs in a single transaction
+    """
+    post_body = request.json
+    if not post_body:
+        logging.error("No post body")
+        return Response(status=400)
+
+    try:
+        res = write(DB.add_playlists_bulk, post_body)
+    except BadRequest as e:
+        raise InvalidUsage(e.message, status_code=e.error_code)
+    except sqlite3.Error as e:
+        print(e)
+        raise InvalidUsage(str(e))
+    return bulk_response(res)
+
+
+@app.route('/playcount/bulk', methods=["POST"])
+def add_plays_bulk():
+    """
+    Adds a list of play count details, same format as /playcount in a single transaction
+    """
+    post_body = request.json
+    if not post_body:
+        logging.error("No post body")
+        return Response(status=400)
+
+    try:
+        res = write(DB.add_plays_bulk, post_body)
+    except BadRequest as e:
+        raise InvalidUsage(e.message, status_code=e.error_code)
+    except sqlite3.Error as e:
+        print(e)
+        raise InvalidUsage(str(e))
+    return bulk_response(res)
+
+
+# -----------------
+# Streaming Create Endpoints
+# Newline delimited JSON bodies (one object per line, same format as the single
+# endpoints) read incrementally and committed in chunks; answers with a summary.
+# -------------------
+
+# Runs a DB.add_*_stream function over the request body, one line at a time
+def load_stream(add_stream):
+    try:
+        chunk_rows = int(request.args.get("chunk_rows", app.config["STREAM_CHUNK_ROWS"]))
+        chunk_ms = int(request.args.get("chunk_ms", app.config["STREAM_CHUNK_MS"]))
+    except ValueError:
+        raise InvalidUsage("chunk_rows and chunk_ms must be integers")
+    if chunk_rows < 1 or chunk_ms < 0:
+        raise InvalidUsage("chunk_rows must be positive and chunk_ms not negative")
+
+    lines = iter(partial(request.stream.readline, app.config["STREAM_MAX_LINE"]), b"")
+    # the body is read here; with the write queue only the chunks go to the writer thread
+    write_queue = get_write_queue()
+    submit = write_queue.submit if write_queue is not None else None
+    res = add_stream(get_db(), lines, chunk_rows, chunk_ms, submit)
+
+    response = jsonify(res)
+    response.status_code = 400 if "error" in res else 201
+    return response
+
+
+@app.route('/artist/stream', methods=["POST"])
+def add_artists_stream():
+    """
+    Loads artists from a newline delimited JSON body, committing in chunks
+    """
+    return load_stream(DB.add_artists_stream)
+
+
+@app.route('/album/stream', methods=["POST"])
+def add_albums_stream():
+    """
+    Loads albums from a newline delimited JSON body, committing in chunks
+    """
+    return load_stream(DB.add_albums_stream)
+
+
+@app.route('/songs/stream', methods=["POST"])
+def add_songs_stream():
+    """
+    Loads songs from a newline delimited JSON body, committing in chunks
+    """
+    return load_stream(DB.add_songs_stream)
+
+
+@app.route('/playlists/stream', methods=["POST"])
+def add_playlists_stream():
+    """
+    Loads playlists from a newline delimited JSON body, committing in chunks
+    """
+    return load_stream(DB.add_playlists_stream)
+
+
+@app.route('/playcount/stream', methods=["POST"])
+def add_plays_stream():
+    """
+    Adds play count details from a newline delimited JSON body, committing in chunks
+    """
+    return load_stream(DB.add_plays_stream)
+
+
 @app.route('/songs/<song_id>', methods=["GET"])
 def find_song(song_id):
     """
     Returns a song's info
     (song_id, name, length, artist name, album name) based on song_id
     """
-    # get DB class with new connection
-    db = DB(get_db_conn())
+    # get DB class with this thread's reader connection
+    db = get_read_db()
 
     try:
         res = db.find_song(song_id)
@@ -193,21 +511,99 @@ def find_song(song_id):
     return Response(status=400)
 
 
+STREAM_FORMATS = {"json": "application/json", "ndjson": "application/x-ndjson"}
+
+
+# the ?stream= format of a streamable endpoint, or None to answer in one piece
+def stream_format():
+    fmt = request.args.get("stream")
+    if fmt is not None and fmt not in STREAM_FORMATS:
+        raise InvalidUsage("stream must be one of %s" % ", ".join(STREAM_FORMATS), status_code=400)
+    return fmt
+
+
+# sends rows (any iterable of JSON values) as a JSON array or NDJSON while they are produced;
+# the opening bytes go out before the first row is read. With a summary (called once the rows
+# are done) the JSON is {"rows": [...], "summary": {...}} and NDJSON ends with a {"summary": ...} line
+def stream_response(rows, fmt, summary=None):
+    batch = app.config["STREAM_BATCH_ROWS"]
+
+    def generate():
+        chunk = []
+        if fmt == "json":
+            yield "[" if summary is None else "{\"rows\":["
+            separator = ""
+            for row in rows:
+                chunk.append(separator + app.json.dumps(row, separators=(",", ":")))
+                separator = ","
+                if len(chunk) >= batch:
+                    yield "".join(chunk)
+                    chunk = []
+            if summary is None:
+                chunk.append("]\n")
+            else:
+                chunk.append("],\"summary\":%s}\n" % app.json.dumps(summary(), separators=(",", ":")))
+        else:
+            for row in rows:
+                chunk.append(app.json.dumps(row, separators=(",", ":")) + "\n")
+                if len(chunk) >= batch:
+                    yield "".join(chunk)
+                    chunk = []
+            if summary is not None:
+                chunk.append(app.json.dumps({"summary": summary()}, separators=(",", ":")) + "\n")
+        yield "".join(chunk)
+
+    return Response(stream_with_context(generate()), mimetype=STREAM_FORMATS[fmt])
+
+
+# with ?stream= set, streams every item of a paged list method (from ?cursor= on); None otherwise
+def stream_pages(db, method, *args):
+    fmt = stream_format()
+    if fmt is None:
+        return None
+    rows = db.iter_pages(method, *args, cursor=request.args.get("cursor"), page_size=app.config["PAGE_MAX_LIMIT"])
+    return stream_response(rows, fmt)
+
+
+# reads the ?limit= and ?cursor= of a list endpoint; (None, None) when it should return everything
+def page_args():
+    limit = request.args.get("limit")
+    cursor = request.args.get("cursor")
+    if limit is None and cursor is None:
+        return None, None
+    if limit is None:
+        limit = app.config["PAGE_DEFAULT_LIMIT"]
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise InvalidUsage("limit must be an integer", status_code=400)
+    if limit < 1:
+        raise InvalidUsage("limit must be at least 1", status_code=400)
+    return min(limit, app.config["PAGE_MAX_LIMIT"]), cursor
+
+
 @app.route('/songs/by_album/<album_id>', methods=["GET"])
 def find_songs_by_album(album_id):
     """
     Returns all an album's songs
     (song_id, name, length, artist name, album name) based on album_id
+    With ?limit= (and ?cursor=) returns one page: {"items": [...], "next_cursor": ...}
+    With ?stream=json or ?stream=ndjson sends every item as it is read
     """
-    # get DB class with new connection
-    db = DB(get_db_conn())
+    # get DB class with this thread's reader connection
+    db = get_read_db()
     
     try:
-        res = db.find_songs_by_album(album_id)
+        streamed = stream_pages(db, db.find_songs_by_album, album_id)
+        if streamed is not None:
+            return streamed
+        res = db.find_songs_by_album(album_id, *page_args())
         return jsonify(res)
     except KeyNotFound as e:
         print(e)
         raise InvalidUsage(e.message, status_code=404)
+    except BadRequest as e:
+        raise InvalidUsage(e.message, status_code=e.error_code)
     except sqlite3.Error as e:
         print(e)
         raise InvalidUsage(str(e))
@@ -219,16 +615,23 @@ def find_songs_by_artist(artist_id):
     """
     Returns all an artists' songs
     (song_id, name, length, artist name, album name) based on artist_id
+    With ?limit= (and ?cursor=) returns one page: {"items": [...], "next_cursor": ...}
+    With ?stream=json or ?stream=ndjson sends every item as it is read
     """
-    # get DB class with new connection
-    db = DB(get_db_conn())
+    # get DB class with this thread's reader connection
+    db = get_read_db()
 
     try:
-        res = db.find_songs_by_artist(artist_id)
+        streamed = stream_pages(db, db.find_songs_by_artist, artist_id)
+        if streamed is not None:
+            return streamed
+        res = db.find_songs_by_artist(artist_id, *page_args())
         return jsonify(res)
     except KeyNotFound as e:
         print(e)
         raise InvalidUsage(e.message, status_code=404)
+    except BadRequest as e:
+        raise InvalidUsage(e.message, status_code=e.error_code)
     except sqlite3.Error as e:
         print(e)
         raise InvalidUsage(str(e))
@@ -241,8 +644,8 @@ def find_album(album_id):
     Returns a album's info
     (album_id, album_name, release_year). 
     """
-    # get DB class with new connection
-    db = DB(get_db_conn())
+    # get DB class with this thread's reader connection
+    db = get_read_db()
 
     try:
         res = db.find_album(album_id)
@@ -261,16 +664,23 @@ def find_album_by_artist(artist_id):
     """
     Returns a album's info
     (album_id, album_name, release_year). 
+    With ?limit= (and ?cursor=) returns one page: {"items": [...], "next_cursor": ...}
+    With ?stream=json or ?stream=ndjson sends every item as it is read
     """
-    # get DB class with new connection
-    db = DB(get_db_conn())
+    # get DB class with this thread's reader connection
+    db = get_read_db()
 
     try:
-        res = db.find_album_by_artist(artist_id)
+        streamed = stream_pages(db, db.find_album_by_artist, artist_id)
+        if streamed is not None:
+            return streamed
+        res = db.find_album_by_artist(artist_id, *page_args())
         return jsonify(res)
     except KeyNotFound as e:
         print(e)
         raise InvalidUsage(e.message, status_code=404)
+    except BadRequest as e:
+        raise InvalidUsage(e.message, status_code=e.error_code)
     except sqlite3.Error as e:
         print(e)
         raise InvalidUsage(str(e))
@@ -283,8 +693,8 @@ def find_artist(artist_id):
     Returns a artist's info
     (artist_id, artist_name, country). 
     """
-    # get DB class with new connection
-    db = DB(get_db_conn())
+    # get DB class with this thread's reader connection
+    db = get_read_db()
 
     try:
         res = db.find_artist(artist_id)
@@ -308,8 +718,8 @@ def avg_song_length(artist_id):
     """
     Returns the average length of an artist's songs (artist_id, avg_length)
     """
-    # get DB class with new connection
-    db = DB(get_db_conn())
+    # get DB class with this thread's reader connection
+    db = get_read_db()
 
     try:
         res = db.avg_song_length(artist_id)
@@ -328,8 +738,8 @@ def cnt_singles(artist_id):
     """
     Returns the number of singles an artist has (artist_id, cnt_single)
     """
-    # get DB class with new connection
-    db = DB(get_db_conn())
+    # get DB class with this thread's reader connection
+    db = get_read_db()
 
     try:
         res = db.cnt_singles(artist_id)
@@ -348,11 +758,15 @@ def top_length(num_artists):
     """
     Returns top (n=num_artists) artists based on total length of songs
     (artist_id, total_length). 
+    With ?stream=json or ?stream=ndjson sends every item as it is read
     """
-    # get DB class with new connection
-    db = DB(get_db_conn())
+    # get DB class with this thread's reader connection
+    db = get_read_db()
     
     try:
+        fmt = stream_format()
+        if fmt is not None:
+            return stream_response(db.top_length(num_artists, stream=True), fmt)
         res = db.top_length(num_artists)
         return jsonify(res)
     except KeyNotFound as e:
@@ -369,40 +783,37 @@ def solo_albums():
     """
     Returns an array/list of album_ids where the album 
     and all songs are by the same single artist_id
+    With ?limit= (and ?cursor=) returns one page: {"items": [...], "next_cursor": ...}
+    With ?stream=json or ?stream=ndjson sends every item as it is read
     """
-    # get DB class with new connection
-    db = DB(get_db_conn())
+    # get DB class with this thread's reader connection
+    db = get_read_db()
     try:
-        res = db.solo_albums()
+        streamed = stream_pages(db, db.solo_albums)
+        if streamed is not None:
+            return streamed
+        res = db.solo_albums(*page_args())
         return jsonify(res)
-    except BadRequest as e:
+    except KeyNotFound as e:
         print(e)
         raise InvalidUsage(e.message, status_code=404)
+    except BadRequest as e:
+        print(e)
+        raise InvalidUsage(e.message, status_code=e.error_code)
     except sqlite3.Error as e:
         print(e)
         raise InvalidUsage(str(e))
     return Response(status=400)
 
 
-# Convert a YYYY-MM-DD string to a datetime.date. Raises BadRequest if not in the right format
-# or if not a valid date.
-# From https://stackoverflow.com/questions/53460391/passing-a-date-as-a-url-parameter-to-a-flask-route
-# Better function exists in 3.7+ adding this to support 3.6+
-def to_date(date_string):
-    try:
-        return datetime.datetime.strptime(date_string, "%Y-%m-%d").date()
-    except ValueError:
-        raise BadRequest('{} is not valid date in the format YYYY-MM-DD'.format(date_string))
-
-
 @app.route('/analytics/playcount/top_song/<date_string>', methods=["GET"])
 def top_song(date_string):
     """
     Get the top song played on a given date
     The test data does not account for ties/ have ties. if you want to break them use song_id ascending.
     """
-    # get DB class with new connection
-    db = DB(get_db_conn())
+    # get DB class with this thread's reader connection
+    db = get_read_db()
     try:
         check_date = to_date(date_string)
         res = db.top_song(check_date)
@@ -426,8 +837,8 @@ def top_source(song_id, date_string):
     The test data does not account for ties.
     If you want to want to account for ties, give all sources that have the same (top) play_count
     """
-    # get DB class with new connection
-    db = DB(get_db_conn())
+    # get DB class with this thread's reader connection
+    db = get_read_db()
     try:
         check_date = to_date(date_string)
         res = db.top_source(song_id, check_date)
@@ -443,14 +854,41 @@ def top_source(song_id, date_string):
     return Response(status=400)
 
 
+@app.route('/analytics/playcount/top_source_all/<date_string>', methods=["GET"])
+def top_source_all(date_string):
+    """
+    For a given date, return the top source of every song played that day
+    (what top_source gives for each song) in one call
+    With ?stream=json or ?stream=ndjson sends every item as it is read
+    """
+    # get DB class with this thread's reader connection
+    db = get_read_db()
+    try:
+        check_date = to_date(date_string)
+        fmt = stream_format()
+        if fmt is not None:
+            return stream_response(db.top_source_all(check_date, stream=True), fmt)
+        res = db.top_source_all(check_date)
+        return jsonify(res)
+    except BadRequest as e:
+        raise InvalidUsage(e.message, status_code=400)
+    except KeyNotFound as e:
+        print(e)
+        raise InvalidUsage(e.message, status_code=404)
+    except sqlite3.Error as e:
+        print(e)
+        raise InvalidUsage(str(e))
+    return Response(status=400)
+
+
 @app.route('/analytics/playcount/top_country/<date_string>', methods=["GET"])
 def top_country(date_string):
     """
     This is an extra credit MS that for a given date , it gives the country
     with the most play
     """
-    # get DB class with new connection
-    db = DB(get_db_conn())
+    # get DB class with this thread's reader connection
+    db = get_read_db()
     try:
         check_date = to_date(date_string)
         res = db.top_country(check_date)
@@ -466,6 +904,45 @@ def top_country(date_string):
     return Response(status=400)
 
 
+# -----------------
+# Debug Endpoints
+# -------------------
+
+@app.route('/debug/cache', methods=["GET"])
+def cache_stats():
+    """
+    Returns the entity cache's size and hit/miss/eviction/invalidation counters
+    """
+    return jsonify(get_entity_cache().stats())
+
+
+@app.route('/metrics', methods=["GET"])
+def metrics():
+    """
+    Returns the request metrics in the Prometheus text exposition format
+    """
+    return Response(request_metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+
+@app.route('/debug/queries', methods=["GET", "DELETE"])
+def query_stats():
+    """
+    Returns the per statement timings (slowest total first, ?limit= of them) and the slow
+    query log with its captured query plans. DELETE clears them.
+    """
+    query_log = get_connections().query_log
+    if query_log is None:
+        raise InvalidUsage("Query log is off (QUERY_LOG)", status_code=404)
+    if request.method == "DELETE":
+        query_log.reset()
+        return jsonify({"message": "reset"})
+    try:
+        limit = int(request.args.get("limit", 50))
+    except ValueError:
+        raise InvalidUsage("limit must be an integer", status_code=400)
+    return jsonify(query_log.stats(limit))
+
+
 # -----------------
 # Web APIs
 # These simply wrap requests from the website/browser and
@@ -484,18 +961,31 @@ def query():
         qry = request.form.get("query")
         # Ensure query was submitted
 
-        # get DB class with new connection
-        db = DB(get_db_conn())
-
         # note DO NOT EVER DO THIS NORMALLY (run SQL from a client/web directly)
         # https://xkcd.com/327/
+        # it runs read-only, within a time/instruction budget and a row cap
+        budget = {"max_rows": app.config["QUERY_PAGE_MAX_ROWS"],
+                  "timeout_ms": app.config["QUERY_PAGE_TIMEOUT_MS"],
+                  "max_steps": app.config["QUERY_PAGE_MAX_STEPS"]}
         try:
-            res = db.run_query(str(qry))
-        except sqlite3.Error as e:
+            # get DB class with this thread's read-only connection, so the query can not write
+            # (opening it fails like the query would, e.g. on a missing database file)
+            db = get_query_db()
+            # json/ndjson output streams the rows instead of rendering a table
+            fmt = request.form.get("output", "table")
+            if fmt in STREAM_FORMATS:
+                bounded = db.run_query(str(qry), stream=True, **budget)
+                return stream_response(bounded, fmt, summary=bounded.summary)
+            res = db.run_query(str(qry), **budget)
+        except BadRequest as e:
+            return render_template("error.html", errmsg=e.message, errcode=e.error_code)
+        except (sqlite3.Error, sqlite3.Warning) as e:
             print(e)
             return render_template("error.html", errmsg=str(e), errcode=400)
 
-        data = res
+        data = res["rows"]
+        if res["truncated"]:
+            flash("Showing the first %d rows only" % res["row_count"])
     return render_template("query.html", data=data)
 
 # paste in a query
@@ -512,38 +1002,48 @@ def post_song_web():
             flash("Must set key")
             return render_template("post_data.html", data=data)
 
-        get_url = "http://127.0.0.1:5000/%s" % parameter
-        print("Making request to %s" % get_url)
-        # grab the response
+        print("Posting to %s" % parameter)
 
         j = json.loads(request.form.get("json_data").strip())
         print("Json from form: %s" % j)
-        r = requests.post(get_url, json=j)
-        if r.status_code >= 400:
-            print("Error.  %s  Body: %s" % (r, r.content))
-            return render_template("error.html", errmsg=r.json(), errcode=r.status_code)
-
-        else:
-            flash("Ran post command")
+        try:
+            play_buffer = get_play_buffer()
+            if parameter == "playcount" and play_buffer is not None:
+                # write-behind (and logged) like POST /playcount
+                service.buffer_play(play_buffer, j)
+            else:
+                write(service.post, parameter, j)
+        except ServiceError as e:
+            print("Error.  %s  Body: %s" % (e.status_code, e.message))
+            return render_template("error.html", errmsg=e.to_dict(), errcode=e.status_code)
+
+        flash("Ran post command")
         return render_template("post_data.html", data=None)
     return render_template("post_data.html", data=None)
 
 @app.route('/web/create', methods=["GET"])
 def create_web():
-    get_url = "http://127.0.0.1:5000/create"
-    print("Making request to %s" % get_url)
-    # grab the response
-    r = requests.get(get_url)
-    if r.status_code >= 400:
-        print("Error.  %s  Body: %s" % (r, r.content))
-        return render_template("error.html", errmsg=r.json(), errcode=r.status_code)
-
-    else:
-        flash("Ran create command")
-        data = r.json()
+    try:
+        data = json.loads(write(recreate_tables, alone=True))
+    except sqlite3.Error as e:
+        print(e)
+        return render_template("error.html", errmsg={"message": str(e)}, errcode=400)
+
+    flash("Ran create command")
     return render_template("home.html", data=data)
 
 
+# runs a GET lookup for one of the pages below, rendering template with its result (or the error page)
+def render_lookup(template, db, path, *parameters):
+    print("Looking up %s %s" % (path, "/".join(parameters)))
+    try:
+        data = service.lookup(db, path, *parameters, play_buffer=get_play_buffer())
+    except ServiceError as e:
+        print("Error.  %s  Body: %s" % (e.status_code, e.message))
+        return render_template("error.html", errmsg=e.to_dict(), errcode=e.status_code)
+    return render_template(template, data=data)
+
+
 @app.route('/web/songs', methods=["GET", "POST"])
 def song_landing():
     data = None
@@ -555,16 +1055,7 @@ def song_landing():
             flash("Must set key")
             return render_template("songs.html", data=data)
 
-        get_url = "http://127.0.0.1:5000/songs/" + path + parameter
-        print("Making request to %s" % get_url)
-        # grab the response
-        r = requests.get(get_url)
-        if r.status_code >= 400:
-            print("Error.  %s  Body: %s" % (r, r.content))
-            return render_template("error.html", errmsg=r.json(), errcode=r.status_code)
-
-        else:
-            data = r.json()
+        return render_lookup("songs.html", get_read_db(), "songs/" + path, parameter)
     return render_template("songs.html", data=data)
 
 
@@ -580,15 +1071,7 @@ def artists_landing():
             flash("Must set key")
             return render_template("artists.html", data=data)
 
-        get_url = "http://127.0.0.1:5000/artists/" + path + parameter
-        # grab the response
-        r = requests.get(get_url)
-        if r.status_code >= 400:
-            print("Error.  %s  Body: %s" % (r, r.content))
-            return render_template("error.html", errmsg=r.json(), errcode=r.status_code)
-
-        else:
-            data = r.json()
+        return render_lookup("artists.html", get_read_db(), "artists/" + path, parameter)
     return render_template("artists.html", data=data)
 
 
@@ -604,14 +1087,7 @@ def albums_landing():
             flash("Must set key")
             return render_template("albums.html", data=data)
 
-        get_url = "http://127.0.0.1:5000/albums/" + path + parameter
-        # grab the response
-        r = requests.get(get_url)
-        if r.status_code >= 400:
-            print("Error.  %s  Body: %s" % (r, r.content))
-            return render_template("error.html", errmsg=r.json(), errcode=r.status_code)
-        else:
-            data = r.json()
+        return render_lookup("albums.html", get_read_db(), "albums/" + path, parameter)
     return render_template("albums.html", data=data)
 
 
@@ -623,14 +1099,14 @@ def analytics_landing():
         # Ensure path was submitted
 
         if path == "solo_albums":
-            get_url = "http://127.0.0.1:5000/analytics/" + path
-        elif path == "playcount/top_song/" or path == "playcount/top_country/":
+            parameters = []
+        elif path == "playcount/top_song/" or path == "playcount/top_country/" or path == "playcount/top_source_all/":
             date = request.form.get("date")
             if date is None or date.strip() == "":
                 flash("Must set key")
                 return render_template("analytics.html", data=data)
 
-            get_url = "http://127.0.0.1:5000/analytics/" + path + date
+            parameters = [date]
         elif path == "playcount/top_source/":
             parameter = request.form.get("parameter")
             if parameter is None or parameter.strip() == "":
@@ -640,24 +1116,16 @@ def analytics_landing():
             if parameter2 is None or parameter2.strip() == "":
                 flash("Must set key")
                 return render_template("analytics.html", data=data)
-            get_url = "http://127.0.0.1:5000/analytics/" + path + parameter + '/' + parameter2
+            parameters = [parameter, parameter2]
         else:
             parameter = request.form.get("parameter")
             if parameter is None or parameter.strip() == "":
                 flash("Must set key")
                 return render_template("analytics.html", data=data)
 
-            get_url = "http://127.0.0.1:5000/analytics/" + path + parameter
+            parameters = [parameter]
 
-        # grab the response
-        print(get_url)
-        r = requests.get(get_url)
-        if r.status_code >= 400:
-            print("Error.  %s  Body: %s" % (r, r.content))
-            return render_template("error.html", errmsg=r.json(), errcode=r.status_code)
-
-        else:
-            data = r.json()
+        return render_lookup("analytics.html", get_read_db(), "analytics/" + path, *parameters)
     return render_template("analytics.html", data=data)
 
 
@@ -665,13 +1133,156 @@ def analytics_landing():
 # Utilities / Errors
 # -------------------
 
-# gets connection to database
+_connections = None
+_connections_lock = threading.Lock()
+
+
+# gets the process wide connection manager, built from app.config on first use
+def get_connections():
+    global _connections
+    if _connections is None:
+        with _connections_lock:
+            if _connections is None:
+                if app.config["AUTO_MIGRATE"]:
+                    migrate_existing(DATABASE)
+                query_log = None
+                if app.config["QUERY_LOG"]:
+                    query_log = QueryLog(slow_ms=app.config["QUERY_SLOW_MS"],
+                                         slow_log_size=app.config["QUERY_SLOW_LOG_SIZE"],
+                                         explain=app.config["QUERY_EXPLAIN"])
+                _connections = ConnectionManager(DATABASE,
+                                                 busy_timeout=app.config["DB_BUSY_TIMEOUT"],
+                                                 cache_size=app.config["DB_CACHE_SIZE"],
+                                                 mmap_size=app.config["DB_MMAP_SIZE"],
+                                                 synchronous=app.config["DB_SYNCHRONOUS"],
+                                                 query_log=query_log,
+                                                 pool_size=app.config["DB_POOL_SIZE"])
+    return _connections
+
+
+# Runs the migrations an existing database has not had yet, on a connection of its own
+def migrate_existing(database):
+    # another worker may be migrating it; wait for it like any other write
+    conn = sqlite3.connect(database, timeout=app.config["DB_BUSY_TIMEOUT"] / 1000.0)
+    try:
+        if conn.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'play'").fetchone()[0]:
+            res = DB(conn).migrate(MIGRATIONS)
+            if res["applied"]:
+                logging.info("Migrated %s to version %d: %s", database, res["version"], ", ".join(res["applied"]))
+    finally:
+        conn.close()
+
+
+_entity_cache = None
+
+
+# gets the process wide entity cache, built from app.config on first use
+def get_entity_cache():
+    global _entity_cache
+    if _entity_cache is None:
+        with _connections_lock:
+            if _entity_cache is None:
+                _entity_cache = EntityCache(max_size=app.config["ENTITY_CACHE_SIZE"],
+                                            ttl=app.config["ENTITY_CACHE_TTL"])
+    return _entity_cache
+
+
+_versions = None
+
+
+# gets the process wide version counters behind the ETags, built from app.config on first use
+def get_versions():
+    global _versions
+    if _versions is None:
+        cache = get_entity_cache()
+        with _connections_lock:
+            if _versions is None:
+                connect = None
+                if app.config["ETAG_DATA_VERSION"]:
+                    connect = partial(sqlite3.connect, DATABASE, check_same_thread=False)
+                _versions = VersionTracker(connect, cache)
+    return _versions
+
+
+_play_buffer = None
+_play_buffer_lock = threading.Lock()
+
+
+# gets the process wide play buffer, started (after replaying its log) on first use;
+# None unless PLAY_BUFFER is set
+def get_play_buffer():
+    global _play_buffer
+    if not app.config["PLAY_BUFFER"]:
+        return None
+    if _play_buffer is None:
+        # not under _connections_lock, which get_db takes while the log is replayed
+        with _play_buffer_lock:
+            if _play_buffer is None:
+                play_buffer = PlayBuffer(get_db, flush_ms=app.config["PLAY_BUFFER_FLUSH_MS"],
+                                         max_keys=app.config["PLAY_BUFFER_MAX_KEYS"],
+                                         log_dir=app.config["PLAY_BUFFER_LOG"],
+                                         fsync=app.config["PLAY_BUFFER_FSYNC"])
+                play_buffer.start()
+                atexit.register(play_buffer.close)
+                _play_buffer = play_buffer
+    return _play_buffer
+
+
+_write_queue = None
+
+
+# gets the process wide write queue, started on first use; None unless WRITE_QUEUE is set
+def get_write_queue():
+    global _write_queue
+    if not app.config["WRITE_QUEUE"]:
+        return None
+    if _write_queue is None:
+        # outside _connections_lock, which get_connections takes
+        query_log = get_connections().query_log
+        with _connections_lock:
+            if _write_queue is None:
+                write_queue = WriteQueue(get_db, max_batch=app.config["WRITE_QUEUE_MAX_BATCH"],
+                                         timeout_ms=app.config["WRITE_QUEUE_TIMEOUT_MS"],
+                                         query_log=query_log)
+                write_queue.start()
+                atexit.register(write_queue.close)
+                _write_queue = write_queue
+    return _write_queue
+
+
+# Runs method(db, *args) (e.g. DB.add_artist) on the writer thread once the write queue is on,
+# returning after its batch commits; else on this thread's writer connection.
+# alone is for writes that commit by themselves (executescript), run outside any batch.
+def write(method, *args, alone=False):
+    write_queue = get_write_queue()
+    if write_queue is None:
+        return method(get_db(), *args)
+    return write_queue.submit(lambda db: method(db, *args), alone=alone)
+
+
+# gets DB class on this thread's writer connection
+def get_db():
+    return DB(get_db_conn(), get_entity_cache(), get_versions())
+
+
+# gets DB class on this thread's reader connection
+def get_read_db():
+    return DB(get_db_reader_conn(), get_entity_cache(), get_versions())
+
+
+# gets DB class on this thread's read-only connection (for ad hoc SQL), without the entity cache
+def get_query_db():
+    return DB(get_connections().read_only())
+
+
+# gets this thread's (long-lived) connection to database, used for writes
 def get_db_conn():
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
+    return get_connections().writer()
 
-    return db
+
+# gets this thread's (long-lived) read connection, so reads don't queue behind the writer
+def get_db_reader_conn():
+    return get_connections().reader()
 
 
 # Error Class for managing Errors
@@ -697,12 +1308,111 @@ def handle_invalid_usage(error):
     response.status_code = error.status_code
     return response
 
-# called on close of response; closes db connection
+
+# the play buffer could not start (its log folder is locked by another process), or the write
+# queue could not take a write (its thread stopped, or it is too far behind)
+@app.errorhandler(PlayBufferError)
+@app.errorhandler(WriteQueueError)
+def handle_unavailable(error):
+    logging.error(error.message)
+    response = jsonify({"message": error.message})
+    response.status_code = 503
+    return response
+
+# starts timing the request for /metrics, under its url rule rather than its url
+@app.before_request
+def start_request_metrics():
+    if not app.config["METRICS"]:
+        return
+    g.metrics_route = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+    g.metrics_start = time.perf_counter()
+    query_log = get_connections().query_log
+    g.metrics_db_start = query_log.thread_seconds() if query_log is not None else None
+    request_metrics.begin(request.method, g.metrics_route)
+
+
+# records the request's status, time and DB time (error responses included)
+@app.after_request
+def record_request_metrics(response):
+    if "metrics_start" in g:
+        db_seconds = None
+        if g.metrics_db_start is not None:
+            db_seconds = get_connections().query_log.thread_seconds() - g.metrics_db_start
+        request_metrics.observe(request.method, g.metrics_route, response.status_code,
+                                time.perf_counter() - g.metrics_start, db_seconds)
+    return response
+
+
+@app.teardown_request
+def end_request_metrics(exception):
+    if "metrics_route" in g:
+        request_metrics.end(request.method, g.metrics_route)
+
+
+# with the play buffer on, flushes the buffered events of the date a playcount analytics
+# request reads, before its ETag is checked, so clients read their own writes
+@app.before_request
+def sync_play_buffer():
+    if request.url_rule is None or not request.url_rule.rule.startswith("/analytics/playcount/"):
+        return
+    play_buffer = get_play_buffer()
+    if play_buffer is not None:
+        try:
+            date = str(to_date(request.view_args["date_string"]))
+        except BadRequest:
+            return
+        play_buffer.sync(date)
+
+
+# Cache-Control of the current request's route
+def cache_control(rule):
+    past_dates = app.config["CACHE_CONTROL_PAST_DATES"]
+    if past_dates and rule.startswith("/analytics/playcount/"):
+        try:
+            if to_date(request.view_args["date_string"]) < datetime.date.today():
+                return past_dates
+        except BadRequest:
+            pass
+    return app.config["CACHE_CONTROL"].get(rule, app.config["CACHE_CONTROL_DEFAULT"])
+
+
+# tags GET requests of the ETAG_ROUTES before their view runs (so a write racing the view
+# can only make the tag older than the response, never newer), and answers a matching
+# If-None-Match with a 304 without running the view
+@app.before_request
+def check_etag():
+    if not app.config["ETAGS"] or request.method != "GET" or request.url_rule is None:
+        return
+    scope = ETAG_ROUTES.get(request.url_rule.rule)
+    if scope is None:
+        return
+    tables, entity = scope
+    entity_key = cache_key(entity[0], request.view_args[entity[1]]) if entity is not None else None
+    g.etag = get_versions().tag(tables, entity_key)
+    if not request.if_none_match.star_tag and request.if_none_match.contains_weak(g.etag):
+        return Response(status=304)
+
+
+# sets the ETag and Cache-Control of tagged responses, and the configured Cache-Control
+# of the other routes in CACHE_CONTROL
+@app.after_request
+def set_etag(response):
+    if response.status_code not in (200, 304) or request.url_rule is None:
+        return response
+    if "etag" in g:
+        response.set_etag(g.etag, weak=True)
+        response.headers["Cache-Control"] = cache_control(request.url_rule.rule)
+    elif request.url_rule.rule in app.config["CACHE_CONTROL"]:
+        response.headers["Cache-Control"] = app.config["CACHE_CONTROL"][request.url_rule.rule]
+    return response
+
+
+# called on close of response; the request thread's connections go back to the pool for
+# the next request, with anything a failed request left uncommitted rolled back
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+    if _connections is not None:
+        _connections.release()
 
 
 # ########### post MS1 ############## #
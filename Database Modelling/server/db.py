@@ -1,16 +1,117 @@
 import sqlite3
+import base64
 from flask.cli import with_appcontext
+import itertools
+from itertools import repeat
+import json
 import logging
+import os
+import queue
+import re
+from functools import partial, lru_cache
+import threading
 import time
+from collections import OrderedDict, deque
 from datetime import datetime
+from urllib.request import pathname2url
 
 
 
 # helper function that converts query result to json, after cursor has executed query
 def to_json(cursor):
     results = cursor.fetchall()
-    headers = [d[0] for d in cursor.description]
-    return [dict(zip(headers, row)) for row in results]
+    headers = header_tuple(cursor.description)
+    return list(map(dict, map(zip, repeat(headers), results)))
+
+
+# helper function that returns the column names of a cursor's description, cached per statement shape
+@lru_cache(maxsize=512)
+def header_tuple(description):
+    return tuple(d[0] for d in description)
+
+
+# helper function like to_json, but yields the rows' dicts as they are fetched, size rows at a
+# time, so a large result is never held whole
+def iter_json(cursor, size=500):
+    if cursor.description is None:
+        return
+    headers = header_tuple(cursor.description)
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield from map(dict, map(zip, repeat(headers), rows))
+
+
+# helper function that returns rows (an iterator) unchanged, raising KeyNotFound(message) if it is empty
+def non_empty(rows, message):
+    first = next(rows, None)
+    if first is None:
+        raise KeyNotFound(message)
+    return itertools.chain([first], rows)
+
+
+# helper function that groups (key, id) rows into a dict of key -> [ids], after cursor has executed query
+def group_ids(cursor):
+    grouped = {}
+    for key, value in cursor.fetchall():
+        grouped.setdefault(key, []).append(value)
+    return grouped
+
+
+# helpers for the opaque cursors of the paged list methods: the sort key of the last row
+# returned, tagged with the list it belongs to so it can not be replayed against another one
+def encode_cursor(kind, key):
+    raw = json.dumps([kind] + list(key), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(kind, cursor, size):
+    try:
+        value = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise BadRequest("Invalid cursor")
+    if not isinstance(value, list) or len(value) != size + 1 or value[0] != kind:
+        raise BadRequest("Invalid cursor")
+    return value[1:]
+
+
+# helper function that cuts rows fetched with limit + 1 down to a page,
+# returning {"items": page, "next_cursor": cursor of the next page or None}
+def to_page(rows, limit, kind, key):
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(kind, key(rows[-1]))
+    return {"items": rows, "next_cursor": next_cursor}
+
+
+# helper function that removes the unset source (playlist_id/album_id) from play rows
+def drop_null_sources(rows):
+    for row in rows:
+        drop_null_source(row)
+    return rows
+
+
+def drop_null_source(row):
+    if row['playlist_id'] is None:
+        del(row['playlist_id'])
+    if row['album_id'] is None:
+        del (row['album_id'])
+    return row
+
+
+# Splits a SQL script into its statements (trigger bodies included); a statement must end
+# at the end of a line
+def split_statements(script):
+    statements = []
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement)
+            statement = ""
+    return statements
 
 
 # Error class for when a key is not found
@@ -44,6 +145,791 @@ class BadRequest(Exception):
         return rv
 
 
+# -----------------
+# Post body parsing
+# Each parse_* validates one post body and returns the rows it inserts, one list per
+# statement in the matching *_STATEMENTS tuple, so single and bulk loads share validation.
+# -------------------
+
+ARTIST_STATEMENTS = ("INSERT OR IGNORE INTO artist VALUES (?, ?, ?)",)
+
+ALBUM_STATEMENTS = ("INSERT OR IGNORE INTO album VALUES (?, ?, ?)",
+                    "INSERT OR IGNORE INTO release VALUES (?, ?)",
+                    "INSERT OR IGNORE INTO tracklist VALUES (?, ?, ?)")
+
+SONG_STATEMENTS = ("INSERT or IGNORE INTO song VALUES (?, ?, ?)",
+                   "INSERT OR IGNORE INTO created VALUES (?, ?)")
+
+PLAYLIST_STATEMENTS = ("INSERT OR IGNORE INTO playlist VALUES (?, ?, ?)",
+                       "INSERT OR IGNORE INTO playlist_songs VALUES (?, ?)")
+
+# Entity cache entries a statement group's rows invalidate: (kind, statement index, id column).
+# An album also invalidates its songs, whose album_ids it changes.
+CACHE_INVALIDATION = {
+    ARTIST_STATEMENTS: [("artist", 0, 0)],
+    ALBUM_STATEMENTS: [("album", 0, 0), ("song", 2, 1)],
+    SONG_STATEMENTS: [("song", 0, 0)],
+}
+
+# Table versions (see VersionTracker) a statement group's rows bump
+WRITTEN_TABLES = {
+    ARTIST_STATEMENTS: ("artist",),
+    ALBUM_STATEMENTS: ("album",),
+    SONG_STATEMENTS: ("song",),
+    PLAYLIST_STATEMENTS: ("playlist",),
+}
+
+
+# write(db, parsed) for add_bulk/add_stream: inserts parse_* results with statements
+def insert_with(statements):
+    return lambda db, parsed: db.insert_many(statements, parsed)
+
+
+def parse_artist(post_body):
+    try:
+        artist_id = post_body["artist_id"]
+        artist_name = post_body["artist_name"]
+        if "country" in post_body:
+            country = post_body["country"]
+        else:
+            country = None
+    except (KeyError, TypeError) as e:
+        raise BadRequest(message="Required attribute is missing")
+    return ([(artist_id, artist_name, country)],)
+
+
+def parse_album(post_body):
+    try:
+        album_id = post_body["album_id"]
+        album_name = post_body["album_name"]
+        release_year = post_body["release_year"]
+        artist_ids = post_body["artist_ids"]
+        song_ids = post_body["song_ids"]
+    except (KeyError, TypeError) as e:
+        raise BadRequest(message="Required attribute is missing")
+    if isinstance(song_ids, list) is False or isinstance(artist_ids, list) is False:
+        raise BadRequest("song_ids or artist_ids are not lists")
+    ordering = int(time.mktime(datetime.now().timetuple()))
+    return ([(album_id, album_name, release_year)],
+            [(album_id, artist_id) for artist_id in artist_ids],
+            [(album_id, song_id, ordering) for song_id in song_ids])
+
+
+def parse_song(post_body):
+    try:
+        song_id = post_body["song_id"]
+        song_name = post_body["song_name"]
+        length = post_body["length"]
+        artist_ids = post_body["artist_ids"]
+    except (KeyError, TypeError) as e:
+        raise BadRequest(message="Required attribute is missing")
+    if isinstance(artist_ids, list) is False:
+        raise BadRequest("artist_ids is not a list")
+    return ([(song_id, song_name, length)],
+            [(artist_id, song_id) for artist_id in artist_ids])
+
+
+def parse_playlist(post_body):
+    try:
+        playlist_id = post_body["playlist_id"]
+        playlist_name = post_body["playlist_name"]
+        author_name = post_body["author_name"]
+        song_ids = post_body["song_ids"]
+    except (KeyError, TypeError) as e:
+        raise BadRequest(message="Required attribute is missing")
+    if isinstance(song_ids, list) is False:
+        raise BadRequest("song_ids is not a lists")
+    return ([(playlist_id, playlist_name, author_name)],
+            [(playlist_id, song_id) for song_id in song_ids])
+
+
+# Returns a play event as (date, song_id, playlist_id, album_id, play_count)
+def parse_play(post_body):
+    try:
+        date = post_body["date"]
+        song_id = post_body["song_id"]
+        play_count = post_body["play_count"]
+    except (KeyError, TypeError) as e:
+        raise BadRequest(message="Required attribute is missing")
+    playlist_id = None
+    album_id = None
+    if "playlist_id" in post_body and "album_id" in post_body:
+        raise BadRequest(message="Both playlist and album is specified")
+    elif "playlist_id" in post_body:
+        playlist_id = post_body["playlist_id"]
+    elif "album_id" in post_body:
+        album_id = post_body["album_id"]
+    # plays are summed by key in Python before they are written (insert_plays, PlayBuffer)
+    if isinstance(play_count, bool) or not isinstance(play_count, (int, float)):
+        raise BadRequest("play_count is not a number")
+    if any(isinstance(value, (list, dict)) for value in (date, song_id, playlist_id, album_id)):
+        raise BadRequest("date, song_id, playlist_id and album_id must be single values")
+    return (date, song_id, playlist_id, album_id, play_count)
+
+
+# PRAGMAs ad hoc SQL may run on a read_only connection: schema lookups (their argument is a
+# table or index name), and settings it may only read, never set
+SCHEMA_PRAGMAS = {"table_info", "table_xinfo", "table_list", "index_list", "index_info", "index_xinfo",
+                  "foreign_key_list"}
+READ_ONLY_PRAGMAS = {"user_version", "page_count", "page_size", "freelist_count"}
+
+# statements a read_only connection may run: reads, plus the PRAGMAs above
+READ_ONLY_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION,
+                     sqlite3.SQLITE_RECURSIVE, sqlite3.SQLITE_TRANSACTION, sqlite3.SQLITE_SAVEPOINT}
+
+
+# sqlite3 authorizer of read_only connections: denies ATTACH/DETACH, writes, DDL and any
+# PRAGMA but the ones above
+def read_only_authorizer(action, arg1, arg2, db_name, trigger):
+    if action in READ_ONLY_ACTIONS:
+        return sqlite3.SQLITE_OK
+    # asked when pragma_table_info() and the like read the schema; sqlite_master itself
+    # cannot be written to
+    if action == sqlite3.SQLITE_UPDATE and arg1 == "sqlite_master":
+        return sqlite3.SQLITE_OK
+    if action == sqlite3.SQLITE_PRAGMA:
+        name = arg1.lower()
+        if name in SCHEMA_PRAGMAS or (name in READ_ONLY_PRAGMAS and arg2 is None):
+            return sqlite3.SQLITE_OK
+    return sqlite3.SQLITE_DENY
+
+
+"""
+Hands out long-lived connections to the database instead of one connect per request.
+A thread gets its own writer and its own reader connection, opened once with WAL and the
+tuned PRAGMAs below, so GETs never wait behind a POST's write transaction. The threaded
+server runs every request on a new thread, so release() (at the end of each request)
+hands the thread's connections back to a pool of at most pool_size idle connections per
+kind, for the next thread to reuse, and nobody pays sqlite3.connect on each request.
+Connections of threads that ended without releasing them are closed on the next get().
+"""
+
+
+class ConnectionManager:
+    SYNCHRONOUS_LEVELS = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+    def __init__(self, database, busy_timeout=5000, cache_size=-64000, mmap_size=268435456,
+                 synchronous="NORMAL", journal_mode="WAL", query_log=None, pool_size=16):
+        if str(synchronous).upper() not in self.SYNCHRONOUS_LEVELS:
+            raise ValueError("synchronous must be one of %s" % (self.SYNCHRONOUS_LEVELS,))
+        self.database = database
+        self.busy_timeout = int(busy_timeout)  # milliseconds
+        self.cache_size = int(cache_size)  # pages, or KiB when negative
+        self.mmap_size = int(mmap_size)  # bytes
+        self.synchronous = str(synchronous).upper()
+        self.journal_mode = journal_mode
+        # QueryLog that records every statement run on these connections, if any
+        self.query_log = query_log
+        self.pool_size = int(pool_size)  # idle connections kept per kind
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        # every open connection of this process -> the thread using it (None while idle)
+        self.opened = {}
+        # kind -> idle connections
+        self.idle = {}
+
+    # Opens a new connection and applies the PRAGMAs (these can not be bound as parameters).
+    # A read_only connection is opened with mode=ro and query_only, so it can not write at all.
+    def connect(self, read_only=False):
+        database = self.database
+        if read_only:
+            database = "file:%s?mode=ro" % pathname2url(os.path.abspath(self.database))
+        # a connection is only used by one thread at a time, but moves between threads
+        if self.query_log is None:
+            conn = sqlite3.connect(database, timeout=self.busy_timeout / 1000.0, check_same_thread=False,
+                                   uri=read_only)
+        else:
+            conn = sqlite3.connect(database, timeout=self.busy_timeout / 1000.0, check_same_thread=False,
+                                   uri=read_only, factory=InstrumentedConnection)
+            conn.query_log = self.query_log
+        if read_only:
+            conn.execute("PRAGMA query_only=1")
+        else:
+            conn.execute("PRAGMA journal_mode=%s" % self.journal_mode)
+        conn.execute("PRAGMA busy_timeout=%d" % self.busy_timeout)
+        conn.execute("PRAGMA cache_size=%d" % self.cache_size)
+        conn.execute("PRAGMA mmap_size=%d" % self.mmap_size)
+        conn.execute("PRAGMA synchronous=%s" % self.synchronous)
+        if read_only:
+            # pooled and fed ad hoc SQL: it must not be able to undo the above or attach files
+            conn.set_authorizer(read_only_authorizer)
+            if hasattr(conn, "setlimit"):
+                conn.setlimit(sqlite3.SQLITE_LIMIT_ATTACHED, 0)
+        with self.lock:
+            self.opened[conn] = threading.current_thread()
+        return conn
+
+    # Returns this thread's connection of the given kind: an idle one from the pool, or a
+    # new one. A forked worker inherits the parent's connections, so they are keyed by pid too
+    # (and the inherited ones are dropped, never used).
+    def get(self, kind):
+        pid = os.getpid()
+        if getattr(self.local, "pid", None) != pid:
+            self.local.pid = pid
+            self.local.connections = {}
+        conn = self.local.connections.get(kind)
+        if conn is None:
+            with self.lock:
+                if self.pid != pid:
+                    self.pid = pid
+                    self.opened = {}
+                    self.idle = {}
+                self.close_abandoned()
+                idle = self.idle.get(kind)
+                if idle:
+                    conn = idle.pop()
+                    self.opened[conn] = threading.current_thread()
+            if conn is None:
+                conn = self.connect(read_only=(kind == "read_only"))
+            self.local.connections[kind] = conn
+        return conn
+
+    # Closes the connections of threads that ended without releasing them (lock held)
+    def close_abandoned(self):
+        for conn, thread in list(self.opened.items()):
+            if thread is not None and not thread.is_alive():
+                del self.opened[conn]
+                conn.close()
+
+    def writer(self):
+        return self.get("writer")
+
+    def reader(self):
+        return self.get("reader")
+
+    # for ad hoc SQL: a connection that refuses writes
+    def read_only(self):
+        return self.get("read_only")
+
+    # Hands this thread's connections back to the pool (closing those it has no room for),
+    # rolling back anything a failed request left open on them
+    def release(self):
+        if getattr(self.local, "pid", None) != os.getpid():
+            return
+        connections, self.local.connections = self.local.connections, {}
+        for kind, conn in connections.items():
+            if conn.in_transaction:
+                conn.rollback()
+            with self.lock:
+                if conn not in self.opened:
+                    continue
+                idle = self.idle.setdefault(kind, [])
+                if len(idle) < self.pool_size:
+                    idle.append(conn)
+                    self.opened[conn] = None
+                    continue
+                del self.opened[conn]
+            conn.close()
+
+    # Closes every connection this process opened (for shutdown)
+    def close_all(self):
+        with self.lock:
+            opened, self.opened = self.opened, {}
+            self.idle = {}
+        for conn in opened:
+            conn.close()
+        self.local = threading.local()
+
+
+"""
+Bounded, in-process LRU of assembled entity results (find_song/find_album/find_artist),
+shared by every DB object of the process. Entries expire after ttl seconds (None = never)
+and are dropped by the DB write paths once their transaction commits.
+Cached values are shared, callers must not mutate them.
+"""
+
+
+# Cache key for an entity id; ids arrive as ints from post bodies and as strings from urls
+def cache_key(kind, entity_id):
+    try:
+        number = float(entity_id)
+        if number.is_integer():
+            entity_id = int(number)
+    except (TypeError, ValueError):
+        entity_id = str(entity_id)
+    return (kind, entity_id)
+
+
+class EntityCache:
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = int(max_size)
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # bumped on every invalidation; a load that started before one is not stored,
+        # since it may have read the rows the invalidating write replaced
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # Returns the cached value for key, or stores and returns load()
+    def get_or_load(self, key, load):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > now):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.generation
+
+        value = load()
+
+        if self.max_size > 0:
+            expires = now + self.ttl if self.ttl else None
+            with self.lock:
+                if generation == self.generation:
+                    self.entries[key] = (expires, value)
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.max_size:
+                        self.entries.popitem(last=False)
+                        self.evictions += 1
+        return value
+
+    def invalidate(self, keys):
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                if self.entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "max_size": self.max_size, "ttl": self.ttl,
+                    "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "invalidations": self.invalidations}
+
+
+"""
+Version counters behind the ETags of the GET endpoints, shared by every DB object of the
+process. A commit bumps the counter of each table it wrote and, for the entities the entity
+cache would drop, one of BUCKETS entity counters (so a tag of an entity only changes when an
+entity sharing its bucket changes). Anything that may change every response (create_db,
+migrate) bumps the epoch. Counters only live in this process, so tags carry a
+random token of it; writes by other processes are caught through PRAGMA data_version
+(see check_external), which then also clears the entity cache.
+"""
+
+
+class VersionTracker:
+    BUCKETS = 4096
+
+    # connect opens the connection that watches data_version; None to not watch it
+    def __init__(self, connect=None, cache=None):
+        self.lock = threading.Lock()
+        self.token = os.urandom(4).hex()
+        self.epoch = 0
+        self.tables = {}
+        self.entities = [0] * self.BUCKETS
+        # number of local commits, to tell them apart from other processes' in check_external
+        self.commits = 0
+        self.connect = connect
+        self.cache = cache
+        self.watch = None
+        self.data_version = None
+        self.commits_seen = 0
+
+    def bump(self, tables, entity_keys=()):
+        with self.lock:
+            self.commits += 1
+            for table in tables:
+                self.tables[table] = self.tables.get(table, 0) + 1
+            for key in entity_keys:
+                self.entities[hash(key) % self.BUCKETS] += 1
+
+    def bump_all(self):
+        with self.lock:
+            self.commits += 1
+            self.epoch += 1
+
+    # Bumps the epoch if the database file changed without a local commit since the last check.
+    # A change that lands together with a local commit is taken for that commit.
+    def check_external(self):
+        if self.connect is None:
+            return
+        with self.lock:
+            if self.watch is None:
+                self.watch = self.connect()
+            data_version = self.watch.execute("PRAGMA data_version").fetchone()[0]
+            external = self.data_version is not None and data_version != self.data_version \
+                and self.commits == self.commits_seen
+            if external:
+                self.epoch += 1
+            self.data_version = data_version
+            self.commits_seen = self.commits
+        if external and self.cache is not None:
+            self.cache.clear()
+
+    # Weak tag (without W/ and quotes) of a response that depends on the given tables and,
+    # optionally, on one entity (a cache_key)
+    def tag(self, tables=(), entity_key=None):
+        self.check_external()
+        with self.lock:
+            parts = [self.token, str(self.epoch)] + [str(self.tables.get(table, 0)) for table in tables]
+            if entity_key is not None:
+                parts.append(str(self.entities[hash(entity_key) % self.BUCKETS]))
+        return "-".join(parts)
+
+    def stats(self):
+        with self.lock:
+            return {"epoch": self.epoch, "commits": self.commits, "tables": dict(self.tables)}
+
+
+"""
+Per statement instrumentation. Connections opened with a QueryLog run every execute and
+fetch through InstrumentedCursor, which records the statement's duration (execute plus
+fetches) and rows returned under its fingerprint (the SQL with literals replaced by ?),
+and keeps the most recent statements slower than slow_ms, optionally with their
+EXPLAIN QUERY PLAN so full table scans stand out.
+"""
+
+
+# Normalizes a statement so the same query with different literals/whitespace is counted once
+@lru_cache(maxsize=1024)
+def fingerprint(sql):
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+(?:\.\d+)?\b", "?", sql)
+    sql = re.sub(r"\s+", " ", sql).strip()
+    return re.sub(r"\(\s*\?(?:\s*,\s*\?)+\s*\)", "(?, ...)", sql)
+
+
+def params_repr(params):
+    if isinstance(params, dict):
+        return {k: repr(v) for k, v in params.items()}
+    return [repr(p) for p in params] if params else []
+
+
+class QueryLog:
+    def __init__(self, slow_ms=50, slow_log_size=200, explain=True):
+        self.slow_ms = slow_ms
+        self.explain = explain
+        self.lock = threading.Lock()
+        # fingerprint -> [count, total seconds, max seconds, rows]
+        self.statements = {}
+        self.slow = deque(maxlen=int(slow_log_size))
+        # fingerprint -> EXPLAIN QUERY PLAN detail lines, captured once per statement
+        self.plans = {}
+        # statement seconds run by each thread, so a request can tell its own DB time
+        self.local = threading.local()
+
+    # Total seconds of statements this thread has run
+    def thread_seconds(self):
+        return getattr(self.local, "seconds", 0.0)
+
+    # Counts seconds of statements another thread ran for this one (the write queue's writer)
+    def add_thread_seconds(self, seconds):
+        self.local.seconds = self.thread_seconds() + seconds
+
+    # Records one finished statement; returns its slow log entry if it was slow, else None
+    def record(self, sql, params, seconds, rows):
+        self.add_thread_seconds(seconds)
+        key = fingerprint(sql)
+        with self.lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = [0, 0.0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            stats[3] += rows
+            if self.slow_ms is None or seconds * 1000.0 < self.slow_ms:
+                return None
+            entry = {"fingerprint": key, "sql": sql, "params": params_repr(params),
+                     "ms": seconds * 1000.0, "rows": rows, "at": datetime.now().isoformat(timespec="seconds")}
+            if key in self.plans:
+                entry.update(self.plans[key])
+            self.slow.append(entry)
+        return entry
+
+    # Adds EXPLAIN QUERY PLAN of a slow SELECT to its slow log entry (and all later ones)
+    def capture_plan(self, conn, entry, sql, params):
+        if not self.explain or "plan" in entry or not re.match(r"\s*(select|with)\b", sql, re.IGNORECASE):
+            return
+        try:
+            details = [row[3] for row in sqlite3.Cursor.execute(conn.cursor(), "EXPLAIN QUERY PLAN " + sql, params)]
+        except sqlite3.Error:
+            return
+        plan = {"plan": details,
+                "full_scans": [d for d in details if d.startswith("SCAN ") and " USING " not in d
+                               and d != "SCAN CONSTANT ROW"]}
+        with self.lock:
+            self.plans[entry["fingerprint"]] = plan
+            entry.update(plan)
+
+    def reset(self):
+        with self.lock:
+            self.statements = {}
+            self.slow.clear()
+            self.plans = {}
+
+    # Statements ordered by total time, then the slow log, newest first
+    def stats(self, limit=50):
+        with self.lock:
+            statements = sorted(self.statements.items(), key=lambda kv: kv[1][1], reverse=True)[:limit]
+            slow = list(self.slow)[::-1]
+        return {
+            "slow_ms": self.slow_ms,
+            "explain": self.explain,
+            "statements": [{"fingerprint": key, "count": count, "total_ms": total * 1000.0,
+                            "mean_ms": total * 1000.0 / count, "max_ms": worst * 1000.0, "rows": rows}
+                           for key, (count, total, worst, rows) in statements],
+            "slow": slow,
+        }
+
+
+# Cursor that reports each statement to its connection's QueryLog. A statement is recorded
+# once its rows are exhausted, the cursor runs another statement or is closed.
+class InstrumentedCursor(sqlite3.Cursor):
+    pending = None
+
+    def execute(self, sql, parameters=()):
+        self.finish()
+        start = time.perf_counter()
+        try:
+            sqlite3.Cursor.execute(self, sql, parameters)
+        finally:
+            self.pending = [sql, parameters, time.perf_counter() - start, 0]
+        # statements without result rows are done now
+        if self.description is None:
+            self.finish()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self.finish()
+        start = time.perf_counter()
+        try:
+            return sqlite3.Cursor.executemany(self, sql, seq_of_parameters)
+        finally:
+            self.pending = [sql, (), time.perf_counter() - start, 0]
+            self.finish()
+
+    def executescript(self, sql_script):
+        self.finish()
+        start = time.perf_counter()
+        try:
+            return sqlite3.Cursor.executescript(self, sql_script)
+        finally:
+            self.pending = [sql_script, (), time.perf_counter() - start, 0]
+            self.finish()
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = sqlite3.Cursor.fetchone(self)
+        self.fetched(start, 0 if row is None else 1, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = sqlite3.Cursor.fetchmany(self, self.arraysize if size is None else size)
+        self.fetched(start, len(rows), not rows)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = sqlite3.Cursor.fetchall(self)
+        self.fetched(start, len(rows), True)
+        return rows
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def close(self):
+        self.finish()
+        sqlite3.Cursor.close(self)
+
+    # a SELECT whose rows were not all fetched is recorded when the cursor goes away
+    def __del__(self):
+        try:
+            self.finish()
+        except sqlite3.Error:
+            pass
+
+    def fetched(self, start, rows, done):
+        if self.pending is not None:
+            self.pending[2] += time.perf_counter() - start
+            self.pending[3] += rows
+            if done:
+                self.finish()
+
+    def finish(self):
+        if self.pending is None:
+            return
+        sql, params, seconds, rows = self.pending
+        self.pending = None
+        log = self.connection.query_log
+        if log is None:
+            return
+        entry = log.record(sql, params, seconds, rows)
+        if entry is not None:
+            log.capture_plan(self.connection, entry, sql, params)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    query_log = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    # the connection shortcuts would otherwise use a plain cursor
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+
+"""
+An ad hoc query (the /web/query page) run within a budget: a progress handler interrupts it
+once it has run timeout_ms of wall clock time or max_steps SQLite virtual machine
+instructions, counted from start() until the rows are all read, and at most max_rows rows
+are returned, the rest reported as truncated. Meant for a read-only connection.
+"""
+
+
+class BoundedQuery:
+    # virtual machine instructions between budget checks
+    CHECK_EVERY = 10000
+
+    def __init__(self, db, query, max_rows=10000, timeout_ms=5000, max_steps=None):
+        self.db = db
+        self.query = query
+        self.max_rows = max_rows
+        self.timeout_ms = timeout_ms
+        self.max_steps = max_steps
+        self.row_count = 0
+        self.truncated = False
+        self.error = None
+        self.cursor = None
+        self.started = None
+        self.steps = 0
+        self.finished = False
+
+    # Returns non zero (interrupting the statement) once the budget is spent
+    def progress(self):
+        self.steps += self.CHECK_EVERY
+        if self.max_steps is not None and self.steps > self.max_steps:
+            return 1
+        if self.timeout_ms is not None and (time.perf_counter() - self.started) * 1000.0 > self.timeout_ms:
+            return 1
+        return 0
+
+    def budget_message(self):
+        return "Query stopped: it went over its budget of %s ms / %s steps" % (self.timeout_ms, self.max_steps)
+
+    # Runs the statement; errors (including running out of budget before the first row) raise here
+    def start(self):
+        self.started = time.perf_counter()
+        self.db.conn.set_progress_handler(self.progress, self.CHECK_EVERY)
+        try:
+            self.cursor = self.db.conn.cursor()
+            self.cursor.execute(self.query)
+        except sqlite3.OperationalError as e:
+            self.finish()
+            if str(e) == "interrupted":
+                raise BadRequest(self.budget_message())
+            raise
+        except BaseException:
+            self.finish()
+            raise
+
+    # Yields up to max_rows rows; running out of budget ends the rows and sets error
+    def __iter__(self):
+        try:
+            rows = iter_json(self.cursor)
+            for row in rows:
+                if self.max_rows is not None and self.row_count >= self.max_rows:
+                    self.truncated = True
+                    break
+                self.row_count += 1
+                yield row
+        except sqlite3.OperationalError as e:
+            if str(e) != "interrupted":
+                raise
+            self.error = self.budget_message()
+        finally:
+            self.finish()
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.db.conn.set_progress_handler(None, 0)
+        if self.cursor is not None:
+            self.cursor.close()
+        if self.db.conn.in_transaction:
+            self.db.conn.commit()
+
+    def summary(self):
+        res = {"row_count": self.row_count, "truncated": self.truncated, "max_rows": self.max_rows,
+               "elapsed_ms": (time.perf_counter() - self.started) * 1000.0}
+        if self.error is not None:
+            res["error"] = self.error
+        return res
+
+
+"""
+Reads an iterable of lines (a request body) on a thread of its own, so its reader can wait
+for the next line with a timeout (add_stream flushes on time while the feed is stalled).
+At most max_waiting lines are read ahead; past that the thread waits, so a fast producer is
+still slowed down to the reader's pace. An error reading the lines is raised by get.
+"""
+
+
+class LineReader:
+    def __init__(self, lines, max_waiting=1000):
+        self.lines = lines
+        self.max_waiting = max_waiting
+        # SimpleQueue: a Queue(max_waiting) costs several times more per line
+        self.waiting = queue.SimpleQueue()
+        # lines put by the thread and taken by get, each counted by its own side
+        self.read = 0
+        self.taken = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="line-reader", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            for line in self.lines:
+                while self.read - self.taken >= self.max_waiting:
+                    if self.stopped.wait(0.01):
+                        return
+                self.read += 1
+                self.waiting.put((line, None))
+            self.waiting.put((None, None))
+        except Exception as e:
+            self.waiting.put((None, e))
+
+    # Returns the next line, or None after the last one; raises queue.Empty when none
+    # arrives within timeout seconds (None waits for as long as it takes)
+    def get(self, timeout=None):
+        line, error = self.waiting.get(timeout=timeout)
+        self.taken += 1
+        if error is not None:
+            raise error
+        return line
+
+    # Stops reading ahead (the thread ends once its current read returns)
+    def close(self):
+        self.stopped.set()
+
+
 """
 Wraps a single connection to the database with higher-level functionality.
 Holds the DB connection
@@ -51,9 +937,72 @@ Holds the DB connection
 
 
 class DB:
-    def __init__(self, connection):
+    def __init__(self, connection, cache=None, versions=None):
         self.conn = connection
-        logging.basicConfig(level=logging.DEBUG)
+        self.cache = cache
+        self.versions = versions
+        # entity cache keys and tables written in the open transaction, handled by commit()
+        self.dirty = set()
+        self.written = set()
+        # set while a WriteQueue job runs (see begin_job): commit() is left to the batch
+        # and rollback() only undoes the job
+        self.savepoint = None
+
+
+    # Commits the open transaction, then drops the cache entries it changed and bumps
+    # the versions of what it wrote
+    def commit(self):
+        if self.savepoint is not None:
+            return
+        self.conn.commit()
+        if self.dirty and self.cache is not None:
+            self.cache.invalidate(self.dirty)
+        if self.written and self.versions is not None:
+            self.versions.bump(self.written, self.dirty)
+        self.dirty = set()
+        self.written = set()
+
+
+    def rollback(self):
+        if self.savepoint is not None:
+            self.conn.execute("ROLLBACK TO %s" % self.savepoint)
+            return
+        self.conn.rollback()
+        self.dirty = set()
+        self.written = set()
+
+
+    # Group commit (see WriteQueue): begin_batch, then every job between begin_job and
+    # end_job, each in its own savepoint so a failed job is undone alone, then commit()
+    def begin_batch(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+
+
+    def begin_job(self):
+        self.conn.execute("SAVEPOINT write_job")
+        self.savepoint = "write_job"
+
+
+    def end_job(self, ok):
+        self.savepoint = None
+        if not ok:
+            self.conn.execute("ROLLBACK TO write_job")
+        self.conn.execute("RELEASE write_job")
+
+
+    # Returns load() through the entity cache, if there is one
+    def cached(self, kind, entity_id, load):
+        if self.cache is None:
+            return load()
+        return self.cache.get_or_load(cache_key(kind, entity_id), load)
+
+
+    # Drops every cached entity and version, after writes that may have changed anything
+    def clear_cache(self):
+        if self.cache is not None:
+            self.cache.clear()
+        if self.versions is not None:
+            self.versions.bump_all()
 
 
     # Simple example of how to execute a query against the DB.
@@ -63,81 +1012,217 @@ class DB:
     # cur.execute("insert into people values (?, ?)", (who, age))
     # And this is the named style:
     # cur.execute("select * from people where name_last=:who and age=:age", {"who": who, "age": age})
-    def run_query(self, query):
-        c = self.conn.cursor()
-        c.execute(query)
-        res = to_json(c)
-        self.conn.commit()
+    # Runs within a budget (see BoundedQuery) and returns {"rows": [...], "row_count", "truncated",
+    # "elapsed_ms"}; raises BadRequest if the budget ran out. With stream=True returns the started
+    # BoundedQuery instead, whose rows are fetched as it is iterated.
+    def run_query(self, query, max_rows=10000, timeout_ms=5000, max_steps=None, stream=False):
+        bounded = BoundedQuery(self, query, max_rows, timeout_ms, max_steps)
+        bounded.start()
+        if stream:
+            return bounded
+        rows = list(bounded)
+        if bounded.error is not None:
+            raise BadRequest(bounded.error)
+        res = bounded.summary()
+        res["rows"] = rows
         return res
 
+    # Yields every item of a paged list method (find_songs_by_artist, solo_albums, ...) from cursor
+    # on, reading page_size items at a time inside one read transaction, so the pages are a
+    # consistent snapshot. The first page is read before returning, so its errors raise here.
+    def iter_pages(self, method, *args, cursor=None, page_size=1000):
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+        page = method(*args, limit=page_size, cursor=cursor)
+
+        def pages(page):
+            while True:
+                yield from page["items"]
+                if page["next_cursor"] is None:
+                    return
+                page = method(*args, limit=page_size, cursor=page["next_cursor"])
+
+        return pages(page)
+
     # Run script that drops and creates all tables
     def create_db(self, create_file):
         print("Running SQL script file %s" % create_file, flush=True)
         logging.info('testing info log')
         with open(create_file, "r") as f:
             self.conn.executescript(f.read())
+        self.clear_cache()
         return "{\"message\":\"created\"}"
 
+    # Upgrades the database in place: runs every NNNN_name.sql file in migrations_dir numbered
+    # above the database's user_version, in order, each in its own transaction.
+    # The version is read again once that transaction holds the write lock, so when several
+    # connections migrate at once each migration runs exactly once.
+    # Returns the resulting version and the migrations that were applied.
+    def migrate(self, migrations_dir):
+        applied = []
+        for name in sorted(os.listdir(migrations_dir)):
+            if not name.endswith(".sql"):
+                continue
+            number = int(name.split("_", 1)[0])
+            if number <= self.user_version():
+                continue
+            with open(os.path.join(migrations_dir, name), "r") as f:
+                script = f.read()
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                if number <= self.user_version():
+                    self.conn.rollback()
+                    continue
+                print("Running migration %s" % name, flush=True)
+                # not executescript, which would commit the transaction first
+                for statement in split_statements(script):
+                    self.conn.execute(statement)
+                self.conn.execute("PRAGMA user_version = %d" % number)
+                self.conn.commit()
+            except sqlite3.Error:
+                if self.conn.in_transaction:
+                    self.conn.rollback()
+                raise
+            applied.append(name)
+        if applied:
+            self.clear_cache()
+        return {"version": self.user_version(), "applied": applied}
+
+
+    # the version of the schema: the number of the last migration applied
+    def user_version(self):
+        return self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+    # Inserts the rows returned by a parse_* function with its matching statements
+    def insert_parsed(self, statements, rows):
+        c = self.conn.cursor()
+        for statement, values in zip(statements, rows):
+            c.executemany(statement, values)
+        for kind, index, column in CACHE_INVALIDATION.get(statements, ()):
+            self.dirty.update(cache_key(kind, row[column]) for row in rows[index])
+        self.written.update(WRITTEN_TABLES.get(statements, ()))
+
+
+    # Inserts a list of parse_* results with one executemany per statement
+    def insert_many(self, statements, parsed):
+        rows = [[] for _ in statements]
+        for item in parsed:
+            for statement_rows, item_rows in zip(rows, item):
+                statement_rows.extend(item_rows)
+        self.insert_parsed(statements, rows)
+
+
+    # Validates every post body in the list, then writes all the valid ones with
+    # write(db, parsed) (one executemany per statement) inside a single transaction.
+    # Returns the number of items inserted and the index/message of each item that failed.
+    def add_bulk(self, post_bodies, parse, write):
+        if isinstance(post_bodies, list) is False:
+            raise BadRequest("Expected a list of objects")
+        parsed = []
+        failed = []
+        for index, post_body in enumerate(post_bodies):
+            try:
+                parsed.append(parse(post_body))
+            except BadRequest as e:
+                failed.append({"index": index, "message": e.message})
 
-    def add_artist(self, post_body):
         try:
-            artist_id = post_body["artist_id"]
-            artist_name = post_body["artist_name"]
-            if "country" in post_body:
-                country = post_body["country"]
+            write(self, parsed)
+            self.commit()
+        except sqlite3.Error:
+            self.rollback()
+            raise
+        return {"inserted": len(parsed), "failed": failed}
+
+
+    # Loads newline delimited JSON from lines (any iterable, read lazily), validating each
+    # line like the single endpoints do and committing every chunk_rows items or chunk_ms
+    # milliseconds, whichever comes first, also while no line arrives. Only one chunk (and
+    # the lines LineReader reads ahead) is held in memory, and since the body is only read as
+    # fast as chunks are written, a fast producer is slowed down to the database's pace. Only the first max_failures failures are listed.
+    # A database error stops the load; the chunks committed before it stay.
+    # With submit (WriteQueue.submit) each chunk is written by the writer thread instead.
+    def add_stream(self, lines, parse, write, chunk_rows=5000, chunk_ms=200, max_failures=100, submit=None):
+        res = {"inserted": 0, "failed_count": 0, "failed": [], "commits": 0}
+        pending = []
+
+        def flush():
+            if submit is None:
+                write(self, pending)
+                self.commit()
             else:
-                country = None
-        except KeyError as e:
-            raise BadRequest(message="Required attribute is missing")
+                chunk = list(pending)
+                submit(lambda db: write(db, chunk))
+            res["inserted"] += len(pending)
+            res["commits"] += 1
+            del pending[:]
 
-        c = self.conn.cursor()
+        reader = LineReader(lines)
+        try:
+            deadline = time.monotonic() + chunk_ms / 1000.0
+            number = 0
+            while True:
+                try:
+                    line = reader.get(max(deadline - time.monotonic(), 0) if pending else None)
+                except queue.Empty:
+                    # the feed is stalled: commit what arrived
+                    flush()
+                    deadline = time.monotonic() + chunk_ms / 1000.0
+                    continue
+                if line is None:
+                    break
+                number += 1
+                if not line.strip():
+                    continue
+                try:
+                    pending.append(parse(json.loads(line)))
+                except (BadRequest, ValueError) as e:
+                    res["failed_count"] += 1
+                    if len(res["failed"]) < max_failures:
+                        message = e.message if isinstance(e, BadRequest) else "Invalid JSON"
+                        res["failed"].append({"line": number, "message": message})
+                if len(pending) >= chunk_rows or (pending and time.monotonic() >= deadline):
+                    flush()
+                    deadline = time.monotonic() + chunk_ms / 1000.0
+            if pending:
+                flush()
+        except sqlite3.Error as e:
+            self.rollback()
+            res["error"] = str(e)
+        finally:
+            reader.close()
+        return res
 
-        artist_statement = "INSERT OR IGNORE INTO artist VALUES (?, ?, ?)"
-        artist_values = [artist_id, artist_name, country]
-        c.execute(artist_statement, artist_values)
 
-        self.conn.commit()
+    def add_artist(self, post_body):
+        self.insert_parsed(ARTIST_STATEMENTS, parse_artist(post_body))
+        self.commit()
 
 
         return "{\"message\":\"artist inserted\"}"
 
 
-    def add_album(self, post_body):
-        try:
-            album_id = post_body["album_id"]
-            album_name = post_body["album_name"]
-            release_year = post_body["release_year"]
-            artist_ids = post_body["artist_ids"]
-            song_ids = post_body["song_ids"]
-        except KeyError as e:
-            raise BadRequest(message="Required attribute is missing")
-        if isinstance(song_ids, list) is False or isinstance(artist_ids, list) is False:
-            print("song_ids or artist_ids are not lists")
-            raise BadRequest("song_ids or artist_ids are not lists")
-        c = self.conn.cursor()
-
+    def add_artists_bulk(self, post_bodies):
+        return self.add_bulk(post_bodies, parse_artist, insert_with(ARTIST_STATEMENTS))
 
 
-        album_statement = "INSERT OR IGNORE INTO album VALUES (?, ?, ?)"
-        album_values = [album_id, album_name, release_year]
-        c.execute(album_statement, album_values)
+    def add_artists_stream(self, lines, chunk_rows, chunk_ms, submit=None):
+        return self.add_stream(lines, parse_artist, insert_with(ARTIST_STATEMENTS), chunk_rows, chunk_ms, submit=submit)
 
 
-        for artist_id in artist_ids: 
-            created_statement = "INSERT OR IGNORE INTO release VALUES (?, ?)"
-            created_values = [album_id, artist_id]
-            c.execute(created_statement, created_values)
+    def add_album(self, post_body):
+        self.insert_parsed(ALBUM_STATEMENTS, parse_album(post_body))
+        self.commit()
+        return "{\"message\":\"album inserted\"}"
 
 
+    def add_albums_bulk(self, post_bodies):
+        return self.add_bulk(post_bodies, parse_album, insert_with(ALBUM_STATEMENTS))
 
-        for song_id in song_ids: 
-            ordering = int(time.mktime(datetime.now().timetuple()))
-            created_statement = "INSERT OR IGNORE INTO tracklist VALUES (?, ?, ?)"
-            created_values = [album_id, song_id, ordering]
-            c.execute(created_statement, created_values)
 
-        self.conn.commit()
-        return "{\"message\":\"album inserted\"}"
+    def add_albums_stream(self, lines, chunk_rows, chunk_ms, submit=None):
+        return self.add_stream(lines, parse_album, insert_with(ALBUM_STATEMENTS), chunk_rows, chunk_ms, submit=submit)
 
 
 
@@ -149,32 +1234,17 @@ class DB:
         Loads a new song (and possibly a new album/artist) into the database.
         """
         # =======MS1 data========
-        try:
-            song_id = post_body["song_id"]
-            song_name = post_body["song_name"]
-            length = post_body["length"]
-            artist_ids = post_body["artist_ids"]
-        except KeyError as e:
-            raise BadRequest(message="Required attribute is missing")
-        if isinstance(artist_ids, list) is False:
-            raise BadRequest("artist_ids is not a list")
-
-        c = self.conn.cursor()
-
-        song_statement = "INSERT or IGNORE INTO song VALUES (?, ?, ?)"
-        song_values = [song_id, song_name, length]
-        c.execute(song_statement, song_values)
-
+        self.insert_parsed(SONG_STATEMENTS, parse_song(post_body))
+        self.commit()
+        return "{\"message\":\"song inserted\"}"
 
-        for artist_id in artist_ids: 
-            created_statement = "INSERT OR IGNORE INTO created VALUES (?, ?)"
-            created_values = [artist_id, song_id]
-            c.execute(created_statement, created_values)
 
+    def add_songs_bulk(self, post_bodies):
+        return self.add_bulk(post_bodies, parse_song, insert_with(SONG_STATEMENTS))
 
-        self.conn.commit()
-        return "{\"message\":\"song inserted\"}"
 
+    def add_songs_stream(self, lines, chunk_rows, chunk_ms, submit=None):
+        return self.add_stream(lines, parse_song, insert_with(SONG_STATEMENTS), chunk_rows, chunk_ms, submit=submit)
 
 
 
@@ -214,8 +1284,10 @@ class DB:
             created_values = [artist_id, song_id]
             c.execute(created_statement, created_values)
 
+        self.dirty.add(cache_key("song", song_id))
+        self.written.add("song")
 
-        self.conn.commit()
+        self.commit()
         return "{\"message\":\"song inserted\"}"
 
 
@@ -224,88 +1296,80 @@ class DB:
     Add a new playlist. 
     """
     def add_playlist(self, post_body):
-        try:
-            playlist_id = post_body["playlist_id"]
-            playlist_name = post_body["playlist_name"]
-            author_name = post_body["author_name"]
-            song_ids = post_body["song_ids"]
-        except KeyError as e:
-            raise BadRequest(message="Required attribute is missing")
-        if isinstance(song_ids, list) is False:
-            print("song_ids is not a list")
-            raise BadRequest("song_ids is not a lists")
-        c = self.conn.cursor()
+        self.insert_parsed(PLAYLIST_STATEMENTS, parse_playlist(post_body))
+        self.commit()
 
 
-        playlist_statement = "INSERT OR IGNORE INTO playlist VALUES (?, ?, ?)"
-        playlist_values = [playlist_id, playlist_name, author_name]
-        c.execute(playlist_statement, playlist_values)
+        return "{\"message\":\"playlist inserted\"}"
 
 
-        for song_id in song_ids: 
-            #ordering = int(time.mktime(datetime.now().timetuple()))
-            created_statement = "INSERT OR IGNORE INTO playlist_songs VALUES (?, ?)"
-            created_values = [playlist_id, song_id]
-            c.execute(created_statement, created_values)
+    def add_playlists_bulk(self, post_bodies):
+        return self.add_bulk(post_bodies, parse_playlist, insert_with(PLAYLIST_STATEMENTS))
 
-        self.conn.commit()
 
-
-        return "{\"message\":\"playlist inserted\"}"
+    def add_playlists_stream(self, lines, chunk_rows, chunk_ms, submit=None):
+        return self.add_stream(lines, parse_playlist, insert_with(PLAYLIST_STATEMENTS), chunk_rows, chunk_ms, submit=submit)
 
 
     """
     Add a new play event. 
     """
     def add_play(self, post_body):
-        try:
-            date = post_body["date"]
-            song_id = post_body["song_id"]
-            play_count = post_body["play_count"]
-        except KeyError as e:
-            raise BadRequest(message="Required attribute is missing")
-        playlist_id = None
-        album_id = None
-        has_playlist = False
-        has_album = False
-        if "playlist_id" in post_body and "album_id" in post_body:
-            raise BadRequest(message="Both playlist and album is specified")
-        elif "playlist_id" in post_body:
-            playlist_id = post_body["playlist_id"]
-            has_playlist = True
-        elif "album_id" in post_body:
-            album_id = post_body["album_id"]
-            has_album = True
-        c = self.conn.cursor()
+        self.insert_plays([parse_play(post_body)])
 
-        play_values = [date, song_id, playlist_id, album_id]
+        self.commit()
 
+        return "{\"message\":\"play inserted\"}"
 
-        exists_statement = "SELECT play_count FROM play WHERE (date = ?) and (song_id = ?) and (playlist_id is ?) and (album_id is ?)"
-        c.execute(exists_statement, play_values)
-        res = to_json(c)
 
-        print("TESTING")
+    # Adds play events given as (date, song_id, playlist_id, album_id, play_count) rows.
+    # Events for the same (date, song, source) are summed first, then each key is upserted
+    # against the play_source unique index, so there is no lookup before the write.
+    def insert_plays(self, plays):
+        totals = {}
+        for date, song_id, playlist_id, album_id, play_count in plays:
+            key = (date, song_id, playlist_id, album_id)
+            totals[key] = totals.get(key, 0) + play_count
 
-        print(len(res))
+        c = self.conn.cursor()
 
-        if len(res) != 0:
-            print("Adding DUPLICATES new count is " + str(play_count))
+        play_statement = "INSERT INTO play VALUES (?, ?, ?, ?, ?) ON CONFLICT (date, song_id, ifnull(playlist_id, -1), ifnull(album_id, -1)) DO UPDATE SET play_count = play_count + excluded.play_count"
+        c.executemany(play_statement, [(key[0], count, key[1], key[2], key[3]) for key, count in totals.items()])
+        self.written.add("play")
 
-            play_statement = "UPDATE play set play_count=play_count + ? where (date = ?) and (song_id = ?) and (playlist_id is ?) and (album_id is ?)"
-            play_values = [play_count, date, song_id, playlist_id, album_id]
-        else:
 
-            play_statement = "INSERT INTO play VALUES (?, ?, ?, ?, ?)"
+    # Adds play events from the write-behind buffer (see playbuffer.py) and records the log
+    # segments they were logged to, in one transaction, so no segment is applied twice
+    def flush_plays(self, plays, segments):
+        try:
+            self.insert_plays(plays)
+            self.conn.executemany("INSERT INTO play_flush VALUES (?)", [(segment,) for segment in segments])
+            self.commit()
+        except sqlite3.Error:
+            self.rollback()
+            raise
 
-            play_values = [date, play_count, song_id, playlist_id, album_id]
 
+    # The given log segments whose plays were already added by flush_plays
+    def flushed_segments(self, segments):
+        c = self.conn.execute("SELECT segment FROM play_flush WHERE segment IN (SELECT value FROM json_each(?))",
+                              (json.dumps(segments),))
+        return {row[0] for row in c.fetchall()}
 
-        c.execute(play_statement, play_values)
 
-        self.conn.commit()
+    # Drops the records of log segments that are deleted
+    def forget_segments(self, segments):
+        self.conn.execute("DELETE FROM play_flush WHERE segment IN (SELECT value FROM json_each(?))",
+                          (json.dumps(segments),))
+        self.commit()
+
+
+    def add_plays_bulk(self, post_bodies):
+        return self.add_bulk(post_bodies, parse_play, DB.insert_plays)
 
-        return "{\"message\":\"play inserted\"}"
+
+    def add_plays_stream(self, lines, chunk_rows, chunk_ms, submit=None):
+        return self.add_stream(lines, parse_play, DB.insert_plays, chunk_rows, chunk_ms, submit=submit)
 
 
     """
@@ -313,6 +1377,9 @@ class DB:
     raise KeyNotFound() if song_id is not found
     """
     def find_song(self, song_id):
+        return self.cached("song", song_id, partial(self.load_song, song_id))
+
+    def load_song(self, song_id):
         c = self.conn.cursor()
         # Your query should fetch (song_id, name, length, artist_name, album_name) based on song_id
 
@@ -348,15 +1415,14 @@ class DB:
     """
     Returns all an album's songs
     raise KeyNotFound() if album_id not found
+    With a limit returns one page, {"items": [...], "next_cursor": ...}, after cursor
 #     """
-    def find_songs_by_album(self, album_id):
+    def find_songs_by_album(self, album_id, limit=None, cursor=None):
         c = self.conn.cursor()
         # Your query should fetch (song_id, name, length, artist name, album name) based on album_id
 
         #some tests do not include length, some do. included her.
 
-        ret = []
-
         to_find = album_id
 
 
@@ -367,50 +1433,54 @@ class DB:
             raise KeyNotFound("Album Id not found")
             return
 
+        if limit is not None:
+            return self.page_songs_by_album(c, to_find, limit, cursor)
 
-        find_statement = "SELECT distinct a.album_name FROM album a where (a.album_id = ?)"
-
-        c.execute(find_statement, (to_find,))
-
-        res = to_json(c)
-
-        album_name = res[0]["album_name"]
+        # one join for the tracklist's songs and one for all of their artists, instead of two queries per song
+        find_statement = "SELECT s.song_id, s.song_name, s.length, a.album_name FROM tracklist t join song s on (s.song_id = t.song_id) join album a on (a.album_id = t.album_id) where (t.album_id = :id) order by t.ordering, t.rowid"
+        c.execute(find_statement, {"id": to_find})
+        ret = to_json(c)
 
-
-        find_statement2 = "SELECT song_id from tracklist t where (t.album_id = :id) order by t.ordering"
+        find_statement2 = "SELECT c.song_id, c.artist_id from created c where c.song_id in (SELECT t.song_id from tracklist t where (t.album_id = :id)) order by c.song_id, c.artist_id"
         c.execute(find_statement2, {"id": to_find})
-        song_id_list = [x[0] for x in c.fetchall()]
+        artist_ids = group_ids(c)
 
-        for song_id in song_id_list:
-            to_find = song_id
-            find_statement = "SELECT distinct s.song_id, s.song_name, s.length FROM song s where (s.song_id = ?)"
-            c.execute(find_statement, (to_find,))
-            res = to_json(c)
-            res[0]["album_name"] = album_name
+        for song in ret:
+            song["artist_ids"] = list(artist_ids.get(song["song_id"], []))
 
-            find_statement2 = "SELECT artist_id from created c where (c.song_id = :id)"
-            c.execute(find_statement2, {"id": song_id})
-            res[0]["artist_ids"] = [x[0] for x in c.fetchall()]
-            res[0]["artist_ids"].sort()
+        self.conn.commit()
+        return ret
 
-            ret.append(res[0])
+    # One page of find_songs_by_album, in tracklist order (keyset on ordering, then rowid)
+    def page_songs_by_album(self, c, album_id, limit, cursor):
+        params = {"id": album_id, "limit": limit + 1}
+        after = ""
+        if cursor is not None:
+            params["ordering"], params["rowid"] = decode_cursor("songs_by_album", cursor, 2)
+            after = " and (t.ordering, t.rowid) > (:ordering, :rowid)"
+        find_statement = "SELECT s.song_id, s.song_name, s.length, a.album_name, t.ordering, t.rowid as track_rowid FROM tracklist t join song s on (s.song_id = t.song_id) join album a on (a.album_id = t.album_id) where (t.album_id = :id)" + after + " order by t.ordering, t.rowid limit :limit"
+        c.execute(find_statement, params)
+        page = to_page(to_json(c), limit, "songs_by_album", lambda song: (song["ordering"], song["track_rowid"]))
 
+        find_statement2 = "SELECT c.song_id, c.artist_id from created c where c.song_id in (SELECT value from json_each(:ids)) order by c.song_id, c.artist_id"
+        c.execute(find_statement2, {"ids": json.dumps([song["song_id"] for song in page["items"]])})
+        artist_ids = group_ids(c)
 
-
-        self.conn.commit()
-        return ret
+        for song in page["items"]:
+            del song["ordering"], song["track_rowid"]
+            song["artist_ids"] = list(artist_ids.get(song["song_id"], []))
+        return page
 
 
     """
     Returns all an artists' songs
     raise KeyNotFound() if artist_id is not found
+    With a limit returns one page, {"items": [...], "next_cursor": ...}, after cursor
     """
-    def find_songs_by_artist(self, artist_id):
+    def find_songs_by_artist(self, artist_id, limit=None, cursor=None):
         c = self.conn.cursor()
 
 
-        ret = []
-
         to_find = artist_id
 
         verify = "SELECT artist_id from artist a where (a.artist_id = :id)"
@@ -420,37 +1490,51 @@ class DB:
             raise KeyNotFound("Artist Id not found")
             return
 
+        if limit is not None:
+            return self.page_songs_by_artist(c, to_find, limit, cursor)
 
-        find_statement2 = "SELECT song_id from created c where (c.artist_id = :id)"
-        c.execute(find_statement2, {"id": to_find})
-        song_id_list = [x[0] for x in c.fetchall()]
-        song_id_list.sort() #song_ids sorted ascending
-
+        # one join for the artist's songs and one for all of their artists, instead of two queries per song
+        find_statement = "SELECT s.song_id, s.song_name, s.length FROM created c join song s on (s.song_id = c.song_id) where (c.artist_id = :id) order by s.song_id"
+        c.execute(find_statement, {"id": to_find})
+        ret = to_json(c) #song_ids sorted ascending
 
-        for song_id in song_id_list:
-            to_find = song_id
-            find_statement = "SELECT distinct s.song_id, s.song_name, s.length FROM song s where (s.song_id = ?)"
-            c.execute(find_statement, (to_find,))
-            res = to_json(c)
-
-            find_statement2 = "SELECT artist_id from created c where (c.song_id = :id)"
-            c.execute(find_statement2, {"id": song_id})
-            res[0]["artist_ids"] = [x[0] for x in c.fetchall()]
-            res[0]["artist_ids"].sort()
-
-            ret.append(res[0])
+        find_statement2 = "SELECT c.song_id, c.artist_id from created c where c.song_id in (SELECT c2.song_id from created c2 where (c2.artist_id = :id)) order by c.song_id, c.artist_id"
+        c.execute(find_statement2, {"id": to_find})
+        artist_ids = group_ids(c)
 
-
- 
+        for song in ret:
+            song["artist_ids"] = list(artist_ids.get(song["song_id"], []))
 
         self.conn.commit()
         return ret
 
+    # One page of find_songs_by_artist (keyset on song_id, along the created primary key)
+    def page_songs_by_artist(self, c, artist_id, limit, cursor):
+        params = {"id": artist_id, "limit": limit + 1}
+        after = ""
+        if cursor is not None:
+            params["after"], = decode_cursor("songs_by_artist", cursor, 1)
+            after = " and c.song_id > :after"
+        find_statement = "SELECT s.song_id, s.song_name, s.length FROM created c join song s on (s.song_id = c.song_id) where (c.artist_id = :id)" + after + " order by c.song_id limit :limit"
+        c.execute(find_statement, params)
+        page = to_page(to_json(c), limit, "songs_by_artist", lambda song: (song["song_id"],))
+
+        find_statement2 = "SELECT c.song_id, c.artist_id from created c where c.song_id in (SELECT value from json_each(:ids)) order by c.song_id, c.artist_id"
+        c.execute(find_statement2, {"ids": json.dumps([song["song_id"] for song in page["items"]])})
+        artist_ids = group_ids(c)
+
+        for song in page["items"]:
+            song["artist_ids"] = list(artist_ids.get(song["song_id"], []))
+        return page
+
     """
     Returns a album's info
     raise KeyNotFound() if album_id is not found
     """
     def find_album(self, album_id):
+        return self.cached("album", album_id, partial(self.load_album, album_id))
+
+    def load_album(self, album_id):
         c = self.conn.cursor()
 
         to_find = album_id
@@ -473,7 +1557,7 @@ class DB:
         res[0]["artist_ids"].sort()
 
 
-        find_statement3 = "SELECT song_id from tracklist t where (t.album_id = :id) order by t.ordering"
+        find_statement3 = "SELECT song_id from tracklist t where (t.album_id = :id) order by t.ordering, t.rowid"
         c.execute(find_statement3, {"id": to_find})
         res[0]["song_ids"] = [x[0] for x in c.fetchall()] 
 
@@ -484,12 +1568,11 @@ class DB:
     Returns a album's info
     raise KeyNotFound() if artist_id is not found 
     if artist exist, but there are no albums then return an empty result (from to_json)
+    With a limit returns one page, {"items": [...], "next_cursor": ...}, after cursor
     """
-    def find_album_by_artist(self, artist_id):
+    def find_album_by_artist(self, artist_id, limit=None, cursor=None):
         c = self.conn.cursor()
 
-        ret = []
-
         to_find = artist_id
 
 
@@ -500,32 +1583,41 @@ class DB:
             raise KeyNotFound("Artist Id not found")
             return
 
+        if limit is not None:
+            return self.page_album_by_artist(c, to_find, limit, cursor)
 
-        find_statement2 = "SELECT album_id from release r where (r.artist_id = :id)"
-        c.execute(find_statement2, {"id": to_find})
-        album_id_list = [x[0] for x in c.fetchall()]
-        album_id_list.sort() #song_ids sorted ascending
-
-        print("album id list is ", flush=True)
-        print(album_id_list)
-
-
-        for album_id in album_id_list:
-            to_find = album_id
-            find_statement = "SELECT distinct a.album_id, a.album_name, a.release_year FROM album a where (a.album_id = ?)"
-            c.execute(find_statement, (to_find,))
-            res = to_json(c)
+        # one join for the artist's albums and one for all of their artists, instead of two queries per album
+        find_statement = "SELECT a.album_id, a.album_name, a.release_year FROM release r join album a on (a.album_id = r.album_id) where (r.artist_id = :id) order by a.album_id"
+        c.execute(find_statement, {"id": to_find})
+        ret = to_json(c) #album_ids sorted ascending
 
-            find_statement2 = "SELECT artist_id from release r where (r.album_id = :id)"
-            c.execute(find_statement2, {"id": to_find})
-            res[0]["artist_ids"] = [x[0] for x in c.fetchall()]
-            res[0]["artist_ids"].sort()
-
-            ret.append(res[0])
+        find_statement2 = "SELECT r.album_id, r.artist_id from release r where r.album_id in (SELECT r2.album_id from release r2 where (r2.artist_id = :id)) order by r.album_id, r.artist_id"
+        c.execute(find_statement2, {"id": to_find})
+        artist_ids = group_ids(c)
 
- 
+        for album in ret:
+            album["artist_ids"] = list(artist_ids.get(album["album_id"], []))
 
         return ret
+
+    # One page of find_album_by_artist (keyset on album_id, along the release_artist index)
+    def page_album_by_artist(self, c, artist_id, limit, cursor):
+        params = {"id": artist_id, "limit": limit + 1}
+        after = ""
+        if cursor is not None:
+            params["after"], = decode_cursor("album_by_artist", cursor, 1)
+            after = " and r.album_id > :after"
+        find_statement = "SELECT a.album_id, a.album_name, a.release_year FROM release r join album a on (a.album_id = r.album_id) where (r.artist_id = :id)" + after + " order by r.album_id limit :limit"
+        c.execute(find_statement, params)
+        page = to_page(to_json(c), limit, "album_by_artist", lambda album: (album["album_id"],))
+
+        find_statement2 = "SELECT r.album_id, r.artist_id from release r where r.album_id in (SELECT value from json_each(:ids)) order by r.album_id, r.artist_id"
+        c.execute(find_statement2, {"ids": json.dumps([album["album_id"] for album in page["items"]])})
+        artist_ids = group_ids(c)
+
+        for album in page["items"]:
+            album["artist_ids"] = list(artist_ids.get(album["album_id"], []))
+        return page
    
 
     """
@@ -533,6 +1625,9 @@ class DB:
     raise KeyNotFound() if artist_id is not found 
     """
     def find_artist(self, artist_id):
+        return self.cached("artist", artist_id, partial(self.load_artist, artist_id))
+
+    def load_artist(self, artist_id):
         c = self.conn.cursor()
         to_find = artist_id
 
@@ -560,7 +1655,8 @@ class DB:
 
         to_find = artist_id
 
-        find_statement = "SELECT a.artist_id, AVG(s.length) as avg_length FROM song s join created c on (s.song_id = c.song_id) join artist a on (a.artist_id = c.artist_id) where (a.artist_id = ?) "
+        # artist_stats is kept current by triggers on created/song (see schema/migrations)
+        find_statement = "SELECT a.artist_id, st.total_length * 1.0 / st.song_count as avg_length FROM artist_stats st join artist a on (a.artist_id = st.artist_id) where (st.artist_id = ?) "
 
         c.execute(find_statement, (to_find,))
 
@@ -568,12 +1664,11 @@ class DB:
         res = to_json(c)
 
         if len(res) == 0:
-            raise KeyNotFound("artist Id not found")
-            return
- 
-        else:  
-            self.conn.commit()
-            return res
+            # same answer the aggregate gave for an artist without songs
+            res = [{"artist_id": None, "avg_length": None}]
+
+        self.conn.commit()
+        return res
 
     """
     Returns the number of singles an artist has (artist_id, cnt_single)
@@ -599,16 +1694,21 @@ class DB:
 
     """
     Returns top (n=num_artists) artists based on total length of songs
+    With stream=True returns an iterator of the rows, fetched as they are consumed
     """
-    def top_length(self, num_artists):
+    def top_length(self, num_artists, stream=False):
         c = self.conn.cursor()
 
         limit = num_artists
 
-        find_statement = "SELECT distinct a.artist_id, sum(s.length) as total_length FROM artist a join created c on (a.artist_id = c.artist_id) join song s on (s.song_id = c.song_id) group by a.artist_id order by total_length desc limit ?  "
+        # walks the artist_stats_length index, so only the top rows are read
+        find_statement = "SELECT st.artist_id, st.total_length FROM artist_stats st join artist a on (a.artist_id = st.artist_id) order by st.total_length desc, st.artist_id limit ?  "
 
         c.execute(find_statement, (limit,))
 
+        if stream:
+            return non_empty(iter_json(c), "no artists found")
+
         res = to_json(c)
 
         if len(res) == 0:
@@ -623,18 +1723,26 @@ class DB:
     """
     Returns an array/list of album_ids where the album is by one artist
     and all songs are by the same single artist.
+    With a limit returns one page, {"items": [...], "next_cursor": ...}, after cursor
     """
-    def solo_albums(self):
+    def solo_albums(self, limit=None, cursor=None):
         c = self.conn.cursor()
 
-        find_statement = "SELECT r.album_id from release r where r.album_id not in (SELECT t.album_id as non_solo from tracklist as t inner join created as c on (t.song_id = c.song_id) inner join release as r on (r.album_id = t.album_id) group by r.album_id, c.song_id having (count(*)!=1 or (r.artist_id != c.artist_id)))"
+        # an album is solo unless one of its tracks has a creator other than one of its release
+        # artists (checked per album through the keys, instead of grouping every track first)
+        solo = "not exists (SELECT 1 from tracklist t join created c on (c.song_id = t.song_id) join release r2 on (r2.album_id = t.album_id) where t.album_id = r.album_id and r2.artist_id != c.artist_id)"
+
+        if limit is not None:
+            return self.page_solo_albums(c, solo, limit, cursor)
+
+        # each album once, like page_solo_albums (an album released by several artists has a
+        # release row per artist)
+        find_statement = "SELECT distinct r.album_id from release r where " + solo + " order by r.album_id"
 
         c.execute(find_statement, ())
 
         res = [x[0] for x in c.fetchall()]
 
-        res.sort()
-
         if len(res) == 0:
             raise KeyNotFound("no albums found")
             return
@@ -643,6 +1751,20 @@ class DB:
         self.conn.commit()
         return res
 
+    # One page of solo_albums, each album once (keyset on album_id, along the release primary key)
+    def page_solo_albums(self, c, solo, limit, cursor):
+        params = {"limit": limit + 1}
+        after = ""
+        if cursor is not None:
+            params["after"], = decode_cursor("solo_albums", cursor, 1)
+            after = " and r.album_id > :after"
+        find_statement = "SELECT distinct r.album_id from release r where " + solo + after + " order by r.album_id limit :limit"
+        c.execute(find_statement, params)
+        page = to_page([x[0] for x in c.fetchall()], limit, "solo_albums", lambda album_id: (album_id,))
+        if cursor is None and len(page["items"]) == 0:
+            raise KeyNotFound("no albums found")
+        return page
+
 
 
     """
@@ -653,7 +1775,8 @@ class DB:
     def top_song(self, check_date):
         c = self.conn.cursor()
 
-        find_statement = "SELECT p.song_id as song_id, SUM(p.play_count) as play_count from play p where (p.date = ?) group by p.song_id order by play_count desc limit 1"
+        # daily_song_plays is kept current by triggers on play; this is one seek on daily_song_plays_top
+        find_statement = "SELECT d.song_id as song_id, d.total_plays as play_count from daily_song_plays d where (d.date = ?) order by d.total_plays desc, d.song_id asc limit 1"
         c.execute(find_statement, (check_date,))
         res = to_json(c)
         
@@ -682,36 +1805,10 @@ class DB:
     def top_source(self, song_id, check_date):
         c = self.conn.cursor()
 
-        find_statement = "SELECT play_count, album_id, playlist_id FROM play p where (p.date = ?) and (p.song_id = ?)"
-        c.execute(find_statement, (check_date,song_id,))
-        res = to_json(c)
-
-        find_statement = "SELECT (MAX(play_count)) as play_count FROM play p where playlist_id is not null and (p.date = ?) and (p.song_id = ?)"
-        c.execute(find_statement, (check_date,song_id,))
-        res = to_json(c)
-        playlist = res[0]["play_count"] 
-
-        find_statement = "SELECT (MAX(play_count)) as play_count FROM play p where album_id is not null and (p.date = ?) and (p.song_id = ?)"
-        c.execute(find_statement, (check_date,song_id,))
-        res = to_json(c)
-        album = res[0]["play_count"] 
-
-        find_statement = "SELECT (MAX(play_count)) as play_count FROM play p where album_id is null and playlist_id is null and (p.date = ?) and (p.song_id = ?)"
+        # sums each source's events, then ranks the sources; every source tied for the top is returned
+        find_statement = "SELECT playlist_id, album_id, play_count FROM (SELECT p.playlist_id, p.album_id, SUM(p.play_count) as play_count, RANK() OVER (ORDER BY SUM(p.play_count) desc) as source_rank FROM play p where (p.date = ?) and (p.song_id = ?) group by ifnull(p.playlist_id, -1), ifnull(p.album_id, -1)) where source_rank = 1 order by playlist_id is null, playlist_id, album_id is null, album_id"
         c.execute(find_statement, (check_date,song_id,))
-        res = to_json(c)
-        none = res[0]["play_count"] 
-
-        options = [playlist, album, none]
-
-        (max_val,index) = max((v,i) for i,v in enumerate(options) if v is not None)
-
-        find_statement = "SELECT playlist_id, album_id, play_count FROM play p where play_count = ? and (p.date = ?) and (p.song_id = ?)"
-        c.execute(find_statement, (max_val,check_date,song_id,))
-        res = to_json(c)
-        if res[0]['playlist_id'] is None:
-            del(res[0]['playlist_id'])
-        if res[0]['album_id'] is None:
-            del (res[0]['album_id'])
+        res = drop_null_sources(to_json(c))
 
         if len(res) == 0:
             raise KeyNotFound("song Id not found")
@@ -722,6 +1819,27 @@ class DB:
             return res
 
 
+    """
+    For a given date return the top source (as in top_source) of every song played that day,
+    ordered by song_id. Expects (song_id, play_count, playlist_id / album_id / neither) objects
+    With stream=True returns an iterator of the rows, fetched as they are consumed
+    """
+    def top_source_all(self, check_date, stream=False):
+        c = self.conn.cursor()
+
+        find_statement = "SELECT song_id, playlist_id, album_id, play_count FROM (SELECT p.song_id, p.playlist_id, p.album_id, SUM(p.play_count) as play_count, RANK() OVER (PARTITION BY p.song_id ORDER BY SUM(p.play_count) desc) as source_rank FROM play p where (p.date = ?) group by p.song_id, ifnull(p.playlist_id, -1), ifnull(p.album_id, -1)) where source_rank = 1 order by song_id, playlist_id is null, playlist_id, album_id is null, album_id"
+        c.execute(find_statement, (check_date,))
+        if stream:
+            return non_empty(map(drop_null_source, iter_json(c)), "Invalid date or date format")
+        res = drop_null_sources(to_json(c))
+
+        if len(res) == 0:
+            raise KeyNotFound("Invalid date or date format")
+            return
+
+        else:
+            self.conn.commit()
+            return res
 
 
 
@@ -735,12 +1853,10 @@ class DB:
         c = self.conn.cursor()
 
         #one song can have multiple artists from the same country--as per Ed, we only count them once
+        #daily_country_plays is kept current by triggers (see schema/migrations), this is one index seek
+        #artists without a country are counted under '', answered as null
 
-        create_statement = "CREATE TEMPORARY TABLE duplicates AS SELECT c.song_id, COUNT(c.artist_id) as artist_count from created c natural join artist a group by c.song_id, a.artist_country having COUNT(c.artist_id) > 1"
-
-        c.execute(create_statement, ())
-
-        find_statement = "SELECT a.artist_country as country, SUM(p.play_count/IFNULL(d.artist_count, 1)) as play_count from (play p natural join created c natural join artist a left join duplicates d on d.song_id = p.song_id) where (p.date = ?) group by a.artist_country order by play_count desc limit 1"
+        find_statement = "SELECT nullif(d.country, '') as country, d.total_plays as play_count from daily_country_plays d where (d.date = ?) order by d.total_plays desc, d.country asc limit 1"
 
 
         c.execute(find_statement, (check_date,))
@@ -0,0 +1,66 @@
+import math
+import re
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+"""
+JSON provider that encodes responses with orjson when it is installed, falling back to the
+stdlib encoder (Flask's default) whenever the two could differ, so the bytes sent are the
+same either way. orjson is only tried for compact output with ensure_ascii, and its result
+is thrown away when it:
+  - fails (types orjson does not encode the way Flask's default does, like dates, Decimal,
+    subclasses and non string keys, are passed to a default that refuses them),
+  - is not pure ASCII (the stdlib escapes those characters) or holds DEL (\\x7f, escaped too),
+  - may hold a float the stdlib writes with an exponent (1e+16, 1e-05),
+  - has a null that could be a NaN/Infinity (the stdlib writes NaN, orjson null).
+"""
+
+# an e right after a digit (1e16); starts with the literal so the search can skip ahead
+EXPONENT = re.compile(rb"e(?<=\de)")
+
+
+def refuse(obj):
+    raise TypeError("not encoded by the fast path")
+
+
+# True if obj holds a NaN or infinite float anywhere
+def has_non_finite(obj):
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(has_non_finite(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(has_non_finite(v) for v in obj)
+    return False
+
+
+# Encodes obj compactly with orjson; None when the stdlib output could be different
+def fast_dumps(obj, sort_keys):
+    if orjson is None:
+        return None
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_SUBCLASS
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    try:
+        out = orjson.dumps(obj, default=refuse, option=option)
+    except TypeError:
+        return None
+    if not out.isascii() or b"\x7f" in out or b"0.0000" in out or EXPONENT.search(out):
+        return None
+    if b"null" in out and has_non_finite(obj):
+        return None
+    return out.decode("ascii")
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        if self.ensure_ascii and kwargs == {"separators": (",", ":")}:
+            out = fast_dumps(obj, self.sort_keys)
+            if out is not None:
+                return out
+        return super().dumps(obj, **kwargs)
@@ -0,0 +1,106 @@
+import threading
+import time
+
+
+"""
+Request metrics in the Prometheus text exposition format, without a client library.
+Per route (the url rule, e.g. /analytics/playcount/top_country/<date_string>) and method:
+request counts by status code, latency and DB time histograms, and in-flight requests.
+DB time is the time spent in statements, as recorded by the connections' QueryLog.
+"""
+
+
+# upper bounds (seconds) of the histogram buckets
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        bucket = 0
+        while bucket < len(BUCKETS) and value > BUCKETS[bucket]:
+            bucket += 1
+        self.counts[bucket] += 1
+        self.sum += value
+
+    # the exposition lines of this histogram (cumulative buckets, then sum and count)
+    def lines(self, name, labels):
+        out = []
+        total = 0
+        for bound, count in zip(BUCKETS + ["+Inf"], self.counts):
+            total += count
+            out.append("%s_bucket{%s,le=\"%s\"} %d" % (name, labels, bound, total))
+        out.append("%s_sum{%s} %r" % (name, labels, self.sum))
+        out.append("%s_count{%s} %d" % (name, labels, total))
+        return out
+
+
+# Escapes a label value for the exposition format
+def label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # (method, route, status) -> count
+        self.requests = {}
+        # (method, route) -> Histogram / in flight count
+        self.latency = {}
+        self.db_time = {}
+        self.in_flight = {}
+
+    def begin(self, method, route):
+        with self.lock:
+            self.in_flight[(method, route)] = self.in_flight.get((method, route), 0) + 1
+
+    def end(self, method, route):
+        with self.lock:
+            self.in_flight[(method, route)] -= 1
+
+    # Records a finished request; db_seconds is None when statements are not being timed
+    def observe(self, method, route, status, seconds, db_seconds=None):
+        key = (method, route)
+        with self.lock:
+            self.requests[(method, route, status)] = self.requests.get((method, route, status), 0) + 1
+            if key not in self.latency:
+                self.latency[key] = Histogram()
+            self.latency[key].observe(seconds)
+            if db_seconds is not None:
+                if key not in self.db_time:
+                    self.db_time[key] = Histogram()
+                self.db_time[key].observe(db_seconds)
+
+    # All metrics in the text exposition format
+    def render(self):
+        with self.lock:
+            lines = ["# HELP process_start_time_seconds Start time of the process since unix epoch in seconds.",
+                     "# TYPE process_start_time_seconds gauge",
+                     "process_start_time_seconds %r" % self.started,
+                     "# HELP http_requests_total Requests handled, by route, method and status code.",
+                     "# TYPE http_requests_total counter"]
+            for (method, route, status), count in sorted(self.requests.items()):
+                lines.append("http_requests_total{method=\"%s\",route=\"%s\",status=\"%s\"} %d"
+                             % (label(method), label(route), status, count))
+            lines += ["# HELP http_requests_in_flight Requests being handled now.",
+                      "# TYPE http_requests_in_flight gauge"]
+            for (method, route), count in sorted(self.in_flight.items()):
+                lines.append("http_requests_in_flight{method=\"%s\",route=\"%s\"} %d"
+                             % (label(method), label(route), count))
+            lines += ["# HELP http_request_duration_seconds Time to handle a request, until its response is built.",
+                      "# TYPE http_request_duration_seconds histogram"]
+            for (method, route), histogram in sorted(self.latency.items()):
+                lines += histogram.lines("http_request_duration_seconds",
+                                         "method=\"%s\",route=\"%s\"" % (label(method), label(route)))
+            lines += ["# HELP http_request_db_seconds Time a request spent running SQL statements.",
+                      "# TYPE http_request_db_seconds histogram"]
+            for (method, route), histogram in sorted(self.db_time.items()):
+                lines += histogram.lines("http_request_db_seconds",
+                                         "method=\"%s\",route=\"%s\"" % (label(method), label(route)))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,319 @@
+import argparse
+import datetime
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import db as db_module
+from db import DB, ConnectionManager, EntityCache, KeyNotFound, BadRequest
+from fastjson import FastJSONProvider, orjson
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "client"))
+import generate
+
+
+"""
+Times the DB methods directly (no Flask, no HTTP) on databases of several sizes, built with
+schema/create.sql plus the migrations and filled by client/generate.py. Reports ops/sec per
+method and size, and how the cost per call grows with the data (the exponent of
+time ~ size^k between the smallest and the largest size: ~0 flat, ~1 linear).
+With --rows it also times building and encoding the rows of the largest find_songs_by_artist
+result, with the original to_json and Flask's default encoder against the current ones.
+The JSON report can be stored and later runs compared against it:
+    python microbench.py --sizes 1000,10000,100000 -o base.json
+    python microbench.py --sizes 1000,10000,100000 --compare base.json
+"""
+
+
+class BenchError(Exception):
+    def __init__(self, message=None):
+        Exception.__init__(self)
+        if message:
+            self.message = message
+        else:
+            self.message = "Bench Error"
+
+
+# What a data set of the given number of songs holds
+class DataSet:
+    def __init__(self, songs, days):
+        self.songs = songs
+        self.artists = max(songs // 10, 1)
+        self.playlists = max(songs // 20, 1)
+        self.plays = songs * 10
+        self.days = days
+        self.start = datetime.date(2020, 1, 1)
+        self.albums = 0
+        # ids the write cases hand out, above anything already stored
+        self.next_id = 0
+
+    def generate_args(self, out):
+        return ["-o", out, "-f", "ndjson", "--songs", str(self.songs), "--artists", str(self.artists),
+                "--playlists", str(self.playlists), "--plays", str(self.plays), "--days", str(self.days),
+                "--start-date", self.start.isoformat()]
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def song(self, rng):
+        return rng.randint(1, self.songs)
+
+    def artist(self, rng):
+        return rng.randint(1, self.artists)
+
+    def album(self, rng):
+        return rng.randint(1, max(self.albums, 1))
+
+    def date(self, rng):
+        return self.start + datetime.timedelta(days=rng.randrange(self.days))
+
+    def play(self, rng):
+        return {"date": self.date(rng).isoformat(), "song_id": self.song(rng), "play_count": 1}
+
+
+# name -> (writes?, call(db, data, rng)); reads run first, on the generated data only
+CASES = {
+    "find_song": (False, lambda db, d, rng: db.find_song(d.song(rng))),
+    "find_songs_by_album": (False, lambda db, d, rng: db.find_songs_by_album(d.album(rng))),
+    "find_songs_by_artist": (False, lambda db, d, rng: db.find_songs_by_artist(d.artist(rng))),
+    "find_album": (False, lambda db, d, rng: db.find_album(d.album(rng))),
+    "find_album_by_artist": (False, lambda db, d, rng: db.find_album_by_artist(d.artist(rng))),
+    "find_artist": (False, lambda db, d, rng: db.find_artist(d.artist(rng))),
+    "avg_song_length": (False, lambda db, d, rng: db.avg_song_length(d.artist(rng))),
+    "cnt_singles": (False, lambda db, d, rng: db.cnt_singles(d.artist(rng))),
+    "top_length": (False, lambda db, d, rng: db.top_length(10)),
+    "solo_albums": (False, lambda db, d, rng: db.solo_albums()),
+    "top_song": (False, lambda db, d, rng: db.top_song(d.date(rng))),
+    "top_source": (False, lambda db, d, rng: db.top_source(d.song(rng), d.date(rng))),
+    "top_source_all": (False, lambda db, d, rng: db.top_source_all(d.date(rng))),
+    "top_country": (False, lambda db, d, rng: db.top_country(d.date(rng))),
+    "add_artist": (True, lambda db, d, rng: db.add_artist(
+        {"artist_id": d.new_id(), "artist_name": "bench", "country": "US"})),
+    "add_song_ms2": (True, lambda db, d, rng: db.add_song_ms2(
+        {"song_id": d.new_id(), "song_name": "bench", "length": 200, "artist_ids": [d.artist(rng)]})),
+    "add_album": (True, lambda db, d, rng: db.add_album(
+        {"album_id": d.new_id(), "album_name": "bench", "release_year": 2000, "artist_ids": [d.artist(rng)],
+         "song_ids": [d.song(rng) for _ in range(10)]})),
+    "add_playlist": (True, lambda db, d, rng: db.add_playlist(
+        {"playlist_id": d.new_id(), "playlist_name": "bench", "author_name": "bench",
+         "song_ids": [d.song(rng) for _ in range(20)]})),
+    "add_play": (True, lambda db, d, rng: db.add_play(d.play(rng))),
+    "add_plays_bulk_100": (True, lambda db, d, rng: db.add_plays_bulk([d.play(rng) for _ in range(100)])),
+}
+
+
+# Creates (or reuses) the database file for a data set and fills it from generated NDJSON
+def build(data, work, reuse, seed):
+    path = os.path.join(work, "bench_%d.db" % data.songs)
+    ndjson = os.path.join(work, "data_%d" % data.songs)
+    exists = reuse and os.path.exists(path)
+    connections = ConnectionManager(path)
+    db = DB(connections.connect())
+    if not exists:
+        generate.generate(generate.make_parser().parse_args(data.generate_args(ndjson) + ["--seed", str(seed)]))
+        db.create_db(os.path.join(HERE, "schema", "create.sql"))
+        db.migrate(os.path.join(HERE, "schema", "migrations"))
+        start = time.perf_counter()
+        for name, load in [("artists", db.add_artists_stream), ("songs", db.add_songs_stream),
+                           ("albums", db.add_albums_stream), ("playlists", db.add_playlists_stream),
+                           ("plays", db.add_plays_stream)]:
+            with open(os.path.join(ndjson, "ndjson", name + ".ndjson"), "rb") as f:
+                res = load(f, 20000, 1000)
+            if res.get("failed_count"):
+                raise BenchError("Loading %s failed: %s" % (name, res["failed"][:3]))
+        print("Loaded %d songs in %.1fs" % (data.songs, time.perf_counter() - start), flush=True)
+        db.conn.execute("ANALYZE")
+    data.albums = db.conn.execute("SELECT count(*) FROM album").fetchone()[0]
+    # a reused database keeps the rows earlier runs' write cases added
+    data.next_id = max(data.next_id, db.conn.execute(
+        "SELECT max(ifnull((SELECT max(artist_id) FROM artist), 0), ifnull((SELECT max(song_id) FROM song), 0),"
+        " ifnull((SELECT max(album_id) FROM album), 0), ifnull((SELECT max(playlist_id) FROM playlist), 0))").fetchone()[0])
+    return connections, db
+
+
+# Calls one case until the time budget (or max_ops) is spent; returns its timings
+def time_case(db, data, call, writes, rng, budget, min_ops, max_ops):
+    def once():
+        try:
+            call(db, data, rng)
+        except (KeyNotFound, BadRequest):
+            pass
+        if writes:
+            db.commit()
+
+    once()  # warm up the statement cache and pages
+    ops = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while ops < max_ops and (ops < min_ops or elapsed < budget):
+        once()
+        ops += 1
+        elapsed = time.perf_counter() - start
+    return {"ops": ops, "seconds": elapsed, "ops_per_sec": ops / elapsed, "mean_us": elapsed / ops * 1e6}
+
+
+# to_json as it was before header caching, for the --rows comparison
+def legacy_to_json(cursor):
+    results = cursor.fetchall()
+    headers = [d[0] for d in cursor.description]
+    return [dict(zip(headers, row)) for row in results]
+
+
+# Times find_songs_by_artist plus encoding its response for the artist with the most songs,
+# the legacy way and the current way; the two must give the same bytes
+def time_rows(db, budget):
+    artist_id = db.conn.execute("SELECT artist_id FROM created GROUP BY artist_id ORDER BY count(*) desc, artist_id LIMIT 1").fetchone()[0]
+    app = Flask("microbench")
+    paths = {"legacy": (legacy_to_json, DefaultJSONProvider(app)), "current": (db_module.to_json, FastJSONProvider(app))}
+    outputs = {}
+    res = {"artist_id": artist_id, "orjson": orjson is not None}
+    for name, (materialize, provider) in paths.items():
+        current = db_module.to_json
+        db_module.to_json = materialize
+        try:
+            def once():
+                return provider.dumps(db.find_songs_by_artist(artist_id), separators=(",", ":"))
+            outputs[name] = once()
+            ops = 0
+            start = time.perf_counter()
+            elapsed = 0.0
+            while ops < 3 or elapsed < budget:
+                once()
+                ops += 1
+                elapsed = time.perf_counter() - start
+        finally:
+            db_module.to_json = current
+        res["rows"] = len(db.find_songs_by_artist(artist_id))
+        res[name + "_rows_per_sec"] = res["rows"] * ops / elapsed
+    if outputs["legacy"] != outputs["current"]:
+        raise BenchError("Fast path output differs from the legacy output")
+    res["speedup"] = res["current_rows_per_sec"] / res["legacy_rows_per_sec"]
+    return res
+
+
+def run_bench(cfg):
+    sizes = sorted(int(s) for s in cfg.sizes.split(","))
+    names = list(CASES) if not cfg.cases else cfg.cases.split(",")
+    unknown = [n for n in names if n not in CASES]
+    if unknown:
+        raise BenchError("Unknown case(s) %s" % ", ".join(unknown))
+    # reads first, so they only see the generated data
+    names.sort(key=lambda n: CASES[n][0])
+    work = cfg.work or tempfile.mkdtemp(prefix="microbench")
+    os.makedirs(work, exist_ok=True)
+
+    results = {name: {} for name in names}
+    rows = {}
+    for size in sizes:
+        data = DataSet(size, cfg.days)
+        connections, db = build(data, work, cfg.reuse, cfg.seed)
+        if cfg.cache:
+            db.cache = EntityCache()
+        try:
+            for name in names:
+                writes, call = CASES[name]
+                r = time_case(db, data, call, writes, random.Random(cfg.seed), cfg.time, cfg.min_ops, cfg.max_ops)
+                results[name][str(size)] = r
+                print("%-22s %8d songs %12.1f ops/s %12.1f us" % (name, size, r["ops_per_sec"], r["mean_us"]), flush=True)
+            if cfg.rows:
+                rows[str(size)] = time_rows(db, cfg.time)
+        finally:
+            connections.close_all()
+
+    scaling = {}
+    if len(sizes) > 1:
+        small, large = str(sizes[0]), str(sizes[-1])
+        for name, by_size in results.items():
+            ratio = by_size[large]["mean_us"] / by_size[small]["mean_us"]
+            scaling[name] = math.log(ratio) / math.log(sizes[-1] / sizes[0])
+    return {
+        "config": {"sizes": sizes, "days": cfg.days, "seed": cfg.seed, "time": cfg.time, "cache": cfg.cache},
+        "results": results,
+        "scaling": scaling,
+        "rows": rows,
+    }
+
+
+def print_report(report):
+    sizes = [str(s) for s in report["config"]["sizes"]]
+    print("%-22s" % "ops/sec" + "".join("%14s" % ("%s songs" % s) for s in sizes) + "%10s" % "scaling")
+    for name, by_size in report["results"].items():
+        scaling = report["scaling"].get(name)
+        print("%-22s" % name + "".join("%14.1f" % by_size[s]["ops_per_sec"] for s in sizes)
+              + ("%10.2f" % scaling if scaling is not None else ""))
+    for size, r in report.get("rows", {}).items():
+        print("find_songs_by_artist(%d), %d rows at %s songs: legacy %.0f rows/s, current %.0f rows/s (%.2fx, orjson %s)"
+              % (r["artist_id"], r["rows"], size, r["legacy_rows_per_sec"], r["current_rows_per_sec"], r["speedup"],
+                 "on" if r["orjson"] else "off"))
+
+
+# Prints the ops/sec change of every (method, size) also in baseline; returns those slower than threshold
+def compare(report, baseline, threshold):
+    regressions = []
+    print("%-22s %12s %12s %12s %10s" % ("method", "songs", "baseline", "now", "change"))
+    for name, by_size in report["results"].items():
+        for size, r in by_size.items():
+            b = baseline["results"].get(name, {}).get(size)
+            if not b:
+                continue
+            change = r["ops_per_sec"] / b["ops_per_sec"] - 1.0
+            print("%-22s %12s %12.1f %12.1f %+9.1f%%" % (name, size, b["ops_per_sec"], r["ops_per_sec"], change * 100))
+            if -change > threshold:
+                regressions.append("%s@%s" % (name, size))
+    for size, r in report.get("rows", {}).items():
+        b = baseline.get("rows", {}).get(size)
+        if not b:
+            continue
+        change = r["current_rows_per_sec"] / b["current_rows_per_sec"] - 1.0
+        print("%-22s %12s %12.1f %12.1f %+9.1f%%" % ("rows/sec", size, b["current_rows_per_sec"], r["current_rows_per_sec"], change * 100))
+        if -change > threshold:
+            regressions.append("rows@%s" % size)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", help="Comma separated data set sizes, in songs (default 1000,10000,100000)",
+                        default="1000,10000,100000")
+    parser.add_argument("--cases", help="Comma separated methods to time (default all)")
+    parser.add_argument("--days", help="Days of play history in each data set (default 30)", default=30, type=int)
+    parser.add_argument("-t", "--time", help="Seconds to spend on each method and size (default 0.5)",
+                        default=0.5, type=float)
+    parser.add_argument("--min-ops", dest="min_ops", help="Least calls per method and size (default 3)",
+                        default=3, type=int)
+    parser.add_argument("--max-ops", dest="max_ops", help="Most calls per method and size (default 100000)",
+                        default=100000, type=int)
+    parser.add_argument("--rows", help="Also time row building and JSON encoding, legacy against current",
+                        action="store_true")
+    parser.add_argument("--cache", help="Put the entity cache in front of the find_ methods", action="store_true")
+    parser.add_argument("--work", help="Folder for the databases (default: a new temp folder)")
+    parser.add_argument("--reuse", help="Reuse databases already in --work (write cases keep adding to them)",
+                        action="store_true")
+    parser.add_argument("--seed", help="Random seed (default 1)", default=1, type=int)
+    parser.add_argument("-o", "--out", help="Write the JSON report here")
+    parser.add_argument("--compare", help="Baseline JSON report to compare against")
+    parser.add_argument("--threshold", help="Relative ops/sec drop that fails the compare (default 0.2)",
+                        default=0.2, type=float)
+    config = parser.parse_args()
+    try:
+        report = run_bench(config)
+        print_report(report)
+        if config.out:
+            with open(config.out, "w") as out:
+                json.dump(report, out, indent=1)
+        if config.compare:
+            with open(config.compare) as baseline_file:
+                regressions = compare(report, json.load(baseline_file), config.threshold)
+            if regressions:
+                print("Regressed: %s" % ", ".join(regressions))
+                sys.exit(1)
+    except BenchError as e:
+        print("BenchError: %s" % e.message)
+        sys.exit(2)
@@ -0,0 +1,215 @@
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+"""
+Write-behind buffer for single play events (POST /playcount with PLAY_BUFFER set).
+Events are folded into totals per (date, song_id, playlist_id, album_id), and a background
+thread adds the totals with DB.flush_plays in one transaction every flush_ms, or as soon as
+max_keys keys are waiting, instead of one transaction per event.
+With a log folder every event is appended (and fsynced) to the open log segment before it is
+acknowledged. Each flush closes the segment and records its name in the flush's transaction,
+so on the next start (recover) only segments whose plays never made it in are replayed.
+Readers call sync(date) first, which flushes if events of that date are still waiting.
+A log folder belongs to one process: start takes an exclusive lock on it (where fcntl exists)
+and fails if another process holds it, as both would replay and delete the same segments.
+"""
+
+
+# Error class for when the play buffer cannot start
+class PlayBufferError(Exception):
+    def __init__(self, message=None):
+        Exception.__init__(self)
+        if message:
+            self.message = message
+        else:
+            self.message = "Play buffer error"
+
+    def __str__(self):
+        return self.message
+
+
+class PlayBuffer:
+    # open_db returns a DB on the calling thread's writer connection
+    def __init__(self, open_db, flush_ms=200, max_keys=10000, log_dir=None, fsync=True):
+        self.open_db = open_db
+        self.flush_ms = flush_ms
+        self.max_keys = max_keys
+        self.log_dir = log_dir
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.wake = threading.Condition(self.lock)
+        # one flush at a time (the flusher thread, sync and close)
+        self.flush_lock = threading.Lock()
+        # (date, song_id, playlist_id, album_id) -> plays not flushed yet, and their dates
+        self.pending = {}
+        self.dates = set()
+        # dates of the flush in progress
+        self.flushing_dates = set()
+        # lock file held on log_dir while running
+        self.lock_file = None
+        # open log segment, and closed ones whose events are pending
+        self.log = None
+        self.segments = []
+        self.last_segment = 0
+        self.thread = None
+        self.stopping = False
+
+    # Replays the segments a crash left behind, then starts the flusher thread
+    def start(self):
+        self.recover()
+        self.thread = threading.Thread(target=self.run, name="play-buffer", daemon=True)
+        self.thread.start()
+
+    # Flushes what is left and stops the flusher thread (registered to run at exit)
+    def close(self):
+        with self.lock:
+            self.stopping = True
+            self.wake.notify()
+        if self.thread is not None:
+            self.thread.join()
+        try:
+            self.flush()
+        except Exception:
+            logging.exception("Play buffer: last flush failed, its events stay in the log")
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    # Buffers a play event, as returned (and validated) by parse_play; once this returns it is logged
+    def add(self, play):
+        date, song_id, playlist_id, album_id, play_count = play
+        key = (date, song_id, playlist_id, album_id)
+        with self.lock:
+            if self.log_dir is not None:
+                self.write_log(play)
+            self.pending[key] = self.pending.get(key, 0) + play_count
+            self.dates.add(date)
+            if len(self.pending) >= self.max_keys:
+                self.wake.notify()
+
+    # Flushes if events of date (YYYY-MM-DD) are waiting, so a read sees every acknowledged play
+    def sync(self, date):
+        with self.lock:
+            waiting = date in self.dates or date in self.flushing_dates
+        if waiting:
+            self.flush()
+
+    # Adds the buffered events in one transaction; returns the number of keys written.
+    # If it fails the events go back to the buffer and the error is raised.
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending and not self.segments and self.log is None:
+                    return 0
+                batch, self.pending = self.pending, {}
+                dates, self.dates = self.dates, set()
+                self.flushing_dates = dates
+                segments = self.segments + self.close_log()
+                self.segments = []
+            names = [os.path.basename(path) for path in segments]
+            try:
+                db = self.open_db()
+                db.flush_plays([key + (count,) for key, count in batch.items()], names)
+            except Exception:
+                with self.lock:
+                    for key, count in batch.items():
+                        self.pending[key] = self.pending.get(key, 0) + count
+                    self.dates |= dates
+                    self.flushing_dates = set()
+                    self.segments = segments + self.segments
+                raise
+            with self.lock:
+                self.flushing_dates = set()
+            if segments:
+                for path in segments:
+                    os.remove(path)
+                db.forget_segments(names)
+            return len(batch)
+
+    # Flusher thread: flushes every flush_ms, or early once max_keys keys are waiting
+    def run(self):
+        while True:
+            with self.lock:
+                self.wake.wait_for(lambda: self.stopping or len(self.pending) >= self.max_keys,
+                                   timeout=self.flush_ms / 1000.0)
+                if self.stopping:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Play buffer flush failed, retrying")
+                time.sleep(self.flush_ms / 1000.0)
+
+    # Appends a play to the open log segment (called with the lock held)
+    def write_log(self, play):
+        if self.log is None:
+            # segment names sort in the order they were opened
+            self.last_segment = max(time.time_ns(), self.last_segment + 1)
+            self.log = open(os.path.join(self.log_dir, "%020d.log" % self.last_segment), "a")
+        self.log.write(json.dumps(play) + "\n")
+        self.log.flush()
+        if self.fsync:
+            os.fsync(self.log.fileno())
+
+    # Closes the open log segment; returns it as a list of paths (called with the lock held)
+    def close_log(self):
+        if self.log is None:
+            return []
+        self.log.close()
+        path = self.log.name
+        self.log = None
+        return [path]
+
+    # Takes the exclusive lock on log_dir, or raises PlayBufferError if another process has it
+    def lock_log_dir(self):
+        if fcntl is None:
+            return
+        lock_file = open(os.path.join(self.log_dir, "lock"), "a")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise PlayBufferError("Play buffer log %s is in use by another process" % self.log_dir)
+        self.lock_file = lock_file
+
+    # Buffers the events of the log segments not flushed before the last stop, and deletes
+    # the ones that were; they are written by the next flush
+    def recover(self):
+        if self.log_dir is None:
+            return
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.lock_log_dir()
+        names = sorted(name for name in os.listdir(self.log_dir) if name.endswith(".log"))
+        if not names:
+            return
+        db = self.open_db()
+        flushed = db.flushed_segments(names)
+        for name in names:
+            path = os.path.join(self.log_dir, name)
+            self.last_segment = max(self.last_segment, int(name[:-4]))
+            if name in flushed:
+                os.remove(path)
+                continue
+            with open(path) as f:
+                for line in f:
+                    try:
+                        date, song_id, playlist_id, album_id, play_count = json.loads(line)
+                    except (ValueError, TypeError):
+                        # a line cut short by the crash, never acknowledged
+                        continue
+                    key = (date, song_id, playlist_id, album_id)
+                    self.pending[key] = self.pending.get(key, 0) + play_count
+                    self.dates.add(date)
+            self.segments.append(path)
+        if flushed:
+            db.forget_segments(sorted(flushed))
+        logging.info("Play buffer: %d log segment(s) to replay", len(self.segments))
@@ -1,5 +1,15 @@
 drop table if exists duplicates;
 
+drop table if exists play_flush;
+
+drop table if exists artist_stats;
+
+drop table if exists daily_song_plays;
+
+drop table if exists song_countries;
+
+drop table if exists daily_country_plays;
+
 drop table if exists playlist_songs;
 
 drop table if exists release;
@@ -34,10 +44,5 @@ create table release(album_id int references album(album_id), artist_id int refe
 
 create table playlist_songs(playlist_id int references playlist(playlist_id), song_id int references song(song_id));
 
-
-
-
-
-
-
-
+-- this is the version 0 schema; keys, indexes and later tables come from schema/migrations
+pragma user_version = 0;
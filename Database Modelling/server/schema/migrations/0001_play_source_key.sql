@@ -0,0 +1,15 @@
+-- Merge duplicate play rows and key play by (date, song, source).
+-- A missing playlist/album is normalized to -1 so direct plays are unique too.
+
+create temporary table play_merged as
+    select date, sum(play_count) as play_count, song_id, playlist_id, album_id
+    from play
+    group by date, song_id, ifnull(playlist_id, -1), ifnull(album_id, -1);
+
+delete from play;
+
+insert into play select date, play_count, song_id, playlist_id, album_id from temp.play_merged;
+
+drop table temp.play_merged;
+
+create unique index if not exists play_source on play(date, song_id, ifnull(playlist_id, -1), ifnull(album_id, -1));
@@ -0,0 +1,28 @@
+-- Composite primary keys (so INSERT OR IGNORE dedupes) and lookup indexes for the join tables.
+-- SQLite can not add a primary key in place, so each table is rebuilt; duplicate rows are
+-- dropped and the original insertion (rowid) order is kept.
+
+create table created_new(artist_id int references artist(artist_id), song_id int references song(song_id), primary key(artist_id, song_id));
+insert into created_new select artist_id, song_id from created group by artist_id, song_id order by min(rowid);
+drop table created;
+alter table created_new rename to created;
+create index created_song on created(song_id, artist_id);
+
+create table tracklist_new(album_id int references album(album_id), song_id int references song(song_id), ordering int not null, primary key(album_id, song_id));
+insert into tracklist_new select album_id, song_id, min(ordering) from tracklist group by album_id, song_id order by min(rowid);
+drop table tracklist;
+alter table tracklist_new rename to tracklist;
+create index tracklist_order on tracklist(album_id, ordering, song_id);
+create index tracklist_song on tracklist(song_id, album_id);
+
+create table release_new(album_id int references album(album_id), artist_id int references artist(artist_id), primary key(album_id, artist_id));
+insert into release_new select album_id, artist_id from release group by album_id, artist_id order by min(rowid);
+drop table release;
+alter table release_new rename to release;
+create index release_artist on release(artist_id, album_id);
+
+create table playlist_songs_new(playlist_id int references playlist(playlist_id), song_id int references song(song_id), primary key(playlist_id, song_id));
+insert into playlist_songs_new select playlist_id, song_id from playlist_songs group by playlist_id, song_id order by min(rowid);
+drop table playlist_songs;
+alter table playlist_songs_new rename to playlist_songs;
+create index playlist_songs_song on playlist_songs(song_id, playlist_id);
@@ -0,0 +1,49 @@
+-- Per artist song count and total song length, kept current by triggers so every write to
+-- created/song updates it in the same transaction. avg_song_length and top_length read it.
+
+create table artist_stats(artist_id int primary key references artist(artist_id), song_count int not null, total_length int not null);
+
+insert into artist_stats
+    select c.artist_id, count(*), sum(s.length)
+    from created c join song s on (s.song_id = c.song_id)
+    group by c.artist_id;
+
+create index artist_stats_length on artist_stats(total_length desc, artist_id);
+
+create trigger artist_stats_created_insert after insert on created
+begin
+    insert into artist_stats
+        select new.artist_id, 1, s.length from song s where s.song_id = new.song_id
+        on conflict (artist_id) do update set song_count = song_count + 1, total_length = total_length + excluded.total_length;
+end;
+
+create trigger artist_stats_created_delete after delete on created
+begin
+    update artist_stats
+        set song_count = song_count - 1, total_length = total_length - (select s.length from song s where s.song_id = old.song_id)
+        where artist_id = old.artist_id and exists (select 1 from song s where s.song_id = old.song_id);
+    delete from artist_stats where artist_id = old.artist_id and song_count <= 0;
+end;
+
+-- a song can be inserted after its created rows
+create trigger artist_stats_song_insert after insert on song
+begin
+    insert into artist_stats
+        select c.artist_id, 1, new.length from created c where c.song_id = new.song_id
+        on conflict (artist_id) do update set song_count = song_count + 1, total_length = total_length + excluded.total_length;
+end;
+
+create trigger artist_stats_song_delete after delete on song
+begin
+    update artist_stats
+        set song_count = song_count - 1, total_length = total_length - old.length
+        where artist_id in (select c.artist_id from created c where c.song_id = old.song_id);
+    delete from artist_stats where song_count <= 0;
+end;
+
+create trigger artist_stats_song_length after update of length on song
+begin
+    update artist_stats
+        set total_length = total_length - old.length + new.length
+        where artist_id in (select c.artist_id from created c where c.song_id = new.song_id);
+end;
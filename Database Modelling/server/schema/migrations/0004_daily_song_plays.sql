@@ -0,0 +1,33 @@
+-- Total plays per (date, song), kept current by triggers on play so add_play updates it in
+-- the same statement. top_song reads the best song of a date with one index seek.
+
+create table daily_song_plays(date varchar(15) not null, song_id int not null references song(song_id), total_plays int not null, primary key(date, song_id));
+
+insert into daily_song_plays
+    select date, song_id, sum(play_count) from play group by date, song_id;
+
+create index daily_song_plays_top on daily_song_plays(date, total_plays desc, song_id);
+
+create trigger daily_song_plays_insert after insert on play
+begin
+    insert into daily_song_plays values (new.date, new.song_id, new.play_count)
+        on conflict (date, song_id) do update set total_plays = total_plays + excluded.total_plays;
+end;
+
+-- also fires for add_play's ON CONFLICT DO UPDATE
+create trigger daily_song_plays_update after update of play_count on play
+begin
+    update daily_song_plays set total_plays = total_plays - old.play_count
+        where date = old.date and song_id = old.song_id;
+    insert into daily_song_plays values (new.date, new.song_id, new.play_count)
+        on conflict (date, song_id) do update set total_plays = total_plays + excluded.total_plays;
+end;
+
+create trigger daily_song_plays_delete after delete on play
+begin
+    update daily_song_plays set total_plays = total_plays - old.play_count
+        where date = old.date and song_id = old.song_id;
+    delete from daily_song_plays
+        where date = old.date and song_id = old.song_id
+        and not exists (select 1 from play p where p.date = old.date and p.song_id = old.song_id);
+end;
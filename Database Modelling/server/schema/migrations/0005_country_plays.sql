@@ -0,0 +1,111 @@
+-- Replaces top_country's per call "duplicates" temp table with two maintained tables:
+--   song_countries: the distinct countries of each song's artists (artist_count artists each),
+--     so a song by several artists from one country counts once for that country;
+--   daily_country_plays: plays per (date, country), a play counting once for each of its
+--     song's countries.
+-- Triggers on created/artist keep song_countries current; a (song, country) pair appearing
+-- or disappearing moves that song's daily_song_plays totals in or out of the rollup, and
+-- triggers on play add each play event. Artists without a country count as country '' here,
+-- which top_country answers as null, like the grouping it replaces.
+
+create table song_countries(song_id int not null references song(song_id), country varchar(15) not null, artist_count int not null, primary key(song_id, country));
+
+insert into song_countries
+    select c.song_id, ifnull(a.artist_country, ''), count(*)
+    from created c join artist a on (a.artist_id = c.artist_id)
+    group by c.song_id, ifnull(a.artist_country, '');
+
+create table daily_country_plays(date varchar(15) not null, country varchar(15) not null, total_plays int not null, primary key(date, country));
+
+insert into daily_country_plays
+    select d.date, sc.country, sum(d.total_plays)
+    from daily_song_plays d join song_countries sc on (sc.song_id = d.song_id)
+    group by d.date, sc.country;
+
+create index daily_country_plays_top on daily_country_plays(date, total_plays desc, country);
+
+create index daily_song_plays_song on daily_song_plays(song_id);
+
+-- song_countries from created/artist
+
+create trigger song_countries_created_insert after insert on created
+begin
+    insert into song_countries
+        select new.song_id, ifnull(a.artist_country, ''), 1 from artist a where a.artist_id = new.artist_id
+        on conflict (song_id, country) do update set artist_count = artist_count + 1;
+end;
+
+create trigger song_countries_created_delete after delete on created
+begin
+    update song_countries set artist_count = artist_count - 1
+        where song_id = old.song_id and country = (select ifnull(a.artist_country, '') from artist a where a.artist_id = old.artist_id);
+    delete from song_countries where song_id = old.song_id and artist_count <= 0;
+end;
+
+-- an artist can be inserted after its created rows
+create trigger song_countries_artist_insert after insert on artist
+begin
+    insert into song_countries
+        select c.song_id, ifnull(new.artist_country, ''), 1 from created c where c.artist_id = new.artist_id
+        on conflict (song_id, country) do update set artist_count = artist_count + 1;
+end;
+
+create trigger song_countries_artist_country after update of artist_country on artist
+begin
+    update song_countries set artist_count = artist_count - 1
+        where country = ifnull(old.artist_country, '') and song_id in (select c.song_id from created c where c.artist_id = old.artist_id);
+    delete from song_countries
+        where country = ifnull(old.artist_country, '') and artist_count <= 0 and song_id in (select c.song_id from created c where c.artist_id = old.artist_id);
+    insert into song_countries
+        select c.song_id, ifnull(new.artist_country, ''), 1 from created c where c.artist_id = new.artist_id
+        on conflict (song_id, country) do update set artist_count = artist_count + 1;
+end;
+
+create trigger song_countries_artist_delete after delete on artist
+begin
+    update song_countries set artist_count = artist_count - 1
+        where country = ifnull(old.artist_country, '') and song_id in (select c.song_id from created c where c.artist_id = old.artist_id);
+    delete from song_countries
+        where country = ifnull(old.artist_country, '') and artist_count <= 0 and song_id in (select c.song_id from created c where c.artist_id = old.artist_id);
+end;
+
+-- daily_country_plays from song_countries
+
+create trigger daily_country_plays_pair_insert after insert on song_countries
+begin
+    insert into daily_country_plays
+        select d.date, new.country, d.total_plays from daily_song_plays d where d.song_id = new.song_id and true
+        on conflict (date, country) do update set total_plays = total_plays + excluded.total_plays;
+end;
+
+create trigger daily_country_plays_pair_delete after delete on song_countries
+begin
+    update daily_country_plays
+        set total_plays = total_plays - (select d.total_plays from daily_song_plays d where d.date = daily_country_plays.date and d.song_id = old.song_id)
+        where country = old.country and date in (select d.date from daily_song_plays d where d.song_id = old.song_id);
+end;
+
+-- daily_country_plays from play
+
+create trigger daily_country_plays_insert after insert on play
+begin
+    insert into daily_country_plays
+        select new.date, sc.country, new.play_count from song_countries sc where sc.song_id = new.song_id and true
+        on conflict (date, country) do update set total_plays = total_plays + excluded.total_plays;
+end;
+
+-- also fires for add_play's ON CONFLICT DO UPDATE
+create trigger daily_country_plays_update after update of play_count on play
+begin
+    update daily_country_plays set total_plays = total_plays - old.play_count
+        where date = old.date and country in (select sc.country from song_countries sc where sc.song_id = old.song_id);
+    insert into daily_country_plays
+        select new.date, sc.country, new.play_count from song_countries sc where sc.song_id = new.song_id and true
+        on conflict (date, country) do update set total_plays = total_plays + excluded.total_plays;
+end;
+
+create trigger daily_country_plays_delete after delete on play
+begin
+    update daily_country_plays set total_plays = total_plays - old.play_count
+        where date = old.date and country in (select sc.country from song_countries sc where sc.song_id = old.song_id);
+end;
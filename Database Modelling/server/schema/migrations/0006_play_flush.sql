@@ -0,0 +1,5 @@
+-- Log segments of the play write-behind buffer (PLAY_BUFFER) already added to play.
+-- A flush records its segments in the same transaction as its plays, so a segment a
+-- crash left behind is replayed only if its plays never made it in.
+
+create table play_flush(segment varchar(40) primary key);
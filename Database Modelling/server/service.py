@@ -0,0 +1,115 @@
+import sqlite3
+import datetime
+from db import KeyNotFound, BadRequest, parse_play
+
+
+"""
+Service layer for the /web pages: runs the same DB calls the JSON/REST endpoints make,
+in process, instead of the pages calling the API back over HTTP.
+Paths are the JSON API's urls, so the page forms keep sending the same values.
+"""
+
+
+# Error class for a failed service call; message and status code match what the JSON api answers
+class ServiceError(Exception):
+    def __init__(self, message, status_code=400):
+        Exception.__init__(self)
+        self.message = message
+        self.status_code = status_code
+
+    def to_dict(self):
+        rv = dict()
+        rv['message'] = self.message
+        return rv
+
+
+# Convert a YYYY-MM-DD string to a datetime.date. Raises BadRequest if not in the right format
+# or if not a valid date.
+# From https://stackoverflow.com/questions/53460391/passing-a-date-as-a-url-parameter-to-a-flask-route
+# Better function exists in 3.7+ adding this to support 3.6+
+def to_date(date_string):
+    try:
+        return datetime.datetime.strptime(date_string, "%Y-%m-%d").date()
+    except ValueError:
+        raise BadRequest('{} is not valid date in the format YYYY-MM-DD'.format(date_string))
+
+
+def as_is(parameter):
+    return parameter
+
+
+# GET urls (up to their parameters): the DB method and how to convert each url parameter
+LOOKUPS = {
+    "songs/": ("find_song", [as_is]),
+    "songs/by_album/": ("find_songs_by_album", [as_is]),
+    "songs/by_artist/": ("find_songs_by_artist", [as_is]),
+    "albums/": ("find_album", [as_is]),
+    "albums/by_artist/": ("find_album_by_artist", [as_is]),
+    "artists/": ("find_artist", [as_is]),
+    "analytics/artists/avg_song_length/": ("avg_song_length", [as_is]),
+    "analytics/artists/cnt_singles/": ("cnt_singles", [as_is]),
+    "analytics/artists/top_length/": ("top_length", [as_is]),
+    "analytics/solo_albums": ("solo_albums", []),
+    "analytics/playcount/top_song/": ("top_song", [to_date]),
+    "analytics/playcount/top_source/": ("top_source", [as_is, to_date]),
+    "analytics/playcount/top_source_all/": ("top_source_all", [to_date]),
+    "analytics/playcount/top_country/": ("top_country", [to_date]),
+}
+
+# POST urls: the DB method that loads the body
+POSTS = {
+    "artist": "add_artist",
+    "album": "add_album",
+    "songs": "add_song_ms2",
+    "playlists": "add_playlist",
+    "playcount": "add_play",
+}
+
+
+# Runs a DB call, turning its errors into ServiceError like the JSON endpoints do
+def run(call, *args):
+    try:
+        return call(*args)
+    except KeyNotFound as e:
+        print(e)
+        raise ServiceError(e.message, status_code=404)
+    except BadRequest as e:
+        raise ServiceError(e.message, status_code=e.error_code)
+    except sqlite3.Error as e:
+        print(e)
+        raise ServiceError(str(e))
+
+
+# Returns what GET <path><parameters joined by '/'> would, e.g. lookup(db, "songs/by_album/", "3").
+# With a play_buffer, playcount lookups first flush the buffered plays of their date.
+def lookup(db, path, *parameters, play_buffer=None):
+    if path not in LOOKUPS:
+        raise ServiceError("Not found %s" % path, status_code=404)
+    method, converters = LOOKUPS[path]
+    if len(parameters) != len(converters):
+        raise ServiceError("Expected %d parameters for %s" % (len(converters), path))
+
+    def call():
+        args = [convert(parameter) for convert, parameter in zip(converters, parameters)]
+        if play_buffer is not None and path.startswith("analytics/playcount/"):
+            # the date is the last parameter
+            play_buffer.sync(str(args[-1]))
+        return getattr(db, method)(*args)
+
+    return run(call)
+
+
+# Loads post_body like POST <path> would
+def post(db, path, post_body):
+    if path not in POSTS:
+        raise ServiceError("Not found %s" % path, status_code=404)
+    if not post_body:
+        raise ServiceError("No post body")
+    return run(getattr(db, POSTS[path]), post_body)
+
+
+# Buffers a play event like POST /playcount does when its play buffer is on
+def buffer_play(play_buffer, post_body):
+    if not post_body:
+        raise ServiceError("No post body")
+    return run(lambda: play_buffer.add(parse_play(post_body)))
@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+SERVER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER)
+
+import app as appmod
+
+
+# the app module, working in an empty folder (it opens splatDB.sqlite3 and schema/ relative to
+# the working directory); its process wide connections, caches and threads are dropped after
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    os.symlink(os.path.join(SERVER, "schema"), str(tmp_path / "schema"))
+    monkeypatch.chdir(tmp_path)
+    yield appmod
+    if appmod._write_queue is not None:
+        appmod._write_queue.close()
+    if appmod._play_buffer is not None:
+        appmod._play_buffer.close()
+    if appmod._connections is not None:
+        appmod._connections.close_all()
+    appmod._write_queue = None
+    appmod._play_buffer = None
+    appmod._connections = None
+    appmod._entity_cache = None
+    appmod._versions = None
+
+
+# a test client on a newly created database
+@pytest.fixture
+def client(server):
+    client = server.app.test_client()
+    assert client.get("/create").status_code == 200
+    return client
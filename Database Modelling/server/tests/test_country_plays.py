@@ -0,0 +1,62 @@
+import sqlite3
+
+
+def add(client, artists, songs, plays):
+    for artist_id, country in artists:
+        artist = {"artist_id": artist_id, "artist_name": "a%d" % artist_id}
+        if country is not None:
+            artist["country"] = country
+        assert client.post("/artist", json=artist).status_code == 201
+    for song_id, artist_ids in songs:
+        song = {"song_id": song_id, "song_name": "s%d" % song_id, "length": 3, "artist_ids": artist_ids}
+        assert client.post("/songs", json=song).status_code == 201
+    for song_id, play_count in plays:
+        play = {"date": "2020-01-01", "song_id": song_id, "play_count": play_count}
+        assert client.post("/playcount", json=play).status_code == 201
+
+
+def top_country(client):
+    r = client.get("/analytics/playcount/top_country/2020-01-01")
+    assert r.status_code == 200
+    return r.get_json()
+
+
+# the maintained tables hold what they would if built from scratch
+def assert_rollups_current(conn):
+    assert set(conn.execute("select song_id, country, artist_count from song_countries")) == set(conn.execute(
+        "select c.song_id, ifnull(a.artist_country, ''), count(*) from created c join artist a on a.artist_id = c.artist_id group by 1, 2"))
+    assert set(conn.execute("select date, country, total_plays from daily_country_plays where total_plays != 0")) == set(conn.execute(
+        "select p.date, sc.country, sum(p.play_count) from play p join song_countries sc on sc.song_id = p.song_id group by 1, 2"))
+
+
+def test_play_counts_once_for_each_country_of_its_song(client):
+    # song 1 has two US artists, song 2 a US and a CA one
+    add(client, [(1, "US"), (2, "US"), (3, "CA")], [(1, [1, 2]), (2, [1, 3])], [(1, 5), (2, 4)])
+
+    assert top_country(client) == [{"country": "US", "play_count": 9}]
+
+
+def test_artists_without_country_count_as_null(client):
+    add(client, [(1, "US"), (2, None)], [(1, [1]), (2, [2]), (3, [2])], [(1, 5), (2, 4), (3, 3)])
+
+    assert top_country(client) == [{"country": None, "play_count": 7}]
+
+
+def test_country_rollups_follow_artist_and_created_changes(client, server):
+    add(client, [(1, "US"), (2, None), (3, "CA")], [(1, [1, 2]), (2, [2, 3]), (3, [3])], [(1, 5), (2, 4), (3, 3)])
+    conn = sqlite3.connect(server.DATABASE)
+    assert_rollups_current(conn)
+
+    # an artist added after its songs, countries changed to and from null, a credit and an artist removed
+    conn.execute("insert into created values (4, 3)")
+    conn.execute("insert into artist values (4, 'a4', 'JP')")
+    conn.execute("update artist set artist_country = null where artist_id = 1")
+    conn.execute("update artist set artist_country = 'CA' where artist_id = 2")
+    conn.execute("delete from created where artist_id = 3 and song_id = 2")
+    conn.execute("delete from created where artist_id = 4")
+    conn.execute("delete from artist where artist_id = 4")
+    conn.commit()
+
+    assert_rollups_current(conn)
+    assert top_country(client) == [{"country": "CA", "play_count": 12}]
+    conn.close()
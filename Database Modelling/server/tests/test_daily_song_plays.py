@@ -0,0 +1,72 @@
+import json
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def songs(client):
+    client.post("/artist", json={"artist_id": 1, "artist_name": "a", "country": "US"})
+    for song_id in (1, 2, 3):
+        client.post("/songs", json={"song_id": song_id, "song_name": "s%d" % song_id, "length": 3, "artist_ids": [1]})
+    client.post("/album", json={"album_id": 1, "album_name": "al", "release_year": 2000, "artist_ids": [1], "song_ids": [1, 2]})
+    return client
+
+
+def play(date, song_id, play_count, **source):
+    return dict(date=date, song_id=song_id, play_count=play_count, **source)
+
+
+# daily_song_plays holds what it would if built from play
+def assert_rollup_current(conn):
+    assert set(conn.execute("select date, song_id, total_plays from daily_song_plays")) == set(conn.execute(
+        "select date, song_id, sum(play_count) from play group by date, song_id"))
+
+
+def top_song(client, date):
+    return client.get("/analytics/playcount/top_song/%s" % date)
+
+
+def test_rollup_follows_every_way_plays_arrive(songs, server):
+    # the same key twice goes through add_play's ON CONFLICT DO UPDATE
+    assert songs.post("/playcount", json=play("2020-01-01", 1, 2)).status_code == 201
+    assert songs.post("/playcount", json=play("2020-01-01", 1, 3)).status_code == 201
+    assert songs.post("/playcount", json=play("2020-01-01", 1, 4, album_id=1)).status_code == 201
+    assert songs.post("/playcount/bulk", json=[play("2020-01-01", 2, 6), play("2020-01-02", 2, 1),
+                                               play("2020-01-01", 2, 1, album_id=1)]).status_code == 201
+    body = "\n".join(json.dumps(p) for p in [play("2020-01-01", 3, 10), play("2020-01-02", 3, 1)])
+    assert songs.post("/playcount/stream", data=body).status_code == 201
+
+    conn = sqlite3.connect(server.DATABASE)
+    assert_rollup_current(conn)
+    assert top_song(songs, "2020-01-01").get_json() == [{"song_id": 3, "play_count": 10}]
+    conn.close()
+
+
+def test_rollup_follows_updates_and_deletes(songs, server):
+    songs.post("/playcount/bulk", json=[play("2020-01-01", 1, 5), play("2020-01-01", 1, 2, album_id=1),
+                                        play("2020-01-01", 2, 6)])
+    conn = sqlite3.connect(server.DATABASE)
+
+    conn.execute("update play set play_count = 1 where song_id = 2")
+    conn.commit()
+    assert_rollup_current(conn)
+    assert top_song(songs, "2020-01-01").get_json() == [{"song_id": 1, "play_count": 7}]
+
+    # one of song 1's two sources, then the other: its rollup row goes with the last one
+    conn.execute("delete from play where song_id = 1 and album_id = 1")
+    conn.commit()
+    assert_rollup_current(conn)
+    conn.execute("delete from play where song_id = 1")
+    conn.commit()
+    assert_rollup_current(conn)
+    assert conn.execute("select count(*) from daily_song_plays where song_id = 1").fetchone() == (0,)
+    assert top_song(songs, "2020-01-01").get_json() == [{"song_id": 2, "play_count": 1}]
+    conn.close()
+
+
+def test_top_song_ties_go_to_the_lowest_song_id(songs):
+    songs.post("/playcount/bulk", json=[play("2020-01-01", 3, 4), play("2020-01-01", 2, 4)])
+
+    assert top_song(songs, "2020-01-01").get_json() == [{"song_id": 2, "play_count": 4}]
+    assert top_song(songs, "2020-01-03").status_code == 404
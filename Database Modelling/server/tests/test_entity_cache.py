@@ -0,0 +1,60 @@
+import pytest
+
+from db import EntityCache
+
+
+@pytest.fixture
+def catalog(client, server, monkeypatch):
+    # every GET runs its view, so answers come from the cache or the database, never a 304
+    monkeypatch.setitem(server.app.config, "ETAGS", False)
+    client.post("/artist", json={"artist_id": 1, "artist_name": "a", "country": "US"})
+    client.post("/songs", json={"song_id": 1, "song_name": "s", "length": 3, "artist_ids": [1]})
+    return client
+
+
+def test_repeated_lookups_are_served_from_the_cache(catalog, server):
+    first = catalog.get("/songs/1").get_json()
+    hits = server.get_entity_cache().stats()["hits"]
+
+    assert catalog.get("/songs/1").get_json() == first
+    assert catalog.get("/songs/%s" % "1.0").get_json() == first
+    assert server.get_entity_cache().stats()["hits"] == hits + 2
+
+
+def test_writes_drop_the_entities_they_change(catalog):
+    assert catalog.get("/songs/1").get_json()[0]["album_ids"] == []
+    catalog.post("/album", json={"album_id": 1, "album_name": "al", "release_year": 2000, "artist_ids": [1], "song_ids": [1]})
+
+    assert catalog.get("/songs/1").get_json()[0]["album_ids"] == [1]
+    assert catalog.get("/albums/1").status_code == 200
+
+
+def test_recreating_the_tables_clears_the_cache(catalog):
+    assert catalog.get("/artists/1").status_code == 200
+    catalog.get("/create")
+
+    assert catalog.get("/artists/1").status_code == 404
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = EntityCache(max_size=2, ttl=None)
+    for key in ("a", "b"):
+        cache.get_or_load(key, lambda: key)
+    cache.get_or_load("a", lambda: "reloaded")
+    cache.get_or_load("c", lambda: "c")
+
+    assert cache.get_or_load("a", lambda: "reloaded") == "a"
+    assert cache.get_or_load("b", lambda: "reloaded") == "reloaded"
+    assert cache.stats()["evictions"] == 2
+
+
+# a load that read the rows before a write replaced them must not be cached after it
+def test_load_racing_an_invalidation_is_not_stored():
+    cache = EntityCache(ttl=None)
+
+    def load():
+        cache.invalidate([("song", 1)])
+        return "old"
+
+    assert cache.get_or_load(("song", 1), load) == "old"
+    assert cache.get_or_load(("song", 1), lambda: "new") == "new"
@@ -0,0 +1,83 @@
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def catalog(client):
+    client.post("/artist", json={"artist_id": 1, "artist_name": "a", "country": "US"})
+    for song_id in (1, 2):
+        client.post("/songs", json={"song_id": song_id, "song_name": "s%d" % song_id, "length": 3, "artist_ids": [1]})
+    client.post("/playcount", json={"date": "2020-01-01", "song_id": 1, "play_count": 2})
+    return client
+
+
+def get(client, url, etag=None):
+    return client.get(url, headers={"If-None-Match": etag} if etag else {})
+
+
+def test_matching_etag_gets_304_without_body(catalog):
+    r = get(catalog, "/songs/1")
+    assert r.status_code == 200
+    assert r.headers["ETag"].startswith('W/"')
+    assert r.headers["Cache-Control"] == "no-cache"
+
+    again = get(catalog, "/songs/1", r.headers["ETag"])
+
+    assert again.status_code == 304
+    assert again.data == b""
+    assert again.headers["ETag"] == r.headers["ETag"]
+
+
+# an entity's tag moves with writes to it, and the response (entity cache included) with it
+def test_write_to_entity_changes_its_tag_and_response(catalog):
+    song = get(catalog, "/songs/1")
+    top_song = get(catalog, "/analytics/playcount/top_song/2020-01-01")
+    catalog.post("/album", json={"album_id": 1, "album_name": "al", "release_year": 2000, "artist_ids": [1], "song_ids": [1]})
+
+    r = get(catalog, "/songs/1", song.headers["ETag"])
+
+    assert r.status_code == 200
+    assert r.headers["ETag"] != song.headers["ETag"]
+    assert r.get_json()[0]["album_ids"] == [1]
+    # responses that do not read what was written keep their tag
+    assert get(catalog, "/analytics/playcount/top_song/2020-01-01", top_song.headers["ETag"]).status_code == 304
+
+
+def test_write_to_table_changes_list_tags(catalog):
+    songs = get(catalog, "/songs/by_artist/1")
+    top_song = get(catalog, "/analytics/playcount/top_song/2020-01-01")
+    catalog.post("/songs", json={"song_id": 3, "song_name": "s3", "length": 3, "artist_ids": [1]})
+    catalog.post("/playcount", json={"date": "2020-01-01", "song_id": 2, "play_count": 5})
+
+    r = get(catalog, "/songs/by_artist/1", songs.headers["ETag"])
+    assert r.status_code == 200
+    assert [song["song_id"] for song in r.get_json()] == [1, 2, 3]
+    r = get(catalog, "/analytics/playcount/top_song/2020-01-01", top_song.headers["ETag"])
+    assert r.status_code == 200
+    assert r.get_json() == [{"song_id": 2, "play_count": 5}]
+
+
+# another process writing to the database: tags and cached entities must not go stale
+def test_external_write_changes_tags_and_clears_cache(catalog, server):
+    artist = get(catalog, "/artists/1")
+    conn = sqlite3.connect(server.DATABASE)
+    conn.execute("update artist set artist_name = 'renamed' where artist_id = 1")
+    conn.commit()
+    conn.close()
+
+    r = get(catalog, "/artists/1", artist.headers["ETag"])
+
+    assert r.status_code == 200
+    assert r.get_json()[0]["artist_name"] == "renamed"
+
+
+def test_star_and_missing_entities_are_not_304(catalog):
+    assert get(catalog, "/songs/999", "*").status_code == 404
+    assert get(catalog, "/songs/1", "*").status_code == 200
+
+
+def test_past_dates_are_cacheable(catalog):
+    r = get(catalog, "/analytics/playcount/top_song/2020-01-01")
+
+    assert r.headers["Cache-Control"] == "public, max-age=31536000, immutable"
@@ -0,0 +1,90 @@
+import os
+import sqlite3
+import threading
+
+from db import DB
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "schema")
+# the version of the last migration
+LATEST = max(int(name.split("_", 1)[0]) for name in os.listdir(os.path.join(SCHEMA, "migrations"))
+             if name.endswith(".sql"))
+
+
+# a database with the version 0 schema (schema/create.sql) and a few rows, plays duplicated
+def create_version_0(path):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    with open("schema/create.sql") as f:
+        conn.executescript(f.read())
+    conn.execute("insert into artist values (1, 'a', 'US')")
+    conn.execute("insert into song values (1, 's', 3)")
+    conn.execute("insert into created values (1, 1)")
+    conn.execute("insert into play values ('2020-01-01', 2, 1, null, null)")
+    conn.execute("insert into play values ('2020-01-01', 3, 1, null, null)")
+    conn.commit()
+    conn.close()
+
+
+def user_version(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_migrate_upgrades_version_0_database(server):
+    create_version_0("old.sqlite3")
+    conn = sqlite3.connect("old.sqlite3")
+    res = DB(conn).migrate(server.MIGRATIONS)
+
+    assert res["version"] == LATEST
+    assert len(res["applied"]) == LATEST
+    # 0001 merged the duplicate plays; the rollups were filled from them
+    assert conn.execute("select play_count from play").fetchall() == [(5,)]
+    assert conn.execute("select date, song_id, total_plays from daily_song_plays").fetchall() == [("2020-01-01", 1, 5)]
+    assert DB(conn).migrate(server.MIGRATIONS) == {"version": LATEST, "applied": []}
+    conn.close()
+
+
+# workers reaching their first request together: each migration must run exactly once
+def test_concurrent_migrations_run_each_migration_once(server):
+    for attempt in range(4):
+        path = "race%d.sqlite3" % attempt
+        create_version_0(path)
+        barrier = threading.Barrier(4)
+        results = []
+        errors = []
+
+        def migrate():
+            conn = sqlite3.connect(path, timeout=30)
+            barrier.wait()
+            try:
+                results.append(DB(conn).migrate(server.MIGRATIONS))
+            except sqlite3.Error as e:
+                errors.append(e)
+            finally:
+                conn.close()
+
+        threads = [threading.Thread(target=migrate) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        applied = [name for res in results for name in res["applied"]]
+        assert sorted(applied) == sorted(set(applied))
+        assert len(applied) == LATEST
+        assert user_version(path) == LATEST
+
+
+def test_existing_database_is_migrated_on_first_connection(server):
+    create_version_0(server.DATABASE)
+    client = server.app.test_client()
+
+    r = client.get("/analytics/playcount/top_song/2020-01-01")
+
+    assert r.status_code == 200
+    assert r.get_json() == [{"song_id": 1, "play_count": 5}]
+    assert user_version(server.DATABASE) == LATEST
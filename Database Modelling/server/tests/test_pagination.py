@@ -0,0 +1,66 @@
+import pytest
+
+LISTS = ["/songs/by_album/1", "/songs/by_artist/1", "/albums/by_artist/1", "/analytics/solo_albums"]
+
+
+@pytest.fixture
+def catalog(client):
+    for artist_id in (1, 2):
+        client.post("/artist", json={"artist_id": artist_id, "artist_name": "a%d" % artist_id, "country": "US"})
+    for song_id in range(1, 8):
+        artist_ids = [1, 2] if song_id == 3 else [1]
+        client.post("/songs", json={"song_id": song_id, "song_name": "s%d" % song_id, "length": song_id, "artist_ids": artist_ids})
+    # every track of an album is posted with the same ordering, so pages split ties
+    albums = [(1, [1], [5, 1, 7, 2, 6, 3, 4]), (2, [1], [1]), (3, [1, 2], [2]), (4, [1], [4, 5]), (5, [1], [])]
+    for album_id, artist_ids, song_ids in albums:
+        client.post("/album", json={"album_id": album_id, "album_name": "al%d" % album_id, "release_year": 2000,
+                                    "artist_ids": artist_ids, "song_ids": song_ids})
+    return client
+
+
+def all_pages(client, url, limit):
+    items = []
+    cursor = None
+    while True:
+        query = {"limit": limit} if cursor is None else {"limit": limit, "cursor": cursor}
+        r = client.get(url, query_string=query)
+        assert r.status_code == 200
+        page = r.get_json()
+        assert len(page["items"]) <= limit
+        items += page["items"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return items
+
+
+@pytest.mark.parametrize("url", LISTS)
+@pytest.mark.parametrize("limit", [1, 2, 3, 100])
+def test_pages_add_up_to_the_whole_list(catalog, url, limit):
+    whole = catalog.get(url).get_json()
+
+    assert len(whole) > 1
+    assert all_pages(catalog, url, limit) == whole
+
+
+@pytest.mark.parametrize("url", LISTS)
+def test_streamed_list_is_the_whole_list(catalog, url):
+    assert catalog.get(url, query_string={"stream": "json"}).get_json() == catalog.get(url).get_json()
+
+
+def test_cursor_only_fits_its_own_list(catalog):
+    cursor = catalog.get("/songs/by_artist/1", query_string={"limit": 2}).get_json()["next_cursor"]
+
+    assert catalog.get("/albums/by_artist/1", query_string={"cursor": cursor}).status_code == 400
+    assert catalog.get("/songs/by_artist/1", query_string={"cursor": "not a cursor"}).status_code == 400
+    assert catalog.get("/songs/by_artist/1", query_string={"limit": 0}).status_code == 400
+
+
+# a row added before the cursor neither repeats nor shifts what the next page returns
+def test_next_page_is_stable_under_inserts(catalog):
+    first = catalog.get("/songs/by_artist/1", query_string={"limit": 3}).get_json()
+    catalog.post("/songs", json={"song_id": 0, "song_name": "s0", "length": 1, "artist_ids": [1]})
+
+    second = catalog.get("/songs/by_artist/1", query_string={"limit": 3, "cursor": first["next_cursor"]}).get_json()
+
+    assert [song["song_id"] for song in first["items"]] == [1, 2, 3]
+    assert [song["song_id"] for song in second["items"]] == [4, 5, 6]
@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+from playbuffer import PlayBuffer, PlayBufferError
+
+
+@pytest.fixture
+def buffered(client, server, monkeypatch):
+    monkeypatch.setitem(server.app.config, "PLAY_BUFFER", True)
+    # flushed only when a read or the test asks for it
+    monkeypatch.setitem(server.app.config, "PLAY_BUFFER_FLUSH_MS", 100000)
+    client.post("/artist", json={"artist_id": 1, "artist_name": "a", "country": "US"})
+    for song_id in (1, 2):
+        client.post("/songs", json={"song_id": song_id, "song_name": "s", "length": 3, "artist_ids": [1]})
+    return client
+
+
+def top_song(client, date="2020-01-01"):
+    return client.get("/analytics/playcount/top_song/%s" % date).get_json()
+
+
+def log_segments(log_dir="play_buffer"):
+    return sorted(name for name in os.listdir(log_dir) if name.endswith(".log"))
+
+
+# stops a buffer the way a crash would: its plays lost but for its log; returns them
+def crash(play_buffer):
+    with play_buffer.lock:
+        play_buffer.stopping = True
+        play_buffer.wake.notify()
+    play_buffer.thread.join()
+    play_buffer.close_log()
+    play_buffer.lock_file.close()
+    plays, play_buffer.pending = play_buffer.pending, {}
+    play_buffer.dates = set()
+    return plays
+
+
+def test_plays_are_buffered_logged_and_read_back(buffered, server):
+    assert buffered.post("/playcount", json={"date": "2020-01-01", "song_id": 1, "play_count": 4}).status_code == 201
+    assert buffered.post("/playcount", json={"date": "2020-01-01", "song_id": 1, "play_count": 1}).status_code == 201
+
+    play_buffer = server.get_play_buffer()
+    assert play_buffer.pending == {("2020-01-01", 1, None, None): 5}
+    assert len(log_segments()) == 1
+    assert top_song(buffered) == [{"song_id": 1, "play_count": 5}]
+    assert play_buffer.pending == {}
+    assert log_segments() == []
+
+
+def test_web_form_plays_go_through_the_buffer(buffered, server):
+    r = buffered.post("/web/post_data", data={"path": "playcount",
+                                               "json_data": '{"date": "2020-01-01", "song_id": 2, "play_count": 3}'})
+
+    assert r.status_code == 200
+    assert server.get_play_buffer().pending == {("2020-01-01", 2, None, None): 3}
+    assert len(log_segments()) == 1
+    page = buffered.post("/web/analytics", data={"path": "playcount/top_song/", "date": "2020-01-01"})
+    assert server.get_play_buffer().pending == {}
+    assert "Error" not in page.get_data(as_text=True)
+
+
+def test_logged_plays_are_replayed_once_after_a_crash(buffered, server):
+    buffered.post("/playcount", json={"date": "2020-01-01", "song_id": 1, "play_count": 4})
+    buffered.post("/playcount", json={"date": "2020-01-02", "song_id": 2, "play_count": 2})
+    crash(server.get_play_buffer())
+
+    restarted = PlayBuffer(server.get_db, flush_ms=100000, log_dir="play_buffer")
+    restarted.start()
+    server._play_buffer = restarted
+    assert restarted.pending == {("2020-01-01", 1, None, None): 4, ("2020-01-02", 2, None, None): 2}
+
+    assert top_song(buffered) == [{"song_id": 1, "play_count": 4}]
+    assert top_song(buffered, "2020-01-02") == [{"song_id": 2, "play_count": 2}]
+    assert log_segments() == []
+
+
+# a crash between a flush's commit and the removal of its segments must not add them twice
+def test_flushed_segment_is_not_replayed(buffered, server):
+    buffered.post("/playcount", json={"date": "2020-01-01", "song_id": 1, "play_count": 4})
+    plays = crash(server.get_play_buffer())
+    server.get_db().flush_plays([key + (count,) for key, count in plays.items()], log_segments())
+
+    restarted = PlayBuffer(server.get_db, flush_ms=100000, log_dir="play_buffer")
+    restarted.start()
+    server._play_buffer = restarted
+
+    assert restarted.pending == {}
+    assert log_segments() == []
+    assert top_song(buffered) == [{"song_id": 1, "play_count": 4}]
+
+
+def test_log_folder_is_used_by_one_buffer_at_a_time(buffered, server):
+    buffered.post("/playcount", json={"date": "2020-01-01", "song_id": 1, "play_count": 4})
+
+    with pytest.raises(PlayBufferError):
+        PlayBuffer(server.get_db, log_dir="play_buffer").start()
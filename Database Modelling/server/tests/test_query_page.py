@@ -0,0 +1,38 @@
+import os
+
+
+def run_query(client, query):
+    return client.post("/web/query", data={"query": query, "output": "json"})
+
+
+def test_query_returns_rows(client):
+    client.post("/artist", json={"artist_id": 1, "artist_name": "a", "country": "US"})
+
+    r = run_query(client, "select artist_id, artist_name from artist")
+
+    assert r.status_code == 200
+    assert r.get_json()["rows"] == [{"artist_id": 1, "artist_name": "a"}]
+
+
+# the connection is pooled: nothing run on it may turn its safeguards off or reach other files
+def test_query_can_not_write_or_attach(client, tmp_path):
+    evil = str(tmp_path / "evil.sqlite3")
+    for query in ["PRAGMA query_only = 0", "ATTACH DATABASE '%s' AS evil" % evil, "PRAGMA user_version = 3",
+                  "insert into artist values (5, 'x', null)", "create temp table t(x)"]:
+        r = run_query(client, query)
+        assert "not authorized" in r.get_data(as_text=True), query
+
+    assert not os.path.exists(evil)
+    assert run_query(client, "PRAGMA user_version").get_json()["rows"][0]["user_version"] > 0
+    assert run_query(client, "PRAGMA table_info(artist)").get_json()["rows"][0]["name"] == "artist_id"
+    assert run_query(client, "select count(*) as n from artist").get_json()["rows"] == [{"n": 0}]
+
+
+def test_query_on_missing_database_renders_error(server, monkeypatch):
+    monkeypatch.setattr(server, "DATABASE", os.path.join("missing", "splatDB.sqlite3"))
+    monkeypatch.setitem(server.app.config, "AUTO_MIGRATE", False)
+
+    r = run_query(server.app.test_client(), "select 1")
+
+    assert r.status_code == 200
+    assert "unable to open database file" in r.get_data(as_text=True)
@@ -0,0 +1,58 @@
+import json
+import sqlite3
+import threading
+import time
+
+from db import DB
+
+
+def artist_line(artist_id):
+    return (json.dumps({"artist_id": artist_id, "artist_name": "a%d" % artist_id, "country": "US"}) + "\n").encode()
+
+
+def artist_count(database):
+    conn = sqlite3.connect(database)
+    try:
+        return conn.execute("select count(*) from artist").fetchone()[0]
+    finally:
+        conn.close()
+
+
+# rows that arrived before the feed went quiet are committed after chunk_ms, not when it resumes
+def test_stalled_feed_commits_on_time(client, server):
+    resume = threading.Event()
+
+    def feed():
+        yield artist_line(1)
+        yield artist_line(2)
+        resume.wait(10)
+        yield artist_line(3)
+
+    results = []
+
+    def load():
+        results.append(server.get_db().add_artists_stream(feed(), chunk_rows=1000, chunk_ms=50))
+
+    loader = threading.Thread(target=load)
+    loader.start()
+    deadline = time.monotonic() + 5
+    while artist_count(server.DATABASE) < 2 and time.monotonic() < deadline:
+        time.sleep(0.02)
+    committed_while_stalled = artist_count(server.DATABASE)
+    resume.set()
+    loader.join()
+
+    assert committed_while_stalled == 2
+    assert results[0]["inserted"] == 3
+    assert results[0]["commits"] == 2
+    assert artist_count(server.DATABASE) == 3
+
+
+def test_stream_reports_bad_lines_by_number(client):
+    body = b"".join([artist_line(1), b"\n", b"{not json\n", artist_line(2)])
+
+    r = client.post("/artist/stream", data=body)
+
+    assert r.status_code == 201
+    assert r.get_json() == {"inserted": 2, "failed_count": 1, "failed": [{"line": 3, "message": "Invalid JSON"}],
+                            "commits": 1}
@@ -0,0 +1,47 @@
+import json
+import re
+import threading
+
+from db import DB
+
+
+# a streamed body goes through the write queue: the bad line is reported, the good ones are
+# written on the writer thread
+def test_stream_with_bad_line_writes_on_writer_thread(client, monkeypatch):
+    threads = []
+    insert_many = DB.insert_many
+
+    def recording_insert_many(db, statements, parsed):
+        threads.append(threading.current_thread().name)
+        return insert_many(db, statements, parsed)
+
+    monkeypatch.setattr(DB, "insert_many", recording_insert_many)
+    body = "\n".join([json.dumps({"artist_id": 1, "artist_name": "a", "country": "US"}),
+                      "not json",
+                      json.dumps({"artist_id": 2, "artist_name": "b", "country": "US"})])
+    r = client.post("/artist/stream", data=body)
+
+    assert r.status_code == 201
+    res = r.get_json()
+    assert res["inserted"] == 2
+    assert res["failed_count"] == 1
+    assert [failure["line"] for failure in res["failed"]] == [2]
+    assert threads and set(threads) == {"write-queue"}
+    assert client.get("/artists/2").status_code == 200
+
+
+def db_seconds_sum(client, method, route):
+    metrics = client.get("/metrics").get_data(as_text=True)
+    match = re.search(r'^http_request_db_seconds_sum\{method="%s",route="%s"\} (\S+)$' % (method, re.escape(route)),
+                      metrics, re.MULTILINE)
+    return float(match.group(1)) if match else None
+
+
+# the statements a write runs on the writer thread count as its request's DB time
+def test_writes_on_writer_thread_count_in_request_db_time(client):
+    client.post("/artist", json={"artist_id": 1, "artist_name": "a", "country": "US"})
+    for i in range(20):
+        assert client.post("/songs", json={"song_id": i, "song_name": "s", "length": 3, "artist_ids": [1]}).status_code == 201
+
+    assert db_seconds_sum(client, "POST", "/songs") > 0
+    assert db_seconds_sum(client, "GET", "/create") > 0
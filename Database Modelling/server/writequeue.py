@@ -0,0 +1,209 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+
+"""
+Single writer with group commit (WRITE_QUEUE). Request threads hand their writes to one
+writer thread as jobs, fn(db), and wait. The writer takes every job waiting (up to
+max_batch) and runs them in one transaction, each in its own savepoint so a job that fails
+is undone alone. It commits once, and only then answers each job with its result or
+error. So requests never compete for SQLite's write lock, and a commit (an fsync, with
+DB_SYNCHRONOUS = FULL) is paid per batch, not per request; the busier it gets, the bigger
+the batches. Jobs submitted with alone=True (DDL, executescript) run on their own, between
+batches, with their own commits.
+With a QueryLog, the seconds of a job's statements are counted for the thread that submitted
+it, so its request's DB time in /metrics includes them.
+A request waits at most timeout_ms for the writer to start its job; past that the job is
+dropped and submit raises WriteQueueError, as it does at once when the writer is not running.
+"""
+
+
+# Error class for a write the write queue could not run
+class WriteQueueError(Exception):
+    def __init__(self, message=None):
+        Exception.__init__(self)
+        if message:
+            self.message = message
+        else:
+            self.message = "Write queue error"
+
+    def __str__(self):
+        return self.message
+
+
+class Job:
+    def __init__(self, fn, alone):
+        self.fn = fn
+        self.alone = alone
+        self.done = threading.Event()
+        # set under WriteQueue.lock: by the writer when it takes the job, by submit when it gives up
+        self.started = False
+        self.cancelled = False
+        # seconds of the statements fn ran
+        self.db_seconds = 0.0
+        self.result = None
+        self.error = None
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+
+class WriteQueue:
+    # open_db returns a DB on the calling thread's writer connection; query_log is the QueryLog
+    # timing its statements, if any
+    def __init__(self, open_db, max_batch=256, timeout_ms=30000, query_log=None):
+        self.open_db = open_db
+        self.query_log = query_log
+        self.max_batch = max_batch
+        self.timeout_ms = timeout_ms
+        self.lock = threading.Lock()
+        self.jobs = queue.Queue()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="write-queue", daemon=True)
+        self.thread.start()
+
+    # Lets the writer finish the jobs already queued, then stops it
+    def close(self):
+        self.jobs.put(None)
+        if self.thread is not None:
+            self.thread.join()
+
+    # Runs fn(db) on the writer thread; returns its result (or raises its error) once the
+    # batch it ran in is committed. Raises WriteQueueError if the writer is not running, or
+    # has not started the job within timeout_ms (the job is then dropped).
+    def submit(self, fn, alone=False):
+        if self.thread is None or not self.thread.is_alive():
+            raise WriteQueueError("Write queue is not running")
+        job = Job(fn, alone)
+        self.jobs.put(job)
+        deadline = time.monotonic() + self.timeout_ms / 1000.0
+        # once started a job runs to its commit; until then the deadline counts too
+        while not job.done.wait(1.0 if job.started else max(min(1.0, deadline - time.monotonic()), 0)):
+            if not self.thread.is_alive() and not job.done.is_set():
+                raise WriteQueueError("Write queue stopped")
+            if time.monotonic() >= deadline:
+                with self.lock:
+                    if not job.started:
+                        job.cancelled = True
+                        raise WriteQueueError("Write queue is busy, the write was not started within %d ms"
+                                              % self.timeout_ms)
+        if self.query_log is not None:
+            self.query_log.add_thread_seconds(job.db_seconds)
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def run(self):
+        db = self.open_db()
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            batch = [job]
+            while len(batch) < self.max_batch and not batch[-1].alone:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    self.jobs.put(None)
+                    break
+                batch.append(job)
+            batch = [job for job in batch if self.take(job)]
+            if not batch:
+                continue
+            try:
+                # an alone job is only ever last; the jobs before it commit first
+                if batch[-1].alone:
+                    self.run_batch(db, batch[:-1])
+                    self.run_alone(db, batch[-1])
+                else:
+                    self.run_batch(db, batch)
+            except Exception as e:
+                # never leave a request waiting
+                logging.exception("Write queue: batch failed")
+                db.savepoint = None
+                self.abort(db, [(job, None) for job in batch if not job.done.is_set()], e)
+
+    # Runs job.fn(db), adding the seconds of the statements it runs to the job
+    def call(self, db, job):
+        if self.query_log is None:
+            return job.fn(db)
+        start = self.query_log.thread_seconds()
+        try:
+            return job.fn(db)
+        finally:
+            job.db_seconds += self.query_log.thread_seconds() - start
+
+    # Marks a job started, unless submit gave up on it
+    def take(self, job):
+        with self.lock:
+            if job.cancelled:
+                return False
+            job.started = True
+            return True
+
+    # Runs jobs in one transaction and answers them after its commit
+    def run_batch(self, db, batch):
+        if not batch:
+            return
+        done = []
+        try:
+            db.begin_batch()
+        except sqlite3.Error as e:
+            for job in batch:
+                job.finish(error=e)
+            return
+        for index, job in enumerate(batch):
+            db.begin_job()
+            try:
+                result = self.call(db, job)
+            except Exception as e:
+                try:
+                    db.end_job(False)
+                except sqlite3.Error:
+                    # the error ended the whole transaction, the jobs before it are gone too
+                    self.abort(db, done + [(job, e)], e)
+                    self.run_batch(db, batch[index + 1:])
+                    return
+                done.append((job, e))
+                continue
+            db.end_job(True)
+            done.append((job, result))
+        try:
+            db.commit()
+        except sqlite3.Error as e:
+            self.abort(db, done, e)
+            return
+        for job, outcome in done:
+            if isinstance(outcome, Exception):
+                job.finish(error=outcome)
+            else:
+                job.finish(result=outcome)
+
+    # Fails every job of a batch that could not be committed
+    def abort(self, db, done, error):
+        logging.error("Write queue: batch of %d job(s) rolled back: %s", len(done), error)
+        if db.conn.in_transaction:
+            db.rollback()
+        db.dirty = set()
+        db.written = set()
+        for job, outcome in done:
+            job.finish(error=outcome if isinstance(outcome, Exception) else error)
+
+    def run_alone(self, db, job):
+        try:
+            result = self.call(db, job)
+        except Exception as e:
+            if db.conn.in_transaction:
+                db.rollback()
+            job.finish(error=e)
+            return
+        job.finish(result=result)